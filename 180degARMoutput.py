@@ -8,21 +8,14 @@ from math import pi
 import math
 import argparse
 import Helper as h
-import multiprocessing as mp
+import TraReader as tr
+import Histograms as hs
+import Instrumentation as ins
+import Sketches as sk
+import numpy as np
 from os import path
-pool = mp.Pool(mp.cpu_count())
 
 ################################################################################
-# Load MEGAlib into ROOT
-M.gSystem.Load("$(MEGALIB)/lib/libMEGAlib.so")
-
-# Initialize MEGAlib
-G = M.MGlobal()
-G.Initialize()
-
-# We are good to go ...
-GeometryName = "/volumes/selene/users/rhea/geomega/COSI.DetectorHead.geo.setup"
-
 parser = argparse.ArgumentParser(description='Compare output parameters from event reconstruction files and source location.')
 parser.add_argument('-f', '--filename', default='test.txt', help='txt file name used for calculating ARM. Contains path to tra file.')
 parser.add_argument('-m', '--minevents', default='1000000', help='Minimum number of events to use')
@@ -36,8 +29,15 @@ parser.add_argument('-b', '--batch', type=str, default='no', help='If set to yes
 parser.add_argument('-i', '--isotope', type=str, default='none', help='The name of the isotope')
 parser.add_argument('-r', '--run', type=str, default='none', help='The name of the run')
 parser.add_argument('-p', '--training', type=str, default='none', help='The name of the training output file')
+parser.add_argument('-c', '--checkpoint', type=str, default='', help='Checkpoint file of the ARM histograms. Resumes from it if it exists.')
+parser.add_argument('--checkpoint-every', type=int, default=1000000, help='Number of events between checkpoints')
+parser.add_argument('--sketch', type=str, default='', help='Also keep quantile sketches of the ARM per phi bin and write them to this file. They cover the events read by this job.')
+parser.add_argument('--sketch-compression', type=int, default=sk.DefaultCompression, help='Compression of the sketches: larger is more accurate at the tails and larger on disk (see Sketches.py)')
+parser.add_argument('--stats', type=str, default='', help='File to append the timing and event counts of this job to as one JSON line. Printed if not given.')
+parser.add_argument('--debug-sample', type=float, default=0.0, help='Fraction of the selected events whose ARM value is printed')
 
 args = parser.parse_args()
+Stats = ins.Stats("180degARMoutput", args.debug_sample, run=args.run, isotope=args.isotope, training=args.training)
 
 if args.filename != "":
   FileName = args.filename
@@ -82,48 +82,34 @@ while line:
   print(trafiles[-1])
   line = str(f.readline()).strip()
 
-# Load geometry:
-Geometry = M.MDGeometryQuest()
-if Geometry.ScanSetupFile(M.MString(GeometryName)) == True:
-  print("Geometry " + GeometryName + " loaded!")
-else:
-  print("Unable to load geometry " + GeometryName + " - Aborting!")
-  quit()
 
-
-#ARM histograms sorted by phi of the event, separated by 20 degrees
-HistARMlist = []
-for i in range(0, 180):
-    HistARMlist.append(M.TH1D("Angle Range " + str(i), title, 3601, -180, 180))
+#ARM histograms sorted by phi of the event, separated by 1 degree
+ARMbyPhi = hs.BinnedARM(np.arange(0, 181, 1))
+Filling = hs.Checkpoint(args.checkpoint, {"phi": ARMbyPhi}, args.checkpoint_every)
+SketchbyPhi = sk.BinnedSketch(ARMbyPhi.Edges, args.sketch_compression) if args.sketch else None
 
 print("Starting data collection...")
 
 # Load file
 for y in range(0, len(trafiles)):
-    Reader = M.MFileEventsTra()
-    if Reader.Open(M.MString(trafiles[y])) == False:
-        print("Unable to open file " + FileName + ". Aborting!")
+    if not path.exists(trafiles[y]):
+        print("Unable to open file " + trafiles[y] + ". Aborting!")
         quit()
     else:
-        print("File " + FileName + " loaded!")
+        print("File " + trafiles[y] + " loaded!")
 
 #Fill Histogram values
-    counter = 0
-    while counter <= 1000000:
-        Event = Reader.GetNextEvent()
-        counter = counter + 1
-        if not Event:
-            break
-
-        if (Event.GetType() == M.MPhysicalEvent.c_Compton) and (low_e <= Event.Ei() <= high_e):
-            ARM_value = Event.GetARMGamma(M.MVector(X, Y, Z))*(180.0/pi);
-            print("ARM_value: " + str(ARM_value))
-            print("Phi: " + str(Event.Phi()))
-            degree = Event.Phi()*(180/pi)
-            index = math.floor(degree)
-            HistARMlist[index].Fill(ARM_value);
-        else:
-            pass
+    for Events in Stats.timed("reading", Filling.events(trafiles[y], MaxEvents=1000001)):
+        with Stats.stage("selection"):
+            Compton = Events["type"] == tr.c_Compton
+            Selected = Compton & (low_e <= Events["Ei"]) & (Events["Ei"] <= high_e)
+            Stats.countSelection(Compton, Selected)
+        with Stats.stage("filling"):
+            ARM_values = h.getARM(Events["C1"][Selected], Events["Dg"][Selected], Events["phi"][Selected], (X, Y, Z))
+            ARMbyPhi.fill(hs.getAttribute(Events, "phi")[Selected], ARM_values)
+            if SketchbyPhi:
+                SketchbyPhi.fill(hs.getAttribute(Events, "phi")[Selected], ARM_values)
+        Stats.debug("ARM", Events["id"][Selected], ARM_values)
 print("\n")
 print("Data collection complete. Getting data analysis parameters..." + "\n")
 
@@ -131,13 +117,14 @@ print("Data collection complete. Getting data analysis parameters..." + "\n")
 #v1: see these values printed
 #TODO v2: store these values into a file
 
-FWHMlist = []
-RMSlist = []
-
-for i in range(len(HistARMlist)):
-    FWHMlist.append(h.getFWHM(HistARMlist[i]))
-    RMSlist.append(round(HistARMlist[i].GetRMS(), 2))
+FWHMlist = ARMbyPhi.getFWHM().tolist()
+RMSlist = ARMbyPhi.getRMS().tolist()
 
 print(FWHMlist)
 print(RMSlist)
 
+if SketchbyPhi:
+    sk.saveSketches(args.sketch, {"phi": SketchbyPhi})
+    print([round(s["containment68"], 2) for s in SketchbyPhi.summary()])
+
+Stats.write(args.stats)
@@ -0,0 +1,274 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Long-lived worker for ARMoutput.py jobs. The worker imports ROOT and the analysis modules once and
+#runs every job in a process forked from it, so a job does not pay for starting Python and loading
+#ROOT again. Jobs come in over a local socket, run concurrently, and the client gets back the job's
+#output, its exit code and the record of Instrumentation.Stats (timings, FWHM/RMS per method,
+#written files). The jobs are forked by a process without threads, itself forked once the modules are
+#loaded and before the worker starts any thread, so no lock held by another thread (stdout, ROOT)
+#is copied into a job.
+#
+#Usage: python3 ARMWorker.py start [-n 8]            starts a worker in the background
+#       python3 ARMWorker.py submit -- -f Run043.RF.txt -x 26.1 -y 0.3 -z 64 -b yes -r Run043 -i Cs137
+#       python3 ARMWorker.py status
+#       python3 ARMWorker.py stop
+#submit takes the options of ARMoutput.py and runs ARMoutput.py directly if no worker is running or
+#the job is not in batch mode.
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import secrets
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from multiprocessing.connection import Client, Listener, wait
+
+ScriptPath = os.path.dirname(os.path.abspath(__file__))
+DefaultAddress = os.path.join(os.path.expanduser("~"), ".cache", "COSIPrograms", "arm-worker.sock")
+
+def workerAddress():
+    return os.environ.get("COSI_ARM_WORKER", DefaultAddress)
+
+#Shared secret of worker and clients, readable only by the user
+def authKey(Address):
+    key_file = Address + ".key"
+    if not os.path.exists(key_file):
+        os.makedirs(os.path.dirname(key_file), exist_ok=True)
+        handle = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(handle, "w") as f:
+            f.write(secrets.token_hex(32))
+    with open(key_file, "r") as f:
+        return f.read().strip().encode()
+
+def connect(Address):
+    try:
+        return Client(Address, family="AF_UNIX", authkey=authKey(Address))
+    except (OSError, EOFError):
+        return None
+
+def isBatch(Arguments):
+    for i, argument in enumerate(Arguments[:-1]):
+        if argument in ("-b", "--batch"):
+            return Arguments[i+1] == "yes"
+    return False
+
+################################################################################
+
+#Runs one job in a forked child: output goes to LogFile, the record of the job to StatsFile
+def runJob(Script, Arguments, Directory, LogFile, StatsFile):
+    import runpy
+    log = os.open(LogFile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+    os.chdir(Directory)
+    sys.argv = [Script] + Arguments + ["--stats", StatsFile]
+    try:
+        runpy.run_path(Script, run_name="__main__")
+    except SystemExit as e:
+        code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(0)
+
+#Forks a child running runJob for every (number, arguments) received on Connection and sends back
+#(number, exit code) once it ended. It has no threads, so forking from it is safe. It stops on None or
+#when the worker is gone; Other is the worker's end of the pipe.
+def forker(Connection, Other):
+    Other.close()
+    running = {}
+    while True:
+        for ready in wait([Connection] + list(running)):
+            if ready is Connection:
+                try:
+                    job = Connection.recv()
+                except EOFError:
+                    return
+                if job is None:
+                    return
+                number, arguments = job
+                child = mp.get_context("fork").Process(target=runJob, args=arguments)
+                child.start()
+                running[child.sentinel] = (number, child)
+            else:
+                number, child = running.pop(ready)
+                child.join()
+                Connection.send((number, child.exitcode))
+
+class Worker:
+    def __init__(self, Address, Jobs):
+        self.Address = Address
+        self.Jobs = Jobs
+        self.Slots = threading.Semaphore(Jobs)
+        self.Running = 0
+        self.Finished = 0
+        self.Lock = threading.Lock()
+        self.Started = time.time()
+        #Jobs waiting for the forker: number -> [event, exit code]
+        self.Waiting = {}
+        self.Number = 0
+
+    #Warm start: everything a job imports is loaded here once
+    def prepare(self):
+        sys.path.insert(0, ScriptPath)
+        import ROOT as M
+        M.gROOT.SetBatch(True)
+        import numpy, Helper, TraReader, StagedReader, GzipIndex, EventCache, Histograms, Instrumentation, Sketches, ResultCache, MetricsStore, Render
+
+    #Exit codes of the jobs from the forker
+    def collect(self):
+        while True:
+            try:
+                number, code = self.Forker.recv()
+            except (EOFError, OSError):
+                return
+            with self.Lock:
+                waiting = self.Waiting.pop(number)
+            waiting[1] = code
+            waiting[0].set()
+
+    def serve(self):
+        self.prepare()
+        self.Forker, connection = mp.Pipe()
+        mp.get_context("fork").Process(target=forker, args=(connection, self.Forker)).start()
+        connection.close()
+        threading.Thread(target=self.collect, daemon=True).start()
+        if os.path.exists(self.Address):
+            os.remove(self.Address)
+        listener = Listener(self.Address, family="AF_UNIX", authkey=authKey(self.Address))
+        print("INFO: ARM worker listening on " + self.Address + " with " + str(self.Jobs) + " job slots")
+        sys.stdout.flush()
+        self.Stop = False
+        while not self.Stop:
+            try:
+                connection = listener.accept()
+            except (OSError, EOFError, mp.AuthenticationError):
+                continue
+            threading.Thread(target=self.handle, args=(connection,), daemon=True).start()
+        listener.close()
+        with self.Lock:
+            self.Forker.send(None)
+
+    def handle(self, Connection):
+        with Connection:
+            try:
+                request = Connection.recv()
+            except EOFError:
+                return
+            if request["command"] == "run":
+                Connection.send(self.run(request))
+            elif request["command"] == "status":
+                with self.Lock:
+                    Connection.send({"pid": os.getpid(), "slots": self.Jobs, "running": self.Running, "finished": self.Finished,
+                                     "uptime": round(time.time() - self.Started, 1)})
+            elif request["command"] == "stop":
+                self.Stop = True
+                Connection.send({"stopped": True})
+                #Wake up accept() so the loop sees Stop
+                connect(self.Address)
+
+    def run(self, Request):
+        script = os.path.join(ScriptPath, "ARMoutput.py")
+        arguments = list(Request["arguments"])
+        if "-j" not in arguments and "--processes" not in arguments:
+            arguments += ["-j", str(max(1, (os.cpu_count() or 1)//self.Jobs))]
+        with self.Slots:
+            with self.Lock:
+                self.Running += 1
+            handle, log_file = tempfile.mkstemp(prefix="arm-job.", suffix=".log")
+            os.close(handle)
+            stats_file = log_file[:-4] + ".json"
+            waiting = [threading.Event(), None]
+            with self.Lock:
+                self.Number += 1
+                number = self.Number
+                self.Waiting[number] = waiting
+                self.Forker.send((number, (script, arguments, Request["cwd"], log_file, stats_file)))
+            waiting[0].wait()
+            with self.Lock:
+                self.Running -= 1
+                self.Finished += 1
+
+        with open(log_file, "r", errors="replace") as f:
+            log = f.read()
+        record = None
+        if os.path.exists(stats_file):
+            with open(stats_file, "r") as f:
+                lines = f.read().splitlines()
+            record = json.loads(lines[-1]) if lines else None
+            os.remove(stats_file)
+        os.remove(log_file)
+        return {"exit": waiting[1], "log": log, "record": record}
+
+################################################################################
+
+#Submits a job and prints its output as if ARMoutput.py had run here
+def submit(Arguments):
+    connection = connect(workerAddress()) if isBatch(Arguments) else None
+    if connection is None:
+        script = os.path.join(ScriptPath, "ARMoutput.py")
+        os.execv(sys.executable, [sys.executable, script] + Arguments)
+    with connection:
+        connection.send({"command": "run", "arguments": Arguments, "cwd": os.getcwd()})
+        reply = connection.recv()
+    sys.stdout.write(reply["log"])
+    if reply["record"] is not None:
+        print("STATS: " + json.dumps(reply["record"]))
+        for FileName in reply["record"]["outputs"]:
+            print("INFO: Wrote " + FileName)
+    return reply["exit"]
+
+#Starts a worker in the background and waits until it accepts jobs
+def start(Jobs, LogFile):
+    address = workerAddress()
+    if connect(address) is not None:
+        print("INFO: ARM worker already running on " + address)
+        return 0
+    with open(LogFile, "a") as log:
+        subprocess.Popen([sys.executable, os.path.abspath(__file__), "serve", "-n", str(Jobs)], stdout=log, stderr=log,
+                         stdin=subprocess.DEVNULL, start_new_session=True)
+    for _ in range(600):
+        time.sleep(0.1)
+        if connect(address) is not None:
+            print("INFO: ARM worker running on " + address)
+            return 0
+    print("ERROR: ARM worker did not start, see " + LogFile)
+    return 1
+
+def request(Command):
+    connection = connect(workerAddress())
+    if connection is None:
+        print("INFO: No ARM worker running on " + workerAddress())
+        return None
+    with connection:
+        connection.send({"command": Command})
+        return connection.recv()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run ARMoutput.py jobs in a persistent worker.')
+    parser.add_argument('command', choices=['serve', 'start', 'submit', 'status', 'stop'], help='serve in the foreground, start in the background, submit a job, show status, or stop the worker')
+    parser.add_argument('-n', '--jobs', type=int, default=os.cpu_count() or 1, help='Number of jobs the worker runs at the same time')
+    parser.add_argument('--log', type=str, default='ARMWorker.log', help='Log file of a worker started with start')
+    #For submit, everything after -- is passed on to ARMoutput.py
+    argv = sys.argv[1:]
+    split = argv.index('--') if '--' in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    arguments = argv[split+1:]
+    if args.command == 'serve':
+        Worker(workerAddress(), args.jobs).serve()
+    elif args.command == 'start':
+        sys.exit(start(args.jobs, args.log))
+    elif args.command == 'submit':
+        sys.exit(submit(arguments))
+    else:
+        reply = request(args.command)
+        if reply is not None:
+            print(json.dumps(reply))
@@ -5,23 +5,21 @@
 import ROOT as M
 from math import pi
 import argparse
+import sys
 import Helper as h
-import multiprocessing as mp
+import TraReader as tr
+import Histograms as hs
+import EventCache as ec
+import Instrumentation as ins
+import Sketches as sk
+import ResultCache as rc
+import MetricsStore as ms
+import Render as rd
+import numpy as np
 from os import path
-pool = mp.Pool(mp.cpu_count())
 
 #################################################################################################################################################################################
 
-# Load MEGAlib into ROOT
-M.gSystem.Load("$(MEGALIB)/lib/libMEGAlib.so")
-
-# Initialize MEGAlib
-G = M.MGlobal()
-G.Initialize()
-
-# We are good to go ...
-GeometryName = "/volumes/selene/users/rhea/geomega/COSI.DetectorHead.geo.setup"
-
 parser = argparse.ArgumentParser(description='Create comparison of ARM plots from event reconstruction files and source location.')
 parser.add_argument('-f', '--filename', default='ComptonTrackIdentification.p1.sim.gz', help='txt file name used for calculating ARM. Contains paths to tra files.')
 parser.add_argument('-m', '--minevents', default='1000000', help='Minimum number of events to use')
@@ -29,16 +27,31 @@ parser.add_argument('-x', '--xcoordinate', type=float, default='26.1', help='X c
 parser.add_argument('-y', '--ycoordinate', type=float, default='0.3', help='Y coordinate of position in 3D Cartesian coordinates')
 parser.add_argument('-z', '--zcoordinate', type=float, default='64', help='Z coordinate of position in 3D Cartesian coordinates') 
 parser.add_argument('-l', '--logarithmic', type=str, default='no', help='If set to yes, displays ARM plot on a logarithmic-scaled y-axis.') 
-parser.add_argument('-e', '--energy', type=float, default='662', help='Peak energy value for source. Outputs ARM histograms with a +-1.5% energy window.')
+parser.add_argument('-e', '--energy', type=float, nargs='+', default=None, help='Peak energy values for source. Outputs ARM histograms with a +-1.5% energy window for each. Defaults to the lines of the isotope, or 662.')
 parser.add_argument('-t', '--title', type=str, default='"ARM Plot for Compton Events"', help='Title for ARM Plot')
 parser.add_argument('-b', '--batch', type=str, default='no', help='If set to yes, runs program in batch mode.')
-parser.add_argument('-i', '--isotope', type=str, default='none', help='The name of the isotope')
+parser.add_argument('-i', '--isotope', type=str, default='none', help='The name of the isotope. Its lines from the line catalog in Helper.py are used if no energies are given.')
 parser.add_argument('-r', '--run', type=str, default='none', help='The name of the run')
 parser.add_argument('-p', '--training', type=str, default='none', help='The name of the training output file')
+parser.add_argument('-s', '--seed', type=int, default=0, help='Seed for the bootstrap error estimation')
+parser.add_argument('-j', '--processes', type=int, default=0, help='Number of processes for reading the tra files and the bootstrap (default: all cores)')
+parser.add_argument('-c', '--checkpoint', type=str, default='', help='Checkpoint file of the ARM histograms. Resumes from it if it exists.')
+parser.add_argument('--checkpoint-every', type=int, default=1000000, help='Number of events between checkpoints')
+parser.add_argument('--sketch', type=str, default='', help='Also keep quantile sketches of the ARM per line and method and write them to this file. They cover the events read by this job.')
+parser.add_argument('--sketch-compression', type=int, default=sk.DefaultCompression, help='Compression of the sketches: larger is more accurate at the tails and larger on disk (see Sketches.py)')
+parser.add_argument('--index', action='store_true', help='Read only the Compton events in the energy windows, through the energy index of the event cache (see EventCache.py). Not with --checkpoint.')
+parser.add_argument('--no-cache', action='store_true', help='Compute all results again instead of taking them from the result cache (see ResultCache.py)')
+parser.add_argument('--metrics', type=str, default=ms.DefaultDatabase, help='SQLite file the FWHM, RMS and peak height of every method and line are written to (see MetricsStore.py)')
+parser.add_argument('--backend', choices=['root', 'matplotlib'], default='root', help='Library the plots are drawn with in batch mode. The histograms are also saved as .plot.npz for Render.py.')
+parser.add_argument('--format', type=str, nargs='+', default=['pdf'], help='Formats of the plots in batch mode, e.g. pdf png')
+parser.add_argument('--stats', type=str, default='', help='File to append the timing and event counts of this job to as one JSON line. Printed if not given.')
+parser.add_argument('--debug-sample', type=float, default=0.0, help='Fraction of the selected events whose ARM value is printed')
 
 
 
 args = parser.parse_args()
+Stats = ins.Stats("ARMoutput", args.debug_sample, run=args.run, isotope=args.isotope, training=args.training)
+Stats.start("init")
 
 if args.filename != "":
   FileName = args.filename
@@ -51,9 +64,18 @@ print("INFO: Using location ({}/{}/{})".format(X, Y, Z))
 if args.logarithmic != "":
     log = args.logarithmic
 
-energy = args.energy
-low_e = 0.985 * float(args.energy)
-high_e = 1.015 * float(args.energy)
+if args.energy:
+    energies = args.energy
+elif args.isotope in h.LineCatalog:
+    energies = h.LineCatalog[args.isotope]
+elif args.isotope != 'none':
+    print("ERROR: Unknown isotope " + args.isotope + " - pass its lines with -e")
+    sys.exit(1)
+else:
+    energies = [662.0]
+low_e = [0.985 * float(energy) for energy in energies]
+high_e = [1.015 * float(energy) for energy in energies]
+print("INFO: Using lines " + ", ".join("{} keV".format(energy) for energy in energies))
 
 if int(args.minevents) < 1000000:
   MinEvents = int(args.minevents)
@@ -65,7 +87,11 @@ run=args.run
 isotope=args.isotope
 training = args.training
 
-title = "{} ({}, {} keV): ARM comparison ".format(run, isotope, energy)
+titles = ["{} ({}, {} keV): ARM comparison ".format(run, isotope, energy) for energy in energies]
+
+if args.index and args.checkpoint:
+    print("ERROR: --index reads only the selected events, which cannot be resumed from a checkpoint")
+    sys.exit(1)
 
 Batch = False
 if args.batch == 'yes':
@@ -74,6 +100,8 @@ if args.batch == 'yes':
     
 ###################################################################################################################################################################################
 
+Stats.stop("init")
+
 #Read in Files
 trafiles = []
 f = open(args.filename, "r")
@@ -83,165 +111,138 @@ while line:
   print(trafiles[-1])
   line = str(f.readline()).strip()
 
-# Load geometry:
-Geometry = M.MDGeometryQuest()
-if Geometry.ScanSetupFile(M.MString(GeometryName)) == True:
-  print("Geometry " + GeometryName + " loaded!")
-else:
-  print("Unable to load geometry " + GeometryName + " - Aborting!")
-  quit()
-    
-#Create Histogram list and color
-HistARMlist = []
-for i in range(0, len(trafiles)):
-    HistARMlist.append(M.TH1D("ARM Plot of Compton events" + str(i), title, 3601, -180, 180))
-    
-HistARMlist[0].SetLineColor(M.kRed)
-if len(HistARMlist) >= 2: 
-  HistARMlist[1].SetLineColor(M.kGreen)
-if len(HistARMlist) >= 3: 
-  HistARMlist[2].SetLineColor(M.kBlue)
-if len(HistARMlist) >= 4: 
-  HistARMlist[3].SetLineColor(M.kBlack)
+#ARM histograms of all methods per line, one slice per tra file
+ARMlines = {"{} keV".format(energy): hs.BinnedARM(np.arange(0, len(trafiles)+1)) for energy in energies}
+Filling = hs.Checkpoint(args.checkpoint, ARMlines, args.checkpoint_every)
+Sketchlines = {name: sk.BinnedSketch(ARMline.Edges, args.sketch_compression) for name, ARMline in ARMlines.items()} if args.sketch else {}
+
+#Results of every tra file and line from earlier jobs with the same inputs. A file is only read if one of its
+#lines is not cached; checkpoints and sketches need the events, so they always read.
+Results = rc.ResultCache([__file__, h.__file__, hs.__file__, tr.__file__], "" if args.no_cache else None)
+Binning = list(ARMlines.values())[0]
+ResultKeys = []
+Cached = []
 
 # Load file
 for y in range(0, len(trafiles)):
-    Reader = M.MFileEventsTra()
-    if Reader.Open(M.MString(trafiles[y])) == False:
-        print("Unable to open file " + FileName + ". Aborting!")
-        quit()
+    if not path.exists(trafiles[y]):
+        print("Unable to open file " + trafiles[y] + ". Aborting!")
+        sys.exit(1)
+    else:
+        print("File " + trafiles[y] + " loaded!")
+
+    ResultKeys.append([Results.key(trafiles[y], position=[X, Y, Z], window=[low_e[l], high_e[l]], maxevents=1000001, bootstrap=[1000, args.seed],
+                                   binning=[Binning.ARMBins, Binning.ARMLow, Binning.ARMHigh]) for l in range(0, len(energies))])
+    Cached.append([None if args.checkpoint or Sketchlines else Results.load(key) for key in ResultKeys[y]])
+    if all(entry is not None for entry in Cached[y]):
+        print("INFO: Using cached results for " + trafiles[y])
+        for ARMline, entry in zip(ARMlines.values(), Cached[y]):
+            ARMline.Counts[y] = entry["counts"]
+            ARMline.Sums[y] = entry["sums"]
+        continue
+
+#Fill Histogram values of all lines in one pass
+    if args.index:
+        Batches = ec.readWindows(trafiles[y], list(zip(low_e, high_e)), tr.c_Compton, MaxEvents=1000001, Stats=Stats, Processes=args.processes or None)
     else:
-        print("File " + FileName + " loaded!")
-
-#Fill Histogram values
-    counter = 0
-    while counter <= 1000000:
-        Event = Reader.GetNextEvent()
-        counter = counter + 1
-        if not Event:
-            break
-
-        if (Event.GetType() == M.MPhysicalEvent.c_Compton) and (low_e <= Event.Ei() <= high_e):
-            ARM_value = Event.GetARMGamma(M.MVector(X, Y, Z))*(180.0/pi);
-            print(ARM_value)
-            HistARMlist[y].Fill(Event.GetARMGamma(M.MVector(X, Y, Z))*(180.0/pi));
-        elif Event.GetType() == M.MPhysicalEvent.c_Photo:
-            pass
+        Batches = Filling.events(trafiles[y], MaxEvents=1000001, Stats=Stats, Processes=args.processes or None)
+    for Events in Stats.timed("reading", Batches):
+        with Stats.stage("selection"):
+            Ei = Events["Ei"]
+            Windows = [(low_e[l] <= Ei) & (Ei <= high_e[l]) for l in range(0, len(energies))]
+            Compton = Events["type"] == tr.c_Compton
+            Selected = Compton & np.logical_or.reduce(Windows)
+            Stats.countSelection(Compton, Selected)
+        with Stats.stage("filling"):
+            ARM_values = h.getARM(Events["C1"][Selected], Events["Dg"][Selected], Events["phi"][Selected], (X, Y, Z))
+            for name, Window in zip(ARMlines, Windows):
+                ARMlines[name].fill(np.full(Window[Selected].sum(), y), ARM_values[Window[Selected]])
+                if Sketchlines:
+                    Sketchlines[name].fill(np.full(Window[Selected].sum(), y), ARM_values[Window[Selected]])
+        Stats.debug("ARM", Events["id"][Selected], ARM_values)
+
+if Sketchlines:
+    with Stats.stage("output"):
+        sk.saveSketches(args.sketch, Sketchlines)
 
 #Parallelizing
-FWHMs = [None]*len(trafiles)
-RMSs = [None]*len(trafiles)
-Peaks = [None]*len(trafiles)
-#if __name__ == '__main__':
-for i in range(0, len(trafiles)):
-    FWHMs[i] = pool.apply(h.bootstrapFWHM, args=(HistARMlist[i], 1000,))
-    RMSs[i] = pool.apply(h.bootstrapRMS, args=(HistARMlist[i], 1000,))
-    Peaks[i] = pool.apply(h.bootstrapPeak, args=(HistARMlist[i], 1000,))
-pool.close()
-pool.join()
+with Stats.stage("bootstrap"):
+    Rows = [(l, y) for l in range(0, len(energies)) for y in range(0, len(trafiles))]
+    Missing = [(l, y) for l, y in Rows if Cached[y][l] is None]
+    Computed = dict(zip(Missing, h.bootstrapAll([(list(ARMlines.values())[l].Counts[y], Binning.ARMLow, Binning.ARMHigh) for l, y in Missing], 1000,
+                                                seed=args.seed, processes=args.processes or None, Keys=[Results.seed(ResultKeys[y][l]) for l, y in Missing])))
+    Errors = [Computed[(l, y)] if Cached[y][l] is None else (Cached[y][l]["FWHMError"], Cached[y][l]["RMSError"], Cached[y][l]["PeakError"]) for l, y in Rows]
+
+with Stats.stage("caching"):
+    for l, ARMline in enumerate(ARMlines.values()):
+        PeakValues, _, FWHMValues = ARMline.getPeakFWHM()
+        RMSValues = ARMline.getRMS()
+        for y in range(0, len(trafiles)):
+            if Cached[y][l] is None:
+                Results.store(ResultKeys[y][l], ARMline.Counts[y], ARMline.Sums[y], source=path.realpath(trafiles[y]), energy=energies[l],
+                              entries=float(ARMline.Counts[y].sum()), FWHM=round(float(FWHMValues[y]), 2), RMS=float(RMSValues[y]), Peak=float(PeakValues[y]),
+                              FWHMError=Computed[(l, y)][0], RMSError=Computed[(l, y)][1], PeakError=Computed[(l, y)][2])
+    Results.prune()
+    Stats.count("result_cache_hits", Results.Hits)
+    Stats.count("result_cache_misses", Results.Misses)
 
 #############################################################################################################################################################################
 
-#Draw Histogram, Set Up Canvas
-
-max = HistARMlist[0].GetMaximum()
-for m in range(1, len(trafiles)):
-    if HistARMlist[m].GetMaximum()>max:
-        max = HistARMlist[m].GetMaximum()
-for m in range(0, len(trafiles)):
-    HistARMlist[m].SetMaximum(1.1*max)
-
-CanvasARM = M.TCanvas("CanvasARM", title, 650, 800)
-print("Drawing ARM histograms for each method...")
-for m in range(0, len(trafiles)):
-    if log == 'yes':
-        M.gPad.SetLogy()
-        HistARMlist[0].GetYaxis().SetTitle("Counts [logarithmic]")
-        HistARMlist[m].Draw("same")
+Stats.start("rendering")
+Canvases = []
+MetricRows = []
+
+for l, ARMline in enumerate(ARMlines.values()):
+    energy = energies[l]
+    title = titles[l]
+    PeakValues, _, FWHMValues = ARMline.getPeakFWHM()
+    FWHMValues = np.round(FWHMValues, 2)
+    RMSValues = ARMline.getRMS()
+    Entries = ARMline.entries()
+    LineErrors = Errors[l*len(trafiles):(l+1)*len(trafiles)]
+    FWHMs = [e[0] for e in LineErrors]
+    RMSs = [e[1] for e in LineErrors]
+    Peaks = [e[2] for e in LineErrors]
+
+    #Plot of all methods with the legend [Method, RMS Value, Peak Height, Total Count, FWHM], drawn by Render.py
+    print("Drawing ARM histograms for each method...")
+    Methods = [ms.algorithmName(trafiles[i], i) + " Method" for i in range(0, len(trafiles))]
+    Plot = rd.Plot(title, Methods, ARMline.Counts, ARMline.Sums, ARMline.ARMLow, ARMline.ARMHigh,
+                   ["Analysis Methods", "RMS Value", "Peak Height", "Total Count", "FWHM"],
+                   [[Methods[i], str(RMSValues[i]) + "+-" + str(RMSs[i]), str(PeakValues[i]) + "+-" + str(Peaks[i]), str(Entries[i]),
+                     str(FWHMValues[i]) + "+-" + str(FWHMs[i])] for i in range(0, len(trafiles))], Log=(log == 'yes'))
+    if Batch == True:
+        #Runs of the same data with different trainings (Pipeline.py --descriptions) must not overwrite each other
+        PlotName = "Results_{}_{}_{}keV".format(run, isotope if training == 'none' else isotope + "_" + training, energy)
+        rd.savePlot(PlotName + ".plot.npz", Plot)
+        rd.render(Plot, [PlotName + "." + extension for extension in args.format], args.backend)
+        Stats.output(PlotName + ".plot.npz")
+        for extension in args.format:
+            Stats.output(PlotName + "." + extension)
     else:
-        HistARMlist[0].GetYaxis().SetTitle("Counts")
-        HistARMlist[m].Draw("same")
-HistARMlist[0].SetTitle(title)
-HistARMlist[0].GetXaxis().SetTitle("ARM [deg]")
-HistARMlist[0].GetXaxis().CenterTitle()
-HistARMlist[0].GetYaxis().CenterTitle()
-HistARMlist[0].GetYaxis().SetTitleOffset(1.7)
-
-CanvasARM.cd()
-CanvasARM.SetGridx()
-CanvasARM.SetBottomMargin(0.5)
-
-#Create Legend [Method, RMS Value, Peak Height, Total Count, FWHM]
-print("Creating legend...")
-Header = M.TH1D("Legend Header placeholder", " ", 1, -180, 180)
-Header.SetLineColor(M.kWhite)
-legend = M.TLegend(0.15, 0.35, 0.85, 0.1)
-legend.SetTextSize(0.017)
-legend.SetNColumns(5)
-
-legend.AddEntry(Header, "Analysis Methods", "l")
-legend.AddEntry(Header, "RMS Value", "l")
-legend.AddEntry(Header, "Peak Height", "l")
-legend.AddEntry(Header, "Total Count", "l")
-legend.AddEntry(Header, "FWHM", "l")
-
-legend.AddEntry(HistARMlist[0], "Classic Method", "l")
-legend.AddEntry(HistARMlist[0], str(round(HistARMlist[0].GetRMS(), 2)) + "+-" + str(RMSs[0]), "l")
-legend.AddEntry(HistARMlist[0], str(h.getMaxHist(HistARMlist[0])) + "+-" + str(Peaks[0]), "l")
-legend.AddEntry(HistARMlist[0], str(HistARMlist[0].GetEntries()), "l") 
-legend.AddEntry(HistARMlist[0], str(h.getFWHM(HistARMlist[0])) + "+-"+ str(FWHMs[0]), "l")
-
-if len(HistARMlist) >= 2: 
-  legend.AddEntry(HistARMlist[1], "Bayes Method", "l")
-  legend.AddEntry(HistARMlist[1], str(round(HistARMlist[1].GetRMS(), 2)) + "+-" + str(RMSs[1]), "l")
-  legend.AddEntry(HistARMlist[1], str(h.getMaxHist(HistARMlist[1])) + "+-" + str(Peaks[1]), "l")
-  legend.AddEntry(HistARMlist[1], str(HistARMlist[1].GetEntries()), "l")
-  legend.AddEntry(HistARMlist[1], str(h.getFWHM(HistARMlist[1])) + "+-"+ str(FWHMs[1]), "l")
-
-if len(HistARMlist) >= 3: 
-  legend.AddEntry(HistARMlist[2], "MLP Method", "l")
-  legend.AddEntry(HistARMlist[2], str(round(HistARMlist[2].GetRMS(), 2)) + "+-" + str(RMSs[2]), "l")
-  legend.AddEntry(HistARMlist[2], str(h.getMaxHist(HistARMlist[2])) + "+-" + str(Peaks[2]), "l")
-  legend.AddEntry(HistARMlist[2], str(HistARMlist[2].GetEntries()), "l")
-  legend.AddEntry(HistARMlist[2], str(h.getFWHM(HistARMlist[2])) + "+-"+ str(FWHMs[2]), "l")
-
-if len(HistARMlist) >= 4: 
-  legend.AddEntry(HistARMlist[3], "RF Method", "l")
-  legend.AddEntry(HistARMlist[3], str(round(HistARMlist[3].GetRMS(), 2)) + "+-" + str(RMSs[3]), "l")
-  legend.AddEntry(HistARMlist[3], str(h.getMaxHist(HistARMlist[3])) + "+-" + str(Peaks[3]), "l")
-  legend.AddEntry(HistARMlist[3], str(HistARMlist[3].GetEntries()), "l")
-  legend.AddEntry(HistARMlist[3], str(h.getFWHM(HistARMlist[3])) + "+-"+ str(FWHMs[3]), "l")
-
-legend.Draw()
-
-CanvasARM.Update()
-
-#create txt file with comparable metrics
-methods = ["Classic Method", "Bayes Method", "MLP Method", "RF Method"]
-print("writing to a txt file...")
-#if not path.exists("log.FileName.txt"):
-metrics_file = open(training+".log.txt", "a+")
-
-#metrics_file.write("Length of FWHMS: " + str(len(FWHMs)) + "\n")
-#metrics_file.write("Length of HistARMlist: "+ str(len(HistARMlist))+ "\n")
-metrics_file.write(args.filename + ": ")
-for i in range(0, len(FWHMs)):
-    metrics_file.write(str(h.getFWHM(HistARMlist[i])) + "\t")
-#    metrics_file.write(str(FWHMs[i]) + "\t")
-for i in range(0, len(FWHMs)):
-    metrics_file.write(str(round(HistARMlist[i].GetRMS(), 2)) + "\t")
-#    metrics_file.write(str(RMSs[i]) + "\t")
-metrics_file.write("\n")
-metrics_file.close()
-#else:
-#    metrics_file = open("log.FileName.txt", "a+")
-#    metric_file.write("Energy Line: " + str(energy) + "\t")
-#    for i in range(0, len(FWHMs)):
-#        metrics_file.write(str(FWHMs[i]) + "\t")
-#    for i in range(0, len(FWHMs)):    
-#        metrics_file.write(str(RMSs[i]) + "\t")
-#    metrics_file.write("\n")
-#    metrics_file.close()
+        Canvases.append(rd.drawROOT(Plot, "CanvasARM" + str(l)))
+
+    Stats.stop("rendering")
+    Stats.start("output")
+
+    #comparable metrics of every method, written to the metrics store after the last line
+    for i in range(0, len(FWHMs)):
+        labels = {"run": run, "isotope": isotope, "line": float(energy), "description": training, "algorithm": ms.algorithmName(trafiles[i], i),
+                  "entries": int(Entries[i]), "tra": path.realpath(trafiles[i])}
+        MetricRows.append(dict(labels, metric="FWHM", value=float(FWHMValues[i]), error=FWHMs[i]))
+        MetricRows.append(dict(labels, metric="RMS", value=float(RMSValues[i]), error=RMSs[i]))
+        MetricRows.append(dict(labels, metric="Peak", value=float(PeakValues[i]), error=Peaks[i]))
+    Stats.result("{} keV".format(energy), {"FWHM": FWHMValues.tolist(), "RMS": RMSValues.tolist(),
+                                           "Peak": PeakValues.tolist(), "FWHMError": FWHMs, "RMSError": RMSs, "PeakError": Peaks})
+    Stats.stop("output")
+    if l < len(energies) - 1:
+        Stats.start("rendering")
+
+if args.metrics:
+    Stats.output(args.metrics)
+    ms.MetricsStore(args.metrics).record(Stats.record(), MetricRows)
+    print("INFO: Wrote " + str(len(MetricRows)) + " results to " + args.metrics)
+Stats.write(args.stats)
 
 # Prevent the canvases from being closed
 
@@ -250,6 +251,4 @@ if Batch == False:
     print("ATTENTION: Please exit by clicking: File -> Close ROOT! Do not just close the window by clicking \"x\"")
     print("           ... and if you didn't honor this warning, and are stuck, execute the following in a new terminal: kill " + str(os.getpid()))
     M.gApplication.Run()
-if Batch == True:
-    CanvasARM.SaveAs("Results_{}_{}_{}keV.pdf".format(run, isotope, energy))
     
@@ -0,0 +1,318 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Benchmarks of the ARM tooling on synthetic tra files. Every stage of an analysis job (reading plain and
+#compressed files, selection, ARM computation, histogram filling, FWHM, bootstrap and rendering) is timed
+#on its own, best of --repeat runs, with its throughput and the peak memory it needed. Reading and the
+#bootstrap are also run on 1 to --cores processes to see how they scale, as is the parallel reading of one
+#compressed file through its index (reading_indexed).
+#
+#The fixtures are toy events of a Cs137 source from ToyTra.py. They are written once per size and seed to
+#$COSI_BENCHMARK_FIXTURES (default ~/.cache/COSIPrograms/benchmark) and reused.
+#
+#The results are written as JSON. Given a baseline from an earlier run, every stage which became slower
+#than its threshold (by default 20%) is listed and the exit code is 1. A baseline or result file which
+#cannot be read is an error (exit code 2):
+#
+#Usage: python3 Benchmark.py run -n 1000000 -o Benchmark.json
+#       python3 Benchmark.py run -n 1000000 -o new.json --baseline Benchmark.json --threshold 0.2 --stage-threshold bootstrap=0.5
+#       python3 Benchmark.py compare Benchmark.json new.json
+#       python3 Benchmark.py fixture -n 100000 -o toy.tra.gz
+
+import argparse
+import multiprocessing as mp
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import Helper as h
+import TraReader as tr
+import Histograms as hs
+import EventCache as ec
+import GzipIndex as gi
+import ToyTra as tt
+
+DefaultDirectory = os.path.join(os.path.expanduser("~"), ".cache", "COSIPrograms", "benchmark")
+DefaultThreshold = 0.2
+
+#Bumped whenever the fixtures change, so old ones are written again
+FixtureVersion = 2
+
+#Source and line of the fixtures, like the Cs137 calibration runs
+Source = (26.1, 0.3, 64.0)
+Line = 661.657
+
+def fixtureDirectory():
+    return os.environ.get("COSI_BENCHMARK_FIXTURES", DefaultDirectory)
+
+################################################################################
+
+#Path of the fixture with Events events, written if it does not exist yet
+def fixture(Events, Seed=0, Compressed=False, Directory=None):
+    Directory = fixtureDirectory() if Directory is None else Directory
+    os.makedirs(Directory, exist_ok=True)
+    FileName = os.path.join(Directory, "toy.v{}.{}.{}.tra{}".format(FixtureVersion, Events, Seed, ".gz" if Compressed else ""))
+    if not os.path.exists(FileName):
+        print("INFO: Writing fixture " + FileName)
+        tt.generate(FileName, Events, Source, (Line,), Seed=Seed)
+    return FileName
+
+################################################################################
+
+#Peak resident memory of this process in MB. On Linux the peak is reset before every stage, elsewhere it
+#can only grow, so only the first stage which needs more memory than the ones before shows up.
+def resetPeak():
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peakRSS():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*scale/(1 << 20)
+
+def childrenRSS():
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss*scale/(1 << 20)
+
+#Runs Function() Repeat times and returns its last result with the shortest wall time, its CPU time and peak memory.
+#Stages faster than MinTime are run again within one measurement until MinTime has passed, and averaged.
+def measure(Function, Repeat, MinTime=0.1):
+    best = None
+    peak = 0.0
+    for i in range(Repeat):
+        resetPeak()
+        calls = 0
+        wall, cpu = time.perf_counter(), time.process_time()
+        while calls == 0 or time.perf_counter() - wall < MinTime:
+            result = Function()
+            calls += 1
+        wall, cpu = (time.perf_counter() - wall)/calls, (time.process_time() - cpu)/calls
+        peak = max(peak, peakRSS())
+        if best is None or wall < best[0]:
+            best = (wall, cpu)
+    return result, {"wall": round(best[0], 6), "cpu": round(best[1], 6), "peak_rss_mb": round(peak, 1)}
+
+def stageResult(Timing, Items, Unit):
+    return dict(Timing, items=int(Items), unit=Unit, rate=round(Items/Timing["wall"], 1) if Timing["wall"] > 0 else None)
+
+################################################################################
+
+def readAll(FileName):
+    return tr.concatBatches(list(tr.readTra(FileName)))
+
+def countEvents(FileName):
+    return sum(tr.batchSize(batch) for batch in tr.readTra(FileName))
+
+def selectEvents(Events):
+    Ei = Events["Ei"]
+    return (Events["type"] == tr.c_Compton) & (0.985*Line <= Ei) & (Ei <= 1.015*Line)
+
+#Histograms of 4 methods as in ARMoutput.py; events are given to the methods in turn
+def fillHistograms(ARM):
+    binned = hs.BinnedARM(np.arange(0, 5))
+    binned.fill(np.arange(len(ARM)) % 4, ARM)
+    return binned
+
+def drawPlot(Binned):
+    import Render as rd
+    plot = rd.Plot("Benchmark", ["Method " + str(i) for i in range(Binned.slices())], Binned.Counts, Binned.Sums, Binned.ARMLow, Binned.ARMHigh,
+                   ["Analysis Methods", "RMS Value", "FWHM"], [["Method " + str(i), str(rms), str(fwhm)] for i, (rms, fwhm) in
+                                                              enumerate(zip(Binned.getRMS(), Binned.getFWHM()))])
+    with tempfile.TemporaryDirectory() as directory:
+        rd.drawMatplotlib(plot, [os.path.join(directory, "Benchmark.png")])
+
+def coreCounts(Cores):
+    counts = [1]
+    while counts[-1]*2 < Cores:
+        counts.append(counts[-1]*2)
+    return counts + [Cores] if Cores > 1 else counts
+
+#Wall time of Function(Processes) for every number of processes up to Cores, with the speedup over one process
+def scaling(Function, Items, Unit, Cores, Repeat):
+    points = []
+    for processes in coreCounts(Cores):
+        timing = measure(lambda: Function(processes), Repeat)[1]
+        timing["peak_rss_mb"] = round(max(timing["peak_rss_mb"], childrenRSS()), 1)
+        points.append(dict(stageResult(timing, Items, Unit), processes=processes))
+    for point in points:
+        point["speedup"] = round(points[0]["wall"]/point["wall"], 2)
+        point["efficiency"] = round(point["speedup"]/point["processes"], 2)
+    return points
+
+def run(Events, Seed=0, Repeat=3, Cores=None, Replicates=1000, Stages=None, Directory=None):
+    Cores = Cores or mp.cpu_count()
+    wanted = lambda name: Stages is None or name in Stages
+    plain = fixture(Events, Seed, False, Directory)
+    compressed = fixture(Events, Seed, True, Directory)
+    stages = {}
+
+    events, timing = measure(lambda: readAll(plain), Repeat)
+    if wanted("reading"):
+        stages["reading"] = stageResult(timing, Events, "events")
+    if wanted("reading_gz"):
+        stages["reading_gz"] = stageResult(measure(lambda: readAll(compressed), Repeat)[1], Events, "events")
+
+    selected, timing = measure(lambda: selectEvents(events), Repeat)
+    if wanted("selection"):
+        stages["selection"] = stageResult(timing, Events, "events")
+    arm, timing = measure(lambda: h.getARM(events["C1"][selected], events["Dg"][selected], events["phi"][selected], Source), Repeat)
+    if wanted("arm"):
+        stages["arm"] = stageResult(timing, len(arm), "events")
+    binned, timing = measure(lambda: fillHistograms(arm), Repeat)
+    if wanted("filling"):
+        stages["filling"] = stageResult(timing, len(arm), "events")
+
+    #FWHM and RMS of as many histograms as a job on the RFTests sweep has
+    many = hs.BinnedARM(np.arange(0, 101))
+    many.Counts = np.tile(binned.Counts, (25, 1))
+    many.Sums = np.tile(binned.Sums, (25, 1))
+    if wanted("fwhm"):
+        stages["fwhm"] = stageResult(measure(lambda: (many.getPeakFWHM(), many.getRMS()), Repeat)[1], many.slices(), "histograms")
+
+    bins = [(binned.Counts[i], binned.ARMLow, binned.ARMHigh) for i in range(binned.slices())]
+    if wanted("bootstrap"):
+        stages["bootstrap"] = stageResult(measure(lambda: h.bootstrapAll(bins, Replicates, processes=1), Repeat)[1],
+                                          len(bins)*Replicates, "replicates")
+    if wanted("rendering"):
+        try:
+            import matplotlib
+            stages["rendering"] = stageResult(measure(lambda: drawPlot(binned), Repeat)[1], 1, "plots")
+        except ImportError:
+            print("INFO: matplotlib is not installed, not timing the rendering")
+
+    #One file per process as in the per-run jobs of the pipeline, and the bootstrap of 4 histograms per process
+    scaled = {}
+    files = [compressed]*max(Cores, 2)
+    def readFiles(Processes):
+        if Processes == 1:
+            return list(map(countEvents, files))
+        with mp.Pool(Processes) as pool:
+            return pool.map(countEvents, files, chunksize=1)
+    if wanted("reading_gz"):
+        scaled["reading_gz"] = scaling(readFiles, Events*len(files), "events", Cores, Repeat)
+    #One compressed file on all processes, through checkpoints every 4 MB of text
+    if wanted("reading_indexed"):
+        if gi.load(compressed) is None:
+            gi.save(compressed, gi.build(compressed, 1 << 22))
+        scaled["reading_indexed"] = scaling(lambda Processes: sum(tr.batchSize(batch) for batch in gi.readTra(compressed, Processes=Processes)),
+                                            Events, "events", Cores, Repeat)
+    if wanted("bootstrap"):
+        scaled["bootstrap"] = scaling(lambda Processes: h.bootstrapAll(bins*max(Cores, 2), Replicates, processes=Processes),
+                                      len(bins)*max(Cores, 2)*Replicates, "replicates", Cores, Repeat)
+
+    return {"host": socket.gethostname(), "started": time.time(), "platform": platform.platform(), "python": platform.python_version(),
+            "numpy": np.__version__, "cpus": mp.cpu_count(), "commit": gitCommit(),
+            "settings": {"events": Events, "seed": Seed, "repeat": Repeat, "cores": Cores, "replicates": Replicates, "fixture": FixtureVersion},
+            "stages": stages, "scaling": scaled}
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+################################################################################
+
+#Stages (and scaling points) of Current whose rate dropped by more than their threshold against Baseline.
+#Rates are compared rather than times, so runs on fixtures of other sizes can be compared as well.
+def regressions(Baseline, Current, Threshold=DefaultThreshold, StageThresholds={}):
+    found = []
+    def check(name, old, new):
+        limit = StageThresholds.get(name.split("@")[0], Threshold)
+        if old.get("rate") and new.get("rate") and old["rate"]/new["rate"] - 1 > limit:
+            found.append({"stage": name, "baseline": old["rate"], "current": new["rate"], "unit": new["unit"],
+                          "slowdown": round(old["rate"]/new["rate"] - 1, 3), "threshold": limit})
+    for name, stage in Current["stages"].items():
+        if name in Baseline.get("stages", {}):
+            check(name, Baseline["stages"][name], stage)
+    for name, points in Current.get("scaling", {}).items():
+        old = {point["processes"]: point for point in Baseline.get("scaling", {}).get(name, [])}
+        for point in points:
+            if point["processes"] in old:
+                check("{}@{}".format(name, point["processes"]), old[point["processes"]], point)
+    return found
+
+def printResults(Results):
+    print("{:<12} {:>10} {:>10} {:>14} {:>12} {:>10}".format("Stage", "Wall [s]", "CPU [s]", "Rate", "Unit/s", "Peak [MB]"))
+    for name, stage in Results["stages"].items():
+        print("{:<12} {:>10.4f} {:>10.4f} {:>14.1f} {:>12} {:>10.1f}".format(name, stage["wall"], stage["cpu"], stage["rate"], stage["unit"], stage["peak_rss_mb"]))
+    for name, points in Results.get("scaling", {}).items():
+        print("Scaling of " + name + ": " + ", ".join("{} x{:.2f} ({:.0f}%)".format(point["processes"], point["speedup"], 100*point["efficiency"])
+                                                      for point in points))
+
+def printRegressions(Found):
+    for r in Found:
+        print("ERROR: {} slowed down by {:.0f}% ({:.1f} -> {:.1f} {}/s, threshold {:.0f}%)".format(r["stage"], 100*r["slowdown"], r["baseline"], r["current"],
+                                                                                                  r["unit"], 100*r["threshold"]))
+    if not Found:
+        print("INFO: No stage slowed down by more than its threshold")
+
+def parseThresholds(Values):
+    thresholds = {}
+    for value in Values:
+        name, _, limit = value.partition("=")
+        thresholds[name] = float(limit)
+    return thresholds
+
+#Results of an earlier run; a file which cannot be read must not pass as "no regressions"
+def loadResults(FileName):
+    Results = ec.readJSON(FileName, None)
+    if not isinstance(Results, dict) or "settings" not in Results:
+        print("ERROR: Cannot read the benchmark results " + FileName)
+        sys.exit(2)
+    return Results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the ARM analysis on synthetic tra files.')
+    parser.add_argument('command', choices=['run', 'compare', 'fixture'], help='run the benchmark, compare two results, or write a fixture')
+    parser.add_argument('results', nargs='*', help='compare: baseline and current results')
+    parser.add_argument('-n', '--events', type=int, default=1000000, help='Number of events of the fixtures')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Seed of the fixtures')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Runs of every stage; the fastest one counts')
+    parser.add_argument('-c', '--cores', type=int, default=0, help='Largest number of processes for the scaling runs (default: all cores)')
+    parser.add_argument('-R', '--replicates', type=int, default=1000, help='Bootstrap replicates per histogram')
+    parser.add_argument('--stages', type=str, nargs='+', default=None, help='Only these stages: reading reading_gz reading_indexed selection arm filling fwhm bootstrap rendering')
+    parser.add_argument('-o', '--output', type=str, default='', help='run: JSON file for the results; fixture: the tra file to write')
+    parser.add_argument('-b', '--baseline', type=str, default='', help='run: results of an earlier run to compare with')
+    parser.add_argument('-t', '--threshold', type=float, default=DefaultThreshold, help='Allowed slowdown of a stage, as a fraction')
+    parser.add_argument('--stage-threshold', type=str, nargs='+', default=[], help='Allowed slowdown of single stages, e.g. bootstrap=0.5')
+    args = parser.parse_args()
+
+    if args.command == 'fixture':
+        tt.generate(args.output or "toy.tra.gz", args.events, Source, (Line,), Seed=args.seed)
+        sys.exit(0)
+
+    if args.command == 'compare':
+        if len(args.results) != 2:
+            parser.error("compare needs the baseline and the current results")
+        Baseline, Current = loadResults(args.results[0]), loadResults(args.results[1])
+    else:
+        Baseline = loadResults(args.baseline) if args.baseline else None
+        Current = run(args.events, args.seed, args.repeat, args.cores or None, args.replicates, args.stages)
+        printResults(Current)
+        if args.output:
+            ec.writeJSON(args.output, Current)
+            print("INFO: Wrote " + args.output)
+
+    if Baseline is not None:
+        if Baseline.get("settings", {}).get("events") != Current["settings"]["events"]:
+            print("WARNING: The fixtures have {} events, the baseline had {}".format(Current["settings"]["events"], Baseline.get("settings", {}).get("events")))
+        Found = regressions(Baseline, Current, args.threshold, parseThresholds(args.stage_threshold))
+        printRegressions(Found)
+        sys.exit(1 if Found else 0)
@@ -0,0 +1,181 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Macroscopic cross sections from the ResponseMatrixO1 files in crossections/ (Xsection.<Process>.<Material>.rsp,
+#energy in keV, cross section in 1/cm). The text files are parsed once into a packed array of log energies and
+#log cross sections with an index of (process, material) -> rows, which is memory-mapped on later runs so only
+#the materials that are looked up are read from disk. mu() interpolates log-log for whole arrays of energies
+#and materials at once.
+#
+#Usage: python3 CrossSections.py list
+#       python3 CrossSections.py mu Compton Germanium 356 662 1173
+
+import argparse
+import glob
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+import numpy as np
+import EventCache as ec
+
+DefaultDirectory = os.path.join(os.path.dirname(os.path.abspath(__file__)), "crossections")
+PackDirectory = os.path.join(os.path.expanduser("~"), ".cache", "COSIPrograms", "crosssections")
+
+#Bumped whenever the packed layout changes
+PackVersion = 1
+
+FileNamePattern = re.compile(r"^Xsection\.([^.]+)\.(.+)\.rsp$")
+DataPoint = re.compile(rb"^R1[ \t]+(\S+)[ \t]+(\S+)", re.M)
+
+################################################################################
+
+#(process, material) -> path of all rsp files in Directory
+def tableFiles(Directory):
+    tables = {}
+    for FileName in sorted(glob.glob(os.path.join(Directory, "Xsection.*.rsp"))):
+        match = FileNamePattern.match(os.path.basename(FileName))
+        if match:
+            tables[match.groups()] = FileName
+    return tables
+
+def readTable(FileName):
+    with open(FileName, "rb") as f:
+        points = np.array(DataPoint.findall(f.read()), dtype=np.float64)
+    if len(points) == 0 or np.any(np.diff(points[:, 0]) <= 0):
+        raise ValueError(FileName + " is not a ResponseMatrixO1 table with increasing energies")
+    return points[:, 0], points[:, 1]
+
+#Packs all tables of Directory into Pack: energy.npy and mu.npy hold log values of all tables back to back,
+#index.json the first row and number of rows of every table
+def pack(Directory, Pack):
+    tables = tableFiles(Directory)
+    energies, values, index = [], [], {}
+    start = 0
+    for (process, material), FileName in tables.items():
+        energy, mu = readTable(FileName)
+        with np.errstate(divide="ignore"):
+            energies.append(np.log(energy))
+            values.append(np.log(mu))
+        index.setdefault(process, {})[material] = [start, len(energy)]
+        start += len(energy)
+
+    os.makedirs(os.path.dirname(Pack), exist_ok=True)
+    temporary = tempfile.mkdtemp(dir=os.path.dirname(Pack), prefix=".incomplete.")
+    np.save(os.path.join(temporary, "energy.npy"), np.concatenate(energies) if energies else np.zeros(0))
+    np.save(os.path.join(temporary, "mu.npy"), np.concatenate(values) if values else np.zeros(0))
+    ec.writeJSON(os.path.join(temporary, "index.json"), {"source": Directory, "tables": index})
+    try:
+        os.rename(temporary, Pack)
+    except OSError:
+        #Another process packed the same tables first
+        shutil.rmtree(temporary, ignore_errors=True)
+
+#Name of the pack of Directory, which changes whenever one of its rsp files does
+def packName(Directory):
+    digest = hashlib.sha256()
+    for FileName in sorted(glob.glob(os.path.join(Directory, "Xsection.*.rsp"))):
+        info = os.stat(FileName)
+        digest.update("{}:{}:{};".format(os.path.basename(FileName), info.st_size, info.st_mtime_ns).encode())
+    return "{}.v{}".format(digest.hexdigest()[:32], PackVersion)
+
+################################################################################
+
+class CrossSections:
+    def __init__(self, Directory=DefaultDirectory):
+        self.Directory = os.path.realpath(Directory)
+        self.Pack = os.path.join(PackDirectory, packName(self.Directory))
+        if not os.path.exists(os.path.join(self.Pack, "index.json")):
+            pack(self.Directory, self.Pack)
+        self.Index = ec.readJSON(os.path.join(self.Pack, "index.json"), None)["tables"]
+        self.LogEnergy = np.load(os.path.join(self.Pack, "energy.npy"), mmap_mode="r")
+        self.LogMu = np.load(os.path.join(self.Pack, "mu.npy"), mmap_mode="r")
+        #Tables copied out of the memory map on first use
+        self.Loaded = {}
+        self.Combined = {}
+
+    def processes(self):
+        return sorted(self.Index)
+
+    def materials(self, Process="Total"):
+        return sorted(self.Index[Process])
+
+    def table(self, Process, Material):
+        key = (Process, Material)
+        if key not in self.Loaded:
+            if Process not in self.Index or Material not in self.Index[Process]:
+                raise KeyError("No {} cross section for {} in {}".format(Process, Material, self.Directory))
+            start, count = self.Index[Process][Material]
+            self.Loaded[key] = (np.array(self.LogEnergy[start:start+count]), np.array(self.LogMu[start:start+count]))
+        return self.Loaded[key]
+
+    #All tables of Process in one flat array of keys log(E) + m*Span, so energies of different materials
+    #are looked up with one searchsorted
+    def combined(self, Process):
+        if Process not in self.Combined:
+            tables = [self.table(Process, name) for name in self.materials(Process)]
+            span = max(x[-1] for x, y in tables) - min(x[0] for x, y in tables) + 1
+            counts = np.array([len(x) for x, y in tables])
+            start = np.concatenate(([0], np.cumsum(counts)[:-1]))
+            keys = np.concatenate([x + m*span for m, (x, y) in enumerate(tables)])
+            x = np.concatenate([x for x, y in tables])
+            y = np.concatenate([y for x, y in tables])
+            self.Combined[Process] = (span, start, start + counts, keys, x, y)
+        return self.Combined[Process]
+
+    #Indices of material names in materials(Process), for callers looking up the same materials many times
+    def materialIndex(self, Process, Names):
+        lookup = {name: m for m, name in enumerate(self.materials(Process))}
+        names, which = np.unique(np.asarray(Names), return_inverse=True)
+        missing = [str(name) for name in names if str(name) not in lookup]
+        if missing:
+            raise KeyError("No {} cross section for {} in {}".format(Process, ", ".join(missing), self.Directory))
+        return np.array([lookup[str(name)] for name in names], dtype=np.int64)[which].reshape(np.shape(Names))
+
+    #Macroscopic cross section [1/cm] of Process for every pair of Materials and Energies [keV].
+    #Materials is one name, or an array of names or of indices from materialIndex. Energies outside
+    #the table give NaN.
+    def mu(self, Process, Materials, Energies):
+        Energies = np.asarray(Energies, dtype=np.float64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            log_energy = np.log(Energies)
+        if np.ndim(Materials) == 0 and isinstance(Materials, str):
+            x, y = self.table(Process, Materials)
+            first, last, keys, shift = 0, len(x), x, 0
+        else:
+            Materials = np.asarray(Materials)
+            if Materials.dtype.kind not in "iu":
+                Materials = self.materialIndex(Process, Materials)
+            span, start, end, keys, x, y = self.combined(Process)
+            first, last, shift = start[Materials], end[Materials], Materials*span
+
+        i = np.clip(np.searchsorted(keys, log_energy + shift, side="right") - 1, first, last - 2)
+        with np.errstate(invalid="ignore"):
+            t = (log_energy - x[i])/(x[i+1] - x[i])
+            values = np.exp(y[i] + t*(y[i+1] - y[i]))
+        return np.where((log_energy >= x[first]) & (log_energy <= x[last - 1]), values, np.nan)
+
+    #Probability to interact within Length [cm] of Material for photons of the given energies
+    def interactionProbability(self, Materials, Energies, Length, Process="Total"):
+        return -np.expm1(-self.mu(Process, Materials, Energies)*np.asarray(Length))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Look up macroscopic cross sections from the crossections directory.')
+    parser.add_argument('command', choices=['list', 'mu'], help='list processes and materials, or print cross sections')
+    parser.add_argument('values', nargs='*', help='For mu: process, material and energies in keV')
+    parser.add_argument('-d', '--directory', type=str, default=DefaultDirectory, help='Directory with the Xsection.*.rsp files')
+    args = parser.parse_args()
+
+    Tables = CrossSections(args.directory)
+    if args.command == 'list':
+        for process in Tables.processes():
+            print(process + ": " + " ".join(Tables.materials(process)))
+    else:
+        if len(args.values) < 3:
+            print("ERROR: mu needs a process, a material and at least one energy")
+            quit()
+        energies = np.array(args.values[2:], dtype=np.float64)
+        for energy, mu in zip(energies, Tables.mu(args.values[0], args.values[1], energies)):
+            print("{} keV: {:.6e} 1/cm".format(energy, mu))
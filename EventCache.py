@@ -0,0 +1,326 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Local cache of parsed tra files. Each file is converted once into one raw binary file per
+#TraReader column, stored under the hash of the tra file content and the reader version, and later
+#runs memory-map those columns instead of decompressing and parsing the file again.
+#
+#Only the events asked for are converted: a job reading the first MaxEvents events converts those and the
+#entry records that it is partial. A later job asking for more converts the file again up to its own
+#MaxEvents (or to the end) and replaces the entry, so a file read in growing steps is parsed more than once.
+#
+#An entry can also hold an energy index: the rows of its events sorted by event type and then by total
+#energy, with the first and last row of every type. An energy window is then two binary searches in the
+#sorted energies of one type plus a gather of only the matching rows, instead of a scan of all events.
+#The index is built the first time a window is read through it (readWindows), or ahead with "index".
+#
+#The cache lives in $COSI_EVENT_CACHE (default ~/.cache/COSIPrograms/events); setting it to an empty
+#string turns caching off. Once it is larger than $COSI_EVENT_CACHE_SIZE (default 20G) the least
+#recently used entries are removed.
+#
+#Usage: python3 EventCache.py list
+#       python3 EventCache.py prune --size 5G
+#       python3 EventCache.py clear
+#       python3 EventCache.py index Run043.RF.tra.gz Run043.BDTD.tra.gz
+
+import argparse
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import TraReader as tr
+import StagedReader as sr
+from contextlib import contextmanager
+
+DefaultDirectory = os.path.join(os.path.expanduser("~"), ".cache", "COSIPrograms", "events")
+DefaultSize = "20G"
+
+#Number of remembered content hashes; the oldest are dropped first
+MaxHashes = 10000
+
+################################################################################
+
+def cacheDirectory():
+    return os.environ.get("COSI_EVENT_CACHE", DefaultDirectory)
+
+def parseSize(Size):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+    Size = str(Size).strip().upper()
+    if Size and Size[-1] in units:
+        return int(float(Size[:-1])*units[Size[-1]])
+    return int(Size)
+
+def cacheLimit():
+    return parseSize(os.environ.get("COSI_EVENT_CACHE_SIZE", DefaultSize))
+
+#Hashes of all tools (the event and result caches, Pipeline.py) are remembered in one place, the event
+#cache directory, also when caching events is turned off
+def hashDirectory():
+    return cacheDirectory() or DefaultDirectory
+
+#Content hash of a file. Hashes are remembered by (path, size, mtime) in hashes.json so unchanged
+#files are only read once.
+def contentHash(FileName):
+    info = os.stat(FileName)
+    stamp = "{}:{}:{}".format(os.path.realpath(FileName), info.st_size, info.st_mtime_ns)
+    memo_file = os.path.join(hashDirectory(), "hashes.json")
+    memo = readJSON(memo_file, {})
+    if stamp in memo:
+        return memo[stamp]
+
+    digest = hashlib.sha256()
+    with open(FileName, "rb") as f:
+        for block in iter(lambda: f.read(1 << 23), b""):
+            digest.update(block)
+    #Other processes add their hashes meanwhile, so the memo is read again under the lock. Hashes of
+    #earlier versions of the same file are dropped.
+    with fileLock(memo_file + ".lock"):
+        path = stamp.rsplit(":", 2)[0]
+        memo = {key: value for key, value in readJSON(memo_file, {}).items() if key.rsplit(":", 2)[0] != path}
+        memo[stamp] = digest.hexdigest()
+        writeJSON(memo_file, dict(list(memo.items())[-MaxHashes:]))
+    return memo[stamp]
+
+#Exclusive lock between processes, held on FileName
+@contextmanager
+def fileLock(FileName):
+    os.makedirs(os.path.dirname(os.path.abspath(FileName)), exist_ok=True)
+    with open(FileName, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def readJSON(FileName, Default):
+    try:
+        with open(FileName, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return Default
+
+def writeJSON(FileName, Content):
+    parent = os.path.dirname(os.path.abspath(FileName))
+    os.makedirs(parent, exist_ok=True)
+    handle, temporary = tempfile.mkstemp(dir=parent, suffix=".tmp")
+    with os.fdopen(handle, "w") as f:
+        json.dump(Content, f, indent=1)
+    os.replace(temporary, FileName)
+
+def entryName(FileName):
+    return "{}.v{}".format(contentHash(FileName)[:32], tr.ReaderVersion)
+
+################################################################################
+
+#Parses the first MaxEvents events (all if None) of a tra file into a new cache entry, one column at a time on
+#disk so memory stays bounded. The file is read in stages on Processes processes (StagedReader.py, default:
+#all cores), whose times go to Stats.
+def convert(FileName, Entry, Stats=None, Processes=None, MaxEvents=None):
+    parent = os.path.dirname(Entry)
+    os.makedirs(parent, exist_ok=True)
+    temporary = tempfile.mkdtemp(dir=parent, prefix=".incomplete.")
+    files = {name: open(os.path.join(temporary, name + ".bin"), "wb") for name in tr.Columns}
+    columns = {name: (column.dtype.str, column.shape[1:]) for name, column in tr.emptyBatch().items()}
+    events = 0
+    try:
+        for batch in sr.readTra(FileName, MaxEvents=MaxEvents, Processes=Processes, Stats=Stats):
+            for name in tr.Columns:
+                files[name].write(np.ascontiguousarray(batch[name]).tobytes())
+            events += tr.batchSize(batch)
+    finally:
+        for f in files.values():
+            f.close()
+
+    #Fewer events than asked for means the file ended
+    meta = {"source": os.path.realpath(FileName), "events": events, "complete": MaxEvents is None or events < MaxEvents, "created": time.time(),
+            "columns": {name: [dtype, list(shape)] for name, (dtype, shape) in columns.items()}}
+    writeJSON(os.path.join(temporary, "meta.json"), meta)
+    try:
+        os.rename(temporary, Entry)
+    except OSError:
+        #Either another process finished the same file first, or the entry holds fewer events and is replaced;
+        #readers which mapped the old one keep its files until they are done
+        if mapEntry(Entry, MaxEvents) is None:
+            outdated = tempfile.mkdtemp(dir=parent, prefix=".outdated.")
+            try:
+                os.rename(Entry, os.path.join(outdated, "entry"))
+                os.rename(temporary, Entry)
+            except OSError:
+                pass
+            shutil.rmtree(outdated, ignore_errors=True)
+        shutil.rmtree(temporary, ignore_errors=True)
+
+#Memory-mapped columns of a cache entry, or None if it does not exist or holds fewer than the first MaxEvents
+#events of the file (all events if None)
+def mapEntry(Entry, MaxEvents=None):
+    meta = readJSON(os.path.join(Entry, "meta.json"), None)
+    if meta is None:
+        return None
+    if not meta.get("complete", True) and (MaxEvents is None or meta["events"] < MaxEvents):
+        return None
+    os.utime(Entry)
+    events = meta["events"]
+    batch = {}
+    for name, (dtype, shape) in meta["columns"].items():
+        if events == 0:
+            batch[name] = np.zeros((0,) + tuple(shape), dtype=dtype)
+        else:
+            batch[name] = np.memmap(os.path.join(Entry, name + ".bin"), dtype=dtype, mode="r", shape=(events,) + tuple(shape))
+    return batch
+
+#At least the first MaxEvents events (all if None) of a tra file as memory-mapped columns, converting the
+#file on first use
+def loadEvents(FileName, Stats=None, Processes=None, MaxEvents=None):
+    Directory = cacheDirectory()
+    entry = os.path.join(Directory, entryName(FileName))
+    events = mapEntry(entry, MaxEvents)
+    if events is None:
+        convert(FileName, entry, Stats, Processes, MaxEvents)
+        prune(cacheLimit(), Directory, Keep=entry)
+        events = mapEntry(entry, MaxEvents)
+    return events
+
+#Drop-in replacement for TraReader.readTra which goes through the cache when it is enabled. Without the cache
+#the file is read in stages which overlap with whatever the caller does with the batches.
+def readEvents(FileName, BatchSize=100000, MaxEvents=None, Skip=0, Stats=None, Processes=None):
+    if not cacheDirectory():
+        yield from sr.readTra(FileName, BatchSize, MaxEvents=MaxEvents, Skip=Skip, Processes=Processes, Stats=Stats)
+        return
+    events = loadEvents(FileName, Stats, Processes, MaxEvents)
+    total = tr.batchSize(events) if MaxEvents is None else min(MaxEvents, tr.batchSize(events))
+    for start in range(Skip, total, BatchSize):
+        yield tr.sliceBatch(events, start, min(start + BatchSize, total))
+
+################################################################################
+
+#Bumped whenever the layout of the energy index changes
+IndexVersion = 1
+
+#Sorts the events of a cache entry by type and total energy: order.bin holds the rows in that order and Ei.bin
+#their energies (NaN last within each type); index.json, written last, the rows of order.bin of every type
+def buildIndex(Entry, Events):
+    order = np.lexsort((Events["Ei"], Events["type"]))
+    types = np.asarray(Events["type"])[order]
+    ranges = {}
+    for code in np.unique(types):
+        ranges[str(int(code))] = [int(np.searchsorted(types, code, side="left")), int(np.searchsorted(types, code, side="right"))]
+    for name, column in (("order", order.astype(np.int64)), ("Ei", np.asarray(Events["Ei"], dtype=np.float64)[order])):
+        handle, temporary = tempfile.mkstemp(dir=Entry, suffix=".tmp")
+        with os.fdopen(handle, "wb") as f:
+            f.write(column.tobytes())
+        os.replace(temporary, os.path.join(Entry, "index." + name + ".bin"))
+    writeJSON(os.path.join(Entry, "index.json"), {"version": IndexVersion, "events": tr.batchSize(Events), "types": ranges})
+
+#Memory-mapped energy index of a cache entry, built if it does not exist yet
+def loadIndex(Entry, Events):
+    index = readJSON(os.path.join(Entry, "index.json"), None)
+    if index is None or index.get("version") != IndexVersion:
+        buildIndex(Entry, Events)
+        index = readJSON(os.path.join(Entry, "index.json"), None)
+    events = index["events"]
+    for name, dtype in (("order", np.int64), ("Ei", np.float64)):
+        index[name] = np.memmap(os.path.join(Entry, "index." + name + ".bin"), dtype=dtype, mode="r", shape=(events,)) if events else np.zeros(0, dtype=dtype)
+    return index
+
+#Rows of the events of type Type with low <= Ei <= high for any (low, high) of Windows, among the first
+#MaxEvents events, in the order of the file
+def windowRows(Index, Windows, Type=tr.c_Compton, MaxEvents=None):
+    first, last = Index["types"].get(str(int(Type)), [0, 0])
+    energies = Index["Ei"][first:last]
+    #Overlapping windows are merged so every row is found once
+    merged = []
+    for low, high in sorted(Windows):
+        if merged and low <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], high)
+        else:
+            merged.append([low, high])
+    found = [np.zeros(0, dtype=np.int64)]
+    for low, high in merged:
+        start = first + np.searchsorted(energies, low, side="left")
+        end = first + np.searchsorted(energies, high, side="right")
+        found.append(np.asarray(Index["order"][start:end]))
+    rows = np.sort(np.concatenate(found))
+    if MaxEvents is not None:
+        rows = rows[:np.searchsorted(rows, MaxEvents)]
+    return rows
+
+#The events of type Type in any of the energy Windows [(low, high) in keV], among the first MaxEvents events
+#of FileName, as batches of at most BatchSize events in the order of the file. Only the matching rows are read
+#from the cache entry. Without the cache all events are read and selected.
+def readWindows(FileName, Windows, Type=tr.c_Compton, BatchSize=100000, MaxEvents=None, Stats=None, Processes=None):
+    if not cacheDirectory():
+        for batch in sr.readTra(FileName, BatchSize, MaxEvents=MaxEvents, Processes=Processes, Stats=Stats):
+            keep = batch["type"] == Type
+            keep &= np.logical_or.reduce([(low <= batch["Ei"]) & (batch["Ei"] <= high) for low, high in Windows])
+            yield {name: column[keep] for name, column in batch.items()}
+        return
+    events = loadEvents(FileName, Stats, Processes, MaxEvents)
+    entry = os.path.join(cacheDirectory(), entryName(FileName))
+    rows = windowRows(loadIndex(entry, events), Windows, Type, MaxEvents)
+    for start in range(0, len(rows), BatchSize):
+        selected = rows[start:start + BatchSize]
+        yield {name: np.asarray(column[selected]) for name, column in events.items()}
+
+################################################################################
+
+def entries(Directory=None):
+    Directory = Directory or cacheDirectory()
+    found = []
+    if not os.path.isdir(Directory):
+        return found
+    for name in os.listdir(Directory):
+        path = os.path.join(Directory, name)
+        if name.startswith(".") or not os.path.isdir(path):
+            continue
+        size = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+        meta = readJSON(os.path.join(path, "meta.json"), {})
+        found.append({"entry": name, "path": path, "bytes": size, "used": os.path.getmtime(path),
+                      "events": meta.get("events"), "complete": meta.get("complete", True), "source": meta.get("source")})
+    return sorted(found, key=lambda e: e["used"], reverse=True)
+
+#Removes least recently used entries until the cache is at most MaxBytes large
+def prune(MaxBytes, Directory=None, Keep=None):
+    removed = []
+    cached = entries(Directory)
+    total = sum(e["bytes"] for e in cached)
+    for e in reversed(cached):
+        if total <= MaxBytes:
+            break
+        if e["path"] == Keep:
+            continue
+        shutil.rmtree(e["path"], ignore_errors=True)
+        total -= e["bytes"]
+        removed.append(e)
+    return removed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect and prune the local cache of parsed tra files.')
+    parser.add_argument('command', choices=['list', 'prune', 'clear', 'index'], help='list entries, prune to a size, remove everything, or build the energy index of tra files')
+    parser.add_argument('files', nargs='*', help='For index: tra files')
+    parser.add_argument('-s', '--size', type=str, default=None, help='Size to prune to, e.g. 500M or 5G (default: $COSI_EVENT_CACHE_SIZE)')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        cached = entries()
+        for e in cached:
+            print("{}  {:>10.1f} MB  {:>10} events{}  {}  {}".format(e["entry"], e["bytes"]/(1 << 20), e["events"], "" if e["complete"] else " (first)",
+                  time.strftime("%Y-%m-%d %H:%M", time.localtime(e["used"])), e["source"]))
+        print("{} entries, {:.1f} MB in {}".format(len(cached), sum(e["bytes"] for e in cached)/(1 << 20), cacheDirectory()))
+    elif args.command == 'index':
+        if not cacheDirectory():
+            print("ERROR: The event cache is turned off, there is nowhere to keep the index")
+            quit()
+        for FileName in args.files:
+            Entry = os.path.join(cacheDirectory(), entryName(FileName))
+            Index = loadIndex(Entry, loadEvents(FileName))
+            print("Indexed {} events of {} ({})".format(Index["events"], FileName, ", ".join("{}: {}".format(code, end - start)
+                                                                                             for code, (start, end) in Index["types"].items())))
+    else:
+        limit = 0 if args.command == 'clear' else parseSize(args.size) if args.size else cacheLimit()
+        for e in prune(limit):
+            print("Removed " + e["entry"] + " (" + str(e["source"]) + ")")
@@ -0,0 +1,382 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Seekable index of .tra.gz files, so one large file can be parsed on many cores and single events can be
+#read without decompressing everything before them. A gzip file can only be decompressed from its start;
+#the index holds checkpoints of the decompressor (as zran.c of the zlib examples) about every --spacing MB
+#of text: the position in the compressed file down to the bit where a deflate block starts, and the last
+#32 KB of text, which is all deflate refers back to. Every checkpoint also knows the first tra event after
+#it and how many events come before that, so the events between two checkpoints are parsed on their own.
+#
+#The index is built in one pass over the file and saved next to it as <file>.zidx, or in $COSI_GZIP_INDEX
+#if that is set. It holds the size and time of the file and is not used any more once the file changed.
+#zlib is called through ctypes since the zlib module of Python cannot stop at the end of a deflate block.
+#
+#Usage: python3 GzipIndex.py build Run043.RF.tra.gz Run043.BDTD.tra.gz
+#       python3 GzipIndex.py info Run043.RF.tra.gz
+#       python3 GzipIndex.py event Run043.RF.tra.gz 123456 --count 2
+#       python3 GzipIndex.py read Run043.RF.tra.gz -j 16
+
+import argparse
+import collections
+import ctypes
+import ctypes.util
+import hashlib
+import io
+import json
+import multiprocessing as mp
+import os
+import re
+import tempfile
+import time
+import numpy as np
+import Helper as h
+import TraReader as tr
+
+#Bumped whenever the layout of the index changes
+IndexVersion = 1
+
+#History deflate can refer back to
+Window = 32768
+
+Z_OK, Z_STREAM_END, Z_BUF_ERROR = 0, 1, -5
+Z_NO_FLUSH, Z_BLOCK = 0, 5
+#Window bits of raw deflate data, and of gzip (or zlib) data with its header
+RawBits, GzipBits = -15, 47
+
+#Start of a tra event. Unlike TraReader.EventStart the character after SE is part of the match, so a match
+#never lies within the 3 bytes carried over from one piece of text to the next
+EventLine = re.compile(rb"\nSE[^A-Za-z0-9_]")
+
+################################################################################
+
+class ZStream(ctypes.Structure):
+    _fields_ = [("next_in", ctypes.c_void_p), ("avail_in", ctypes.c_uint), ("total_in", ctypes.c_ulong),
+                ("next_out", ctypes.c_void_p), ("avail_out", ctypes.c_uint), ("total_out", ctypes.c_ulong),
+                ("msg", ctypes.c_char_p), ("state", ctypes.c_void_p),
+                ("zalloc", ctypes.c_void_p), ("zfree", ctypes.c_void_p), ("opaque", ctypes.c_void_p),
+                ("data_type", ctypes.c_int), ("adler", ctypes.c_ulong), ("reserved", ctypes.c_ulong)]
+
+Library = {}
+
+def zlib():
+    if "z" not in Library:
+        try:
+            z = ctypes.CDLL(ctypes.util.find_library("z") or "libz.so.1")
+        except OSError:
+            raise IOError("Unable to load zlib (libz), which is needed for gzip indexes")
+        stream = ctypes.POINTER(ZStream)
+        z.zlibVersion.restype = ctypes.c_char_p
+        z.inflateInit2_.argtypes = [stream, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        z.inflate.argtypes = [stream, ctypes.c_int]
+        z.inflateEnd.argtypes = [stream]
+        z.inflateReset2.argtypes = [stream, ctypes.c_int]
+        z.inflatePrime.argtypes = [stream, ctypes.c_int, ctypes.c_int]
+        z.inflateSetDictionary.argtypes = [stream, ctypes.c_void_p, ctypes.c_uint]
+        Library["z"] = z
+    return Library["z"]
+
+#Decompressor reading from bytes given with feed, which are kept referenced as long as zlib reads them
+class Inflater:
+    def __init__(self, Bits):
+        self.z = zlib()
+        self.stream = ZStream()
+        self.pointer = ctypes.byref(self.stream)
+        self.input = np.zeros(0, dtype=np.uint8)
+        if self.z.inflateInit2_(self.pointer, Bits, self.z.zlibVersion(), ctypes.sizeof(ZStream)) != Z_OK:
+            raise ValueError("Unable to start zlib inflate")
+
+    def feed(self, Data):
+        self.input = np.frombuffer(Data, dtype=np.uint8)
+        self.stream.next_in = self.input.ctypes.data
+        self.stream.avail_in = len(self.input)
+
+    def available(self):
+        return self.stream.avail_in
+
+    #Input given with feed which was not used yet
+    def rest(self):
+        return self.input[len(self.input) - self.stream.avail_in:].tobytes()
+
+    def prime(self, Bits, Value):
+        self.z.inflatePrime(self.pointer, Bits, Value)
+
+    def dictionary(self, Data):
+        data = np.ascontiguousarray(Data, dtype=np.uint8)
+        self.z.inflateSetDictionary(self.pointer, data.ctypes.data, len(data))
+
+    def reset(self, Bits):
+        self.z.inflateReset2(self.pointer, Bits)
+
+    #Decompresses into Output[Start:]; returns the code of zlib and the bytes of input used and of output written
+    def inflate(self, Output, Start=0, Flush=Z_NO_FLUSH):
+        before = self.stream.avail_in
+        self.stream.next_out = Output.ctypes.data + Start
+        self.stream.avail_out = len(Output) - Start
+        code = self.z.inflate(self.pointer, Flush)
+        used, written = before - self.stream.avail_in, len(Output) - Start - self.stream.avail_out
+        if code < 0 and code != Z_BUF_ERROR or code == Z_BUF_ERROR and used == 0 and written == 0 and self.stream.avail_in > 0:
+            raise ValueError("Corrupt gzip data (zlib error {})".format(code))
+        return code, used, written
+
+    def close(self):
+        self.z.inflateEnd(self.pointer)
+
+#After the end of a gzip member, skips the Trailer bytes of its trailer which zlib did not read. Returns whether
+#another member follows, with Inflater reset to read it.
+def nextMember(Inflater, File, Trailer):
+    rest = Inflater.rest()
+    while len(rest) < Trailer + 2:
+        data = File.read(1 << 16)
+        if not data:
+            break
+        rest += data
+    rest = rest[Trailer:]
+    if rest[:2] != b"\x1f\x8b":
+        return False
+    Inflater.reset(GzipBits)
+    Inflater.feed(rest)
+    return True
+
+################################################################################
+
+def indexPath(FileName):
+    directory = os.environ.get("COSI_GZIP_INDEX", "")
+    if not directory:
+        return FileName + ".zidx"
+    real = os.path.realpath(FileName)
+    return os.path.join(directory, "{}.{}.zidx".format(os.path.basename(real), hashlib.sha256(real.encode()).hexdigest()[:16]))
+
+#Decompresses FileName once, taking a checkpoint at the first deflate block boundary after every Spacing bytes of text
+def build(FileName, Spacing=1 << 24):
+    inflater = Inflater(GzipBits)
+    #The last Window bytes of text, written round
+    output = np.zeros(Window, dtype=np.uint8)
+    position = total = events = 0
+    points = {name: [] for name in ("in", "bits", "out", "first", "number", "length")}
+    windows, waiting = [], collections.deque()
+    carry = b"\n"
+    with open(FileName, "rb") as f:
+        try:
+            while True:
+                if inflater.available() == 0:
+                    data = f.read(1 << 20)
+                    if not data:
+                        break
+                    inflater.feed(data)
+                if position == Window:
+                    position = 0
+                code, _, written = inflater.inflate(output, position, Z_BLOCK)
+                if written:
+                    text = carry + output[position:position + written].tobytes()
+                    base = total - len(carry)
+                    for match in EventLine.finditer(text):
+                        start = base + match.start() + 1
+                        while waiting and points["out"][waiting[0]] <= start:
+                            point = waiting.popleft()
+                            points["first"][point], points["number"][point] = start, events
+                        events += 1
+                    carry = text[-3:]
+                    position += written
+                    total += written
+                if code == Z_STREAM_END:
+                    if not nextMember(inflater, f, 0):
+                        break
+                    continue
+                #At the end of a block which is not the last one of its member, or just after a gzip header
+                kind = inflater.stream.data_type
+                if kind & 128 and not kind & 64 and (not points["out"] or total - points["out"][-1] >= Spacing):
+                    length = min(total, Window)
+                    ring = np.concatenate((output[position:], output[:position]))
+                    window = np.zeros(Window, dtype=np.uint8)
+                    window[Window - length:] = ring[Window - length:]
+                    for name, value in (("in", f.tell() - inflater.available()), ("bits", kind & 7), ("out", total),
+                                        ("first", total), ("number", events), ("length", length)):
+                        points[name].append(value)
+                    windows.append(window)
+                    waiting.append(len(windows) - 1)
+        finally:
+            inflater.close()
+    for point in waiting:
+        points["first"][point], points["number"][point] = total, events
+
+    info = os.stat(FileName)
+    index = {name: np.array(values, dtype=np.int64) for name, values in points.items()}
+    index["windows"] = np.array(windows, dtype=np.uint8).reshape(len(windows), Window)
+    index["meta"] = {"version": IndexVersion, "source": os.path.realpath(FileName), "size": info.st_size, "mtime": info.st_mtime_ns,
+                     "spacing": Spacing, "text": total, "events": events, "checkpoints": len(windows), "created": time.time()}
+    return index
+
+def save(FileName, Index):
+    path = indexPath(FileName)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, meta=np.array(json.dumps(Index["meta"])), **{name: values for name, values in Index.items() if name != "meta"})
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix=".tmp")
+    with os.fdopen(handle, "wb") as f:
+        f.write(buffer.getvalue())
+    #Indexes sit next to shared data; one readable only by its owner would make load() fail for everyone else
+    h.replaceShared(temporary, path)
+    return path
+
+#The index of FileName, or None if there is none or the file changed since it was built
+def load(FileName):
+    try:
+        with np.load(indexPath(FileName)) as content:
+            index = {name: content[name] for name in content.files if name != "meta"}
+            index["meta"] = json.loads(str(content["meta"]))
+    except (OSError, KeyError, ValueError):
+        return None
+    info = os.stat(FileName)
+    meta = index["meta"]
+    if meta["version"] != IndexVersion or meta["size"] != info.st_size or meta["mtime"] != info.st_mtime_ns:
+        return None
+    return index
+
+#Everything a process needs to start at checkpoint Point; the events it covers end where those of the next one start
+def checkpoint(Index, Point):
+    last = int(Index["first"][Point + 1]) if Point + 1 < len(Index["first"]) else None
+    return {"in": int(Index["in"][Point]), "bits": int(Index["bits"][Point]), "out": int(Index["out"][Point]),
+            "first": int(Index["first"][Point]), "last": last, "number": int(Index["number"][Point]),
+            "window": Index["windows"][Point][Window - int(Index["length"][Point]):].tobytes()}
+
+################################################################################
+
+#Text of the file from Checkpoint on, in pieces of up to PieceBytes
+def inflateFrom(FileName, Checkpoint, PieceBytes=1 << 20):
+    inflater = Inflater(RawBits)
+    output = np.zeros(PieceBytes, dtype=np.uint8)
+    raw = True
+    try:
+        with open(FileName, "rb") as f:
+            bits = Checkpoint["bits"]
+            f.seek(Checkpoint["in"] - (1 if bits else 0))
+            if bits:
+                inflater.prime(bits, f.read(1)[0] >> (8 - bits))
+            if Checkpoint["window"]:
+                inflater.dictionary(np.frombuffer(Checkpoint["window"], dtype=np.uint8))
+            while True:
+                if inflater.available() == 0:
+                    data = f.read(1 << 20)
+                    if not data:
+                        return
+                    inflater.feed(data)
+                code, _, written = inflater.inflate(output)
+                if written:
+                    yield output[:written].tobytes()
+                if code == Z_STREAM_END:
+                    #Raw deflate stops before the trailer of the member, gzip reads it
+                    if not nextMember(inflater, f, 8 if raw else 0):
+                        return
+                    raw = False
+    finally:
+        inflater.close()
+
+#Text of the events covered by Checkpoint, in pieces of about ChunkBytes which end at the end of an event
+def eventChunks(FileName, Checkpoint, ChunkBytes=1 << 22):
+    first, last = Checkpoint["first"], Checkpoint["last"]
+    offset = Checkpoint["out"]
+    pieces, size = [], 0
+    for piece in inflateFrom(FileName, Checkpoint):
+        start, offset = offset, offset + len(piece)
+        if offset <= first:
+            continue
+        pieces.append(piece[max(first - start, 0):None if last is None else max(last - start, 0)])
+        size += len(pieces[-1])
+        if last is not None and offset >= last:
+            break
+        if size >= ChunkBytes:
+            text = b"".join(pieces)
+            split = text.rfind(b"\nSE")
+            if split > 0:
+                yield text[:split + 1]
+                text = text[split + 1:]
+            pieces, size = [text], len(text)
+    yield b"".join(pieces)
+
+#Job = (FileName, Checkpoint, ChunkBytes): the events covered by Checkpoint as one batch
+def readCheckpoint(Job):
+    FileName, Checkpoint, ChunkBytes = Job
+    return tr.concatBatches([tr.parseEvents(text) for text in eventChunks(FileName, Checkpoint, ChunkBytes)])
+
+#Drop-in replacement for TraReader.readTra which parses the events between the checkpoints of the index on
+#Processes processes, at most two checkpoints ahead per process. Files without a usable index are read by
+#TraReader.readTra, as are all files within processes of a pool, which cannot start processes of their own.
+def readTra(FileName, BatchSize=100000, ChunkBytes=1 << 22, MaxEvents=None, Skip=0, Processes=None):
+    index = load(FileName) if FileName.endswith(".gz") else None
+    Processes = Processes or mp.cpu_count()
+    if index is None or Processes == 1 or mp.current_process().daemon:
+        yield from tr.readTra(FileName, BatchSize, MaxEvents=MaxEvents, Skip=Skip)
+        return
+    numbers = index["number"]
+    begin = max(int(np.searchsorted(numbers, Skip, side="right")) - 1, 0)
+    end = len(numbers) if MaxEvents is None else max(int(np.searchsorted(numbers, MaxEvents, side="left")), begin + 1)
+    jobs = [(FileName, checkpoint(index, point), ChunkBytes) for point in range(begin, end)]
+    skipped = int(numbers[begin])
+    with mp.Pool(min(Processes, len(jobs))) as pool:
+        def parsed():
+            waiting = collections.deque()
+            for job in jobs:
+                waiting.append(pool.apply_async(readCheckpoint, (job,)))
+                if len(waiting) >= 2*Processes:
+                    yield waiting.popleft().get()
+            while waiting:
+                yield waiting.popleft().get()
+        yield from tr.limitEvents(parsed(), BatchSize, None if MaxEvents is None else MaxEvents - skipped, Skip - skipped)
+
+#Text of Count events from event First on, counting the events of the file from 0
+def eventText(FileName, First, Count=1, Index=None):
+    Index = Index or load(FileName)
+    if Index is None:
+        raise IOError("No up to date index of " + FileName + " - build it with GzipIndex.py build")
+    if First < 0 or First >= Index["meta"]["events"]:
+        raise ValueError("{} has {} events".format(FileName, Index["meta"]["events"]))
+    point = int(np.searchsorted(Index["number"], First, side="right")) - 1
+    skip = First - int(Index["number"][point])
+    #Events are counted from the start of the text, which is the start of the first event of the checkpoint
+    starts, text, scanned = [0], b"", 0
+    for piece in eventChunks(FileName, dict(checkpoint(Index, point), last=None), Window):
+        text += piece
+        starts += [match.start() + 1 for match in EventLine.finditer(text, scanned)]
+        scanned = max(len(text) - 3, 0)
+        if len(starts) > skip + Count:
+            return text[starts[skip]:starts[skip + Count]].decode()
+    return text[starts[skip]:].decode()
+
+################################################################################
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build and use seekable indexes of .tra.gz files for parallel and random access.')
+    parser.add_argument('command', choices=['build', 'info', 'event', 'read'], help='build indexes, show an index, print events, or time a parallel read')
+    parser.add_argument('files', nargs='+', help='tra.gz files; for event the file and the numbers of the events (from 0)')
+    parser.add_argument('-s', '--spacing', type=float, default=16.0, help='Text between checkpoints [MB]')
+    parser.add_argument('-c', '--count', type=int, default=1, help='Events printed from every event number on')
+    parser.add_argument('-j', '--processes', type=int, default=0, help='Number of processes for read (default: all cores)')
+    args = parser.parse_args()
+
+    if args.command == 'event':
+        for number in args.files[1:]:
+            print(eventText(args.files[0], int(number), args.count), end="")
+        quit()
+
+    for FileName in args.files:
+        if args.command == 'build':
+            Start = time.time()
+            index = build(FileName, int(args.spacing*(1 << 20)))
+            path = save(FileName, index)
+            print("INFO: Indexed {} in {:.1f} s: {} events, {:.0f} MB of text, {} checkpoints in {}".format(FileName, time.time() - Start,
+                  index["meta"]["events"], index["meta"]["text"]/(1 << 20), index["meta"]["checkpoints"], path))
+            continue
+        index = load(FileName)
+        if index is None:
+            print("ERROR: No up to date index of " + FileName + " - build it with GzipIndex.py build")
+            quit()
+        if args.command == 'info':
+            meta = index["meta"]
+            print("{}: {} events, {:.1f} MB of text in {:.1f} MB, {} checkpoints every {:.0f} MB, built {}".format(FileName, meta["events"], meta["text"]/(1 << 20),
+                  meta["size"]/(1 << 20), meta["checkpoints"], meta["spacing"]/(1 << 20), time.strftime("%Y-%m-%d %H:%M", time.localtime(meta["created"]))))
+        else:
+            Start = time.time()
+            events = sum(tr.batchSize(batch) for batch in readTra(FileName, Processes=args.processes or None))
+            print("{}: {} events in {:.2f} s, {:.0f} events/s".format(FileName, events, time.time() - Start, events/(time.time() - Start)))
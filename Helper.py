@@ -1,70 +1,188 @@
 #####################################################################################################################################################################
 #Written by Rhea Senthil Kumar
 ######################################################################################################################################################################
-import ROOT as M
-import statistics
+import os
+import numpy as np
+import multiprocessing as mp
 ######################################################################################################################################################################
+#Gamma-ray lines [keV] of the calibration isotopes
+LineCatalog = {"Ba133": [356.017], "Cs137": [661.657], "Na22": [510.99, 1274.577], "Y88": [898.042, 1836.063], "Co60": [1173.237, 1332.501]}
+
 #Secondary Functions for Main ARM Output Program
 def getMaxHist(Hist):
-    Max = 0
-    for b in range(1, Hist.GetNbinsX()+1):
-        if Hist.GetBinContent(b) > Max:
-            Max = Hist.GetBinContent(b)
-    return Max
+    return float(getMaxHistBatch(histToBins(Hist)[0][None, :])[0])
 
 def getFWHM(Hist):
-    half_peak = getMaxHist(Hist)/2
-    low_halfpeak, high_halfpeak = 0,0
-    for c in range(1, Hist.GetNbinsX()+1):
-        if Hist.GetBinContent(c) > half_peak:
-            low_halfpeak = (Hist.GetXaxis().GetBinCenter(c) + Hist.GetXaxis().GetBinCenter(c+1))/2
-            break
-    for d in reversed(range(1, Hist.GetNbinsX()+1)):
-        if Hist.GetBinContent(d) > half_peak:
-            high_halfpeak = (Hist.GetXaxis().GetBinCenter(d) + Hist.GetXaxis().GetBinCenter(d+1))/2
+    contents, low, high = histToBins(Hist)
+    return round(float(getFWHMBatch(contents[None, :], (high - low)/len(contents))[0]), 2)
+
+#Array versions of getMaxHist and getFWHM: every row of Rows is one histogram
+def getMaxHistBatch(Rows):
+    return np.asarray(Rows).max(axis=1)
+
+def getFWHMBatch(Rows, BinWidth):
+    return getPeakFWHMBatch(Rows, 0.0, BinWidth)[2]
+
+#Peak height, peak position (center of the highest bin) and FWHM of every row of Rows, histograms whose
+#bins of BinWidth start at Low. The half maximum is crossed between the outermost bins above it and their
+#outer neighbours; the crossing is interpolated linearly between those bin centers, or put on the
+#histogram edge if the outermost bin above half maximum is the first or last bin. Empty rows have FWHM 0.
+def getPeakFWHMBatch(Rows, Low, BinWidth):
+    Rows = np.asarray(Rows, dtype=np.float64)
+    bins = Rows.shape[1]
+    rows = np.arange(len(Rows))
+    peak_bin = Rows.argmax(axis=1)
+    peak = Rows[rows, peak_bin]
+    half = peak/2
+
+    above = Rows > half[:, None]
+    first = above.argmax(axis=1)
+    last = bins - 1 - above[:, ::-1].argmax(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        inner, outer = Rows[rows, first], Rows[rows, np.maximum(first - 1, 0)]
+        left = np.where(first > 0, first - (inner - half)/(inner - outer), -0.5)
+        inner, outer = Rows[rows, last], Rows[rows, np.minimum(last + 1, bins - 1)]
+        right = np.where(last < bins - 1, last + (inner - half)/(inner - outer), bins - 0.5)
+    fwhm = np.where(above.any(axis=1), (right - left)*BinWidth, 0.0)
+    return peak, Low + (peak_bin + 0.5)*BinWidth, fwhm
+
+#ARM of Compton events in degrees, for arrays of first interaction positions C1 (n, 3), unit scatter
+#directions Dg (n, 3) and scatter angles Phi (n,) [rad]. Like MComptonEvent::GetARMGamma, it is the
+#angle between (Source - C1) and -Dg minus Phi.
+def getARM(C1, Dg, Phi, Source):
+    origin = np.asarray(Source, dtype=np.float64) - C1
+    cosine = -(origin*Dg).sum(axis=1)/np.sqrt((origin*origin).sum(axis=1))
+    return (np.arccos(np.clip(cosine, -1, 1)) - Phi)*(180.0/np.pi)
+
+#Compares getARM with MEGAlib's GetARMGamma for the first MaxEvents events of a tra file and returns the
+#number of Compton events compared and the largest difference in degrees
+def checkARM(FileName, X, Y, Z, MaxEvents=100000):
+    import ROOT as M
+    import TraReader as tr
+    M.gSystem.Load("$(MEGALIB)/lib/libMEGAlib.so")
+    M.MGlobal().Initialize()
+
+    Reader = M.MFileEventsTra()
+    if Reader.Open(M.MString(FileName)) == False:
+        raise IOError("Unable to open file " + FileName)
+    megalib = {}
+    for counter in range(MaxEvents):
+        Event = Reader.GetNextEvent()
+        if not Event:
             break
-    print(low_halfpeak, high_halfpeak)
-    FWHM = high_halfpeak - low_halfpeak
-    return round(FWHM, 2)
+        if Event.GetType() == M.MPhysicalEvent.c_Compton:
+            megalib[Event.GetId()] = Event.GetARMGamma(M.MVector(X, Y, Z))*(180.0/np.pi)
+
+    Events = tr.concatBatches(list(tr.readTra(FileName, MaxEvents=MaxEvents)))
+    compton = Events["type"] == tr.c_Compton
+    ARM = getARM(Events["C1"][compton], Events["Dg"][compton], Events["phi"][compton], (X, Y, Z))
+    ids = Events["id"][compton]
+    common = [i for i in range(len(ids)) if ids[i] in megalib]
+    difference = max([abs(ARM[i] - megalib[ids[i]]) for i in common], default=0.0)
+    return len(common), difference
+
+#Fills an array of values into a TH1, skipping NaNs
+def fillHist(Hist, Values):
+    Values = np.ascontiguousarray(Values, dtype=np.float64)
+    Values = Values[np.isfinite(Values)]
+    if len(Values) > 0:
+        Hist.FillN(len(Values), Values, np.ones(len(Values)))
+
+#Bin contents (without under- and overflow) and axis range of a TH1
+def histToBins(Hist):
+    contents = np.array([Hist.GetBinContent(b) for b in range(1, Hist.GetNbinsX()+1)])
+    return contents, Hist.GetXaxis().GetXmin(), Hist.GetXaxis().GetXmax()
 
 #Bootstrap Functions
-def bootstrapFWHM(Hist, R=1000):
-    FWHMs = []
-    Sample = []
-    for i in range(R):
-        ARMSample = M.TH1D("Sample", "", 501, -180, 180)
-        for w in range(1, int(Hist.GetEntries())):
-            event = Hist.GetRandom()
-            ARMSample.Fill(event)
-        fwhm = getFWHM(ARMSample)
-        FWHMs.append(fwhm)
-    stderror = statistics.stdev(FWHMs)
-    return round(stderror, 2)
+#Each replicate redraws all entries of the histogram as one multinomial draw over its bins, which is
+#then rebinned onto the 501 bin sample grid. A fine bin straddling two sample bins splits its count
+#binomially by overlap, which is what GetRandom() + Fill() did one entry at a time.
+#Returns the FWHM, RMS and peak height of every replicate; Chunk replicates are held in memory at once.
+def bootstrapReplicates(Contents, Low, High, R=1000, rng=None, SampleBins=501, Chunk=100):
+    if rng is None:
+        rng = np.random.default_rng()
+    counts = np.clip(np.asarray(Contents, dtype=np.float64), 0, None)
+    entries = int(round(counts.sum()))
+    FWHMs, RMSs, Peaks = np.zeros(R), np.zeros(R), np.zeros(R)
+    if entries == 0:
+        return FWHMs, RMSs, Peaks
+
+    fine_bins = len(counts)
+    fine_edges = np.linspace(Low, High, fine_bins+1)
+    fine_centers = (fine_edges[:-1] + fine_edges[1:])/2
+    sample_width = (High - Low)/SampleBins
+    target = np.minimum(((fine_edges[:-1] - Low)//sample_width).astype(np.int64), SampleBins-1)
+    split = Low + (target+1)*sample_width
+    inside = np.clip((split - fine_edges[:-1])/(fine_edges[1:] - fine_edges[:-1]), 0, 1)
+    neighbour = np.minimum(target+1, SampleBins-1)
+    pvals = counts/counts.sum()
+
+    for start in range(0, R, Chunk):
+        n = min(Chunk, R-start)
+        draws = rng.multinomial(entries, pvals, size=n)
+        first = rng.binomial(draws, inside)
+        rows = np.arange(n)[:, None]*SampleBins
+        sample = np.bincount((rows + target).ravel(), weights=first.ravel(), minlength=n*SampleBins)
+        sample += np.bincount((rows + neighbour).ravel(), weights=(draws - first).ravel(), minlength=n*SampleBins)
+        sample = sample.reshape(n, SampleBins)
+
+        mean = draws @ fine_centers / entries
+        RMSs[start:start+n] = np.sqrt(np.maximum(draws @ fine_centers**2 / entries - mean**2, 0))
+        Peaks[start:start+n], _, FWHMs[start:start+n] = getPeakFWHMBatch(sample, Low, sample_width)
+    return FWHMs, RMSs, Peaks
+
+def replicateErrors(FWHMs, RMSs, Peaks):
+    return tuple(round(float(np.std(values, ddof=1)), 2) for values in (FWHMs, RMSs, Peaks))
 
+#Standard errors of FWHM, RMS and peak height from one set of R replicates
+def bootstrapErrors(Hist, R=1000, seed=None):
+    contents, low, high = histToBins(Hist)
+    return replicateErrors(*bootstrapReplicates(contents, low, high, R, np.random.default_rng(seed)))
+
+#Bootstrap Scheduler
+#The R replicates of every histogram are cut into blocks of BlockSize and all (histogram, block) jobs are
+#handed to the pool at once. Workers only receive the bin arrays from histToBins. Every job seeds its own
+#generator from (seed, histogram, block), so the errors are identical for any number of processes.
+#Keys replaces the index of every histogram in the seed, e.g. by a key of its content from ResultCache.
+def bootstrapBlock(Job):
+    contents, low, high, n, seed_sequence = Job
+    return bootstrapReplicates(contents, low, high, n, np.random.default_rng(seed_sequence))
+
+def bootstrapAll(Bins, R=1000, seed=0, processes=None, BlockSize=100, Keys=None):
+    jobs = []
+    for i, (contents, low, high) in enumerate(Bins):
+        key = i if Keys is None else Keys[i]
+        for b, start in enumerate(range(0, R, BlockSize)):
+            jobs.append((contents, low, high, min(BlockSize, R-start), np.random.SeedSequence(seed, spawn_key=(key, b))))
+    if len(jobs) == 0:
+        return []
+    if processes == 1:
+        blocks = list(map(bootstrapBlock, jobs))
+    else:
+        with mp.Pool(processes or mp.cpu_count()) as pool:
+            blocks = pool.map(bootstrapBlock, jobs, chunksize=1)
+
+    errors = []
+    per_hist = len(range(0, R, BlockSize))
+    for i in range(len(Bins)):
+        own = blocks[i*per_hist:(i+1)*per_hist]
+        errors.append(replicateErrors(*(np.concatenate(stat) for stat in zip(*own))))
+    return errors
+
+def bootstrapFWHM(Hist, R=1000):
+    return bootstrapErrors(Hist, R)[0]
 
 def bootstrapRMS(Hist, R=1000):
-    RMSs = []
-    Sample = []
-    for i in range(R):
-        ARMSample = M.TH1D("Sample", "", 501, -180, 180)
-        for w in range(1, int(Hist.GetEntries())):
-            event = Hist.GetRandom()
-            ARMSample.Fill(event)
-        rms = ARMSample.GetRMS()
-        RMSs.append(rms)
-    stderror = statistics.stdev(RMSs)
-    return round(stderror, 2)
+    return bootstrapErrors(Hist, R)[1]
 
 def bootstrapPeak(Hist, R=1000):
-    Peaks = []
-    Sample = []
-    for i in range(R):
-        ARMSample = M.TH1D("Sample", "", 501, -180, 180)
-        for w in range(1, int(Hist.GetEntries())):
-            event = Hist.GetRandom()
-            ARMSample.Fill(event)
-        peak = getMaxHist(ARMSample)
-        Peaks.append(peak)
-    stderror = statistics.stdev(Peaks)
-    return round(stderror, 2)
+    return bootstrapErrors(Hist, R)[2]
 
+#Output Files
+#Moves Temporary, written with tempfile.mkstemp (readable only by its owner), to FileName with the mode of
+#any other new file (0666 minus the umask): outputs, checkpoints and indexes are shared with other users
+def replaceShared(Temporary, FileName):
+    umask = os.umask(0)
+    os.umask(umask)
+    os.chmod(Temporary, 0o666 & ~umask)
+    os.replace(Temporary, FileName)
@@ -0,0 +1,247 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#ARM histograms split by an event attribute (scatter angle, energy, lever arm, ...), kept as one
+#2D array of counts: one row ("slice") per attribute bin, one column per ARM bin.
+#
+#The histograms of a job can be checkpointed to a .npz file together with how far each tra file was
+#read, so an interrupted job resumes where it stopped, and checkpoints of several jobs (e.g. the runs
+#of one source) merge exactly by adding their bins:
+#  python3 Histograms.py merge -o Cs137.npz Run043.npz Run044.npz Run045.npz Run046.npz
+#  python3 Histograms.py info Cs137.npz
+
+import argparse
+import io
+import json
+import os
+import tempfile
+import numpy as np
+import Helper as h
+import EventCache as ec
+
+#Attributes events can be binned by, computed from TraReader columns
+Attributes = {
+    "phi": lambda Events: Events["phi"]*(180.0/np.pi),              #Compton scatter angle [deg]
+    "Ei": lambda Events: Events["Ei"],                               #total energy [keV]
+    "leverarm": lambda Events: np.linalg.norm(Events["C2"] - Events["C1"], axis=1),   #first lever arm [cm]
+}
+
+def getAttribute(Events, Name):
+    return Attributes[Name](Events)
+
+#The value axis is ARM by default, but any other per-event value (e.g. the lever arm) can be binned the same way
+class BinnedARM:
+    #Edges: bin edges of the attribute; every bin is [low, high), the last one [low, high]
+    def __init__(self, Edges, ARMBins=3601, ARMLow=-180.0, ARMHigh=180.0):
+        self.Edges = np.asarray(Edges, dtype=np.float64)
+        self.ARMBins = ARMBins
+        self.ARMLow = ARMLow
+        self.ARMHigh = ARMHigh
+        self.Counts = np.zeros((len(self.Edges) - 1, ARMBins))
+        #Sum and sum of squares of the ARM values per slice, for the unbinned RMS like TH1::GetRMS
+        self.Sums = np.zeros((len(self.Edges) - 1, 2))
+        #Entries outside the attribute or ARM range, or with NaN values
+        self.Outside = 0
+
+    def slices(self):
+        return len(self.Edges) - 1
+
+    def attributeBins(self, Attribute):
+        index = np.searchsorted(self.Edges, Attribute, side='right') - 1
+        index[Attribute == self.Edges[-1]] = self.slices() - 1
+        return index
+
+    def fill(self, Attribute, ARM):
+        Attribute = np.asarray(Attribute, dtype=np.float64)
+        ARM = np.asarray(ARM, dtype=np.float64)
+        row = self.attributeBins(Attribute)
+        #NaN values (e.g. ARM of events with an unphysical scatter angle) are counted as outside below
+        with np.errstate(invalid="ignore"):
+            column = np.floor((ARM - self.ARMLow)/(self.ARMHigh - self.ARMLow)*self.ARMBins).astype(np.int64, copy=False) if len(ARM) else np.zeros(0, dtype=np.int64)
+        column[ARM == self.ARMHigh] = self.ARMBins - 1
+        inside = (row >= 0) & (row < self.slices()) & (column >= 0) & (column < self.ARMBins) & np.isfinite(ARM)
+        self.Outside += int(len(ARM) - inside.sum())
+        row, column, ARM = row[inside], column[inside], ARM[inside]
+        self.Counts += np.bincount(row*self.ARMBins + column, minlength=self.Counts.size).reshape(self.Counts.shape)
+        self.Sums[:, 0] += np.bincount(row, weights=ARM, minlength=self.slices())
+        self.Sums[:, 1] += np.bincount(row, weights=ARM*ARM, minlength=self.slices())
+
+    def sameBinning(self, Other):
+        return (np.array_equal(self.Edges, Other.Edges) and self.ARMBins == Other.ARMBins
+                and self.ARMLow == Other.ARMLow and self.ARMHigh == Other.ARMHigh)
+
+    #Adds the bins of Other, which has to be binned the same way
+    def merge(self, Other):
+        if not self.sameBinning(Other):
+            raise ValueError("Cannot merge ARM histograms with different binning")
+        self.Counts += Other.Counts
+        self.Sums += Other.Sums
+        self.Outside += Other.Outside
+
+    def binWidth(self):
+        return (self.ARMHigh - self.ARMLow)/self.ARMBins
+
+    def entries(self):
+        return self.Counts.sum(axis=1)
+
+    def getMax(self):
+        return h.getMaxHistBatch(self.Counts)
+
+    def getFWHM(self):
+        return np.round(h.getFWHMBatch(self.Counts, self.binWidth()), 2)
+
+    #Peak height, peak position and FWHM of all slices in one pass
+    def getPeakFWHM(self):
+        return h.getPeakFWHMBatch(self.Counts, self.ARMLow, self.binWidth())
+
+    def getMean(self):
+        return self.Sums[:, 0]/np.maximum(self.entries(), 1)
+
+    #Values below which the fractions Probabilities of the entries of every slice lie, interpolated
+    #linearly inside the bins; NaN for empty slices
+    def quantiles(self, Probabilities):
+        Probabilities = np.asarray(Probabilities, dtype=np.float64)
+        cumulative = np.cumsum(self.Counts, axis=1)
+        total = cumulative[:, -1]
+        target = Probabilities[None, :]*total[:, None]
+        rows = np.arange(self.slices())[:, None]
+        index = np.minimum((cumulative[:, None, :] < target[:, :, None]).sum(axis=2), self.ARMBins - 1)
+        below = np.where(index > 0, cumulative[rows, np.maximum(index - 1, 0)], 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            fraction = np.clip((target - below)/self.Counts[rows, index], 0, 1)
+        values = self.ARMLow + (index + fraction)*self.binWidth()
+        values[total == 0] = np.nan
+        return values
+
+    def getRMS(self):
+        n = np.maximum(self.entries(), 1)
+        mean = self.Sums[:, 0]/n
+        return np.round(np.sqrt(np.maximum(self.Sums[:, 1]/n - mean**2, 0)), 2)
+
+    #One slice as a ROOT TH1D, with the unbinned statistics of the filled values
+    def toTH1(self, Slice, Name, Title):
+        import ROOT as M
+        Hist = M.TH1D(Name, Title, self.ARMBins, self.ARMLow, self.ARMHigh)
+        Hist.SetContent(np.concatenate(([0.0], self.Counts[Slice], [0.0])))
+        n = self.Counts[Slice].sum()
+        Hist.SetEntries(n)
+        Hist.PutStats(np.array([n, n, self.Sums[Slice, 0], self.Sums[Slice, 1]]))
+        return Hist
+
+################################################################################
+
+#Writes the histograms (a dict name -> BinnedARM) and the read progress of every tra file
+def saveCheckpoint(FileName, Hists, Progress):
+    arrays = {}
+    meta = {"names": list(Hists), "progress": Progress, "axes": [], "outside": []}
+    for i, Hist in enumerate(Hists.values()):
+        arrays["edges" + str(i)] = Hist.Edges
+        arrays["counts" + str(i)] = Hist.Counts
+        arrays["sums" + str(i)] = Hist.Sums
+        meta["axes"].append([Hist.ARMBins, Hist.ARMLow, Hist.ARMHigh])
+        meta["outside"].append(Hist.Outside)
+    arrays["meta"] = np.array(json.dumps(meta))
+
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, **arrays)
+    directory = os.path.dirname(os.path.abspath(FileName))
+    handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+    with os.fdopen(handle, "wb") as f:
+        f.write(buffer.getvalue())
+    h.replaceShared(temporary, FileName)
+
+def loadCheckpoint(FileName):
+    with np.load(FileName) as content:
+        meta = json.loads(str(content["meta"]))
+        Hists = {}
+        for i, name in enumerate(meta["names"]):
+            bins, low, high = meta["axes"][i]
+            Hist = BinnedARM(content["edges" + str(i)], bins, low, high)
+            Hist.Counts = content["counts" + str(i)]
+            Hist.Sums = content["sums" + str(i)]
+            Hist.Outside = meta["outside"][i]
+            Hists[name] = Hist
+    return Hists, meta["progress"]
+
+#Adds up the histograms of several checkpoints. A tra file may only be part of one of them.
+def mergeCheckpoints(FileNames):
+    Hists, Progress = loadCheckpoint(FileNames[0])
+    for FileName in FileNames[1:]:
+        other, other_progress = loadCheckpoint(FileName)
+        if list(other) != list(Hists):
+            raise ValueError(FileName + " does not contain the same histograms as " + FileNames[0])
+        twice = set(Progress) & set(other_progress)
+        if twice:
+            raise ValueError("Events of " + ", ".join(sorted(twice)) + " would be counted twice")
+        for name, Hist in Hists.items():
+            Hist.merge(other[name])
+        Progress.update(other_progress)
+    return Hists, Progress
+
+#Fills histograms from tra files with periodic checkpoints. If FileName exists, the histograms are
+#restored from it and files are read from where the checkpoint stopped; Every is the number of
+#events between checkpoints. Without a FileName it only reads the events.
+class Checkpoint:
+    def __init__(self, FileName, Hists, Every=1000000):
+        self.FileName = FileName
+        self.Hists = Hists
+        self.Every = Every
+        self.Progress = {}
+        self.Unsaved = 0
+        self.Opened = {}
+        if FileName and os.path.exists(FileName):
+            saved, self.Progress = loadCheckpoint(FileName)
+            if list(saved) != list(Hists) or not all(saved[name].sameBinning(Hist) for name, Hist in Hists.items()):
+                raise ValueError("Checkpoint " + FileName + " was written for different histograms")
+            for name, Hist in Hists.items():
+                Hist.merge(saved[name])
+            print("INFO: Resuming from checkpoint " + FileName)
+
+    def save(self):
+        if self.FileName:
+            saveCheckpoint(self.FileName, self.Hists, self.Progress)
+        self.Unsaved = 0
+
+    #Batches of TraFile the checkpoint has not seen yet. A batch counts as done once the caller asks
+    #for the next one, so a checkpoint never contains half of a batch.
+    def events(self, TraFile, MaxEvents=None, Stats=None, Processes=None):
+        #A file read more than once in the same job is tracked separately each time
+        key = os.path.realpath(TraFile)
+        self.Opened[key] = self.Opened.get(key, 0) + 1
+        if self.Opened[key] > 1:
+            key += "#" + str(self.Opened[key])
+        done = self.Progress.get(key, {"events": 0, "id": None, "complete": False})
+        if done["complete"]:
+            print("INFO: " + TraFile + " is already in the checkpoint")
+            return
+        for Events in ec.readEvents(TraFile, MaxEvents=MaxEvents, Skip=done["events"], Stats=Stats, Processes=Processes):
+            yield Events
+            if len(Events["id"]) > 0:
+                done = {"events": done["events"] + len(Events["id"]), "id": int(Events["id"][-1]), "complete": False}
+                self.Progress[key] = done
+                self.Unsaved += len(Events["id"])
+            if self.Unsaved >= self.Every:
+                self.save()
+        self.Progress[key] = dict(done, complete=True)
+        self.save()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merge and inspect ARM histogram checkpoints.')
+    parser.add_argument('command', choices=['merge', 'info'], help='merge checkpoints into one, or show what a checkpoint contains')
+    parser.add_argument('checkpoints', nargs='+', help='Checkpoint files')
+    parser.add_argument('-o', '--output', type=str, default='merged.npz', help='Output file of merge')
+    args = parser.parse_args()
+
+    if args.command == 'merge':
+        Hists, Progress = mergeCheckpoints(args.checkpoints)
+        saveCheckpoint(args.output, Hists, Progress)
+        print("Merged " + str(len(args.checkpoints)) + " checkpoints into " + args.output)
+    else:
+        for FileName in args.checkpoints:
+            Hists, Progress = loadCheckpoint(FileName)
+            print(FileName + ":")
+            for name, Hist in Hists.items():
+                print("  {}: {} slices, {} entries, {} outside".format(name, Hist.slices(), int(Hist.entries().sum()), Hist.Outside))
+            for tra, done in Progress.items():
+                print("  {}: {} events up to ID {}{}".format(tra, done["events"], done["id"], " (complete)" if done["complete"] else ""))
@@ -0,0 +1,129 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Wall and CPU time per stage and event counters of an analysis job, written as one JSON record per
+#job instead of printing every event. Usage in a script:
+#  Stats = ins.Stats("ARMoutput", run=run, isotope=isotope)
+#  with Stats.stage("selection"):
+#      ...
+#  Stats.count("compton", n)
+#  Stats.write(args.stats)
+#Event-level debug output is only printed for a random fraction of the events, see Stats.debug.
+
+import json
+import os
+import socket
+import sys
+import time
+from contextlib import contextmanager
+import numpy as np
+
+class Stats:
+    def __init__(self, Job, DebugFraction=0.0, **Labels):
+        self.Job = Job
+        self.Labels = Labels
+        self.Started = time.time()
+        self.Stages = {}
+        self.Running = {}
+        self.Counters = {}
+        self.Outputs = []
+        self.Results = {}
+        self.Pipeline = {}
+        self.DebugFraction = DebugFraction
+        self.Random = np.random.default_rng(0)
+        #Everything before the job was set up (Python start, importing ROOT) in CPU time
+        self.Stages["startup"] = {"wall": None, "cpu": time.process_time(), "calls": 1}
+
+    def add(self, Name, Wall, CPU):
+        stage = self.Stages.setdefault(Name, {"wall": 0.0, "cpu": 0.0, "calls": 0})
+        stage["wall"] += Wall
+        stage["cpu"] += CPU
+        stage["calls"] += 1
+
+    @contextmanager
+    def stage(self, Name):
+        self.start(Name)
+        try:
+            yield
+        finally:
+            self.stop(Name)
+
+    #start/stop for stages spanning code which is not a single block
+    def start(self, Name):
+        self.Running[Name] = (time.perf_counter(), time.process_time())
+
+    def stop(self, Name):
+        wall, cpu = self.Running.pop(Name)
+        self.add(Name, time.perf_counter() - wall, time.process_time() - cpu)
+
+    #Passes the items of Iterable through, timing how long each one takes to produce as stage Name
+    def timed(self, Name, Iterable):
+        iterator = iter(Iterable)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(Name, time.perf_counter() - wall, time.process_time() - cpu)
+                return
+            self.add(Name, time.perf_counter() - wall, time.process_time() - cpu)
+            yield item
+
+    def count(self, Name, N=1):
+        self.Counters[Name] = self.Counters.get(Name, 0) + int(N)
+
+    #Counts a batch of events going through the usual Compton selection
+    def countSelection(self, IsCompton, InWindow):
+        self.count("events_read", len(IsCompton))
+        self.count("compton", IsCompton.sum())
+        self.count("rejected_by_type", len(IsCompton) - IsCompton.sum())
+        self.count("in_energy_window", (IsCompton & InWindow).sum())
+
+    #Time of the stages of a read by StagedReader.py; the reads of several files add up
+    def pipeline(self, Stages):
+        for name, report in Stages.items():
+            stage = self.Pipeline.setdefault(name, {"wall": 0.0, "busy": 0.0, "waiting": 0.0, "blocked": 0.0, "items": 0, "capacity": 0.0})
+            for key in ("wall", "busy", "waiting", "blocked", "items"):
+                stage[key] += report[key]
+            stage["capacity"] += report["wall"]*report["workers"]
+
+    #Files the job wrote and its results (e.g. FWHM and RMS per method), passed on in the record
+    def output(self, FileName):
+        self.Outputs.append(os.path.abspath(FileName))
+
+    def result(self, Name, Value):
+        self.Results[Name] = Value
+
+    #Prints Name and the value of a random DebugFraction of the given events
+    def debug(self, Name, IDs, Values):
+        if self.DebugFraction <= 0 or len(IDs) == 0:
+            return
+        chosen = np.flatnonzero(self.Random.random(len(IDs)) < self.DebugFraction)
+        for i in chosen:
+            print("DEBUG: event {} {}: {}".format(IDs[i], Name, Values[i]))
+
+    def record(self):
+        wall = time.time() - self.Started
+        stages = {name: {"wall": None if s["wall"] is None else round(s["wall"], 6), "cpu": round(s["cpu"], 6), "calls": s["calls"]}
+                  for name, s in self.Stages.items()}
+        read = self.Counters.get("events_read", 0)
+        throughput = {"events_per_s": round(read/wall, 1) if wall > 0 else None}
+        for name in ("reading", "selection", "filling"):
+            if name in self.Stages and self.Stages[name]["wall"] > 0:
+                throughput[name + "_events_per_s"] = round(read/self.Stages[name]["wall"], 1)
+        pipeline = {name: dict({key: round(value, 6) for key, value in s.items()}, utilization=round(s["busy"]/s["capacity"], 3) if s["capacity"] > 0 else None)
+                    for name, s in self.Pipeline.items()}
+        return {"job": self.Job, "labels": self.Labels, "host": socket.gethostname(), "pid": os.getpid(),
+                "argv": sys.argv, "started": self.Started, "wall": round(wall, 6), "cpu": round(time.process_time(), 6),
+                "stages": stages, "pipeline": pipeline, "counters": self.Counters, "throughput": throughput,
+                "outputs": self.Outputs, "results": self.Results}
+
+    #Appends the record to FileName as one line of JSON, or prints it if no file is given
+    def write(self, FileName=""):
+        line = json.dumps(self.record())
+        if FileName:
+            with open(FileName, "a") as f:
+                f.write(line + "\n")
+        else:
+            print("STATS: " + line)
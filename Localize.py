@@ -0,0 +1,280 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Localization of a source whose position is wrong or unknown. The ARM of every selected Compton event is
+#evaluated for every point of a grid of candidate positions (x/y/z in cm, like -x/-y/-z of ARMoutput.py)
+#or sky directions (theta/phi in deg, for a source far away). For every candidate it keeps
+#  - the backprojection: the number of Compton cones passing within --width degrees of it
+#  - an ARM histogram within +-(--range) degrees, giving the FWHM of the ARM at the candidate
+#  - the log-likelihood of the ARM values for a Gaussian of --width degrees on a flat background, summed over
+#    the bins of that histogram
+#The best fit is the candidate with the largest likelihood. Its uncertainty comes from the likelihood map:
+#the extent of the candidates within 2.30 (1 sigma for two parameters) of the largest 2 log L, and the
+#spread of the candidates weighted by their likelihood. When the grid is coarser than that, the position and
+#error are refined between grid points from the curvature of 2 log L around the best candidate.
+#
+#Events x candidates are evaluated in blocks of about --block pairs, so every block stays in the CPU
+#cache, and the candidates are split among the processes of a pool which all see the same events.
+#
+#Usage: python3 Localize.py -f Run043.RF.txt -i Cs137 -x 26.1 -y 0.3 -z 64 --extent 40 40 0 --points 100 100 1 -o Run043.localize
+#       python3 Localize.py -f Run043.RF.txt -i Cs137 --sky --theta 0 60 --phi -180 180 --points 100 100 -o Run043.sky
+
+import argparse
+import multiprocessing as mp
+import time
+import numpy as np
+import Helper as h
+import TraReader as tr
+import EventCache as ec
+
+#Selected events, set in every process before the scan
+Shared = {}
+
+#Change of 2 log L covering 68% for two parameters
+OneSigma = 2.30
+
+################################################################################
+
+def positionGrid(Center, Extent, Points):
+    axes = [np.linspace(c - e/2, c + e/2, n) if n > 1 else np.array([float(c)]) for c, e, n in zip(Center, Extent, Points)]
+    mesh = np.meshgrid(*axes, indexing="ij")
+    return np.column_stack([m.ravel() for m in mesh]), axes
+
+#Unit vectors towards theta (from +z) and phi (from +x) [deg], and the two axes
+def skyGrid(Theta, Phi, Points):
+    axes = [np.linspace(Theta[0], Theta[1], Points[0]), np.linspace(Phi[0], Phi[1], Points[1])]
+    theta, phi = np.meshgrid(np.radians(axes[0]), np.radians(axes[1]), indexing="ij")
+    return np.column_stack(((np.sin(theta)*np.cos(phi)).ravel(), (np.sin(theta)*np.sin(phi)).ravel(), np.cos(theta).ravel())), axes
+
+#Compton events of all files in any of the energy windows, as C1, Dg and phi [deg]
+def loadEvents(TraFiles, Windows, MaxEvents=None, Processes=None):
+    found = []
+    for TraFile in TraFiles:
+        for Events in ec.readWindows(TraFile, Windows, tr.c_Compton, MaxEvents=MaxEvents, Processes=Processes):
+            good = np.isfinite(Events["phi"]) & np.isfinite(Events["Dg"]).all(axis=1)
+            found.append((Events["C1"][good], Events["Dg"][good], np.degrees(Events["phi"][good])))
+    if not found:
+        return np.zeros((0, 3)), np.zeros((0, 3)), np.zeros(0)
+    return tuple(np.concatenate(column) for column in zip(*found))
+
+def share(C1, Dg, Phi):
+    Shared["C1"], Shared["Dg"], Shared["phi"] = C1, Dg, Phi
+
+#ARM [deg] of events (n) at candidates (m) as an (n, m) array. For positions the distance from C1 to the
+#candidate is expanded, so everything is a matrix product: |P - C1|^2 = |P|^2 - 2 P.C1 + |C1|^2.
+#All steps work in place, since the blocks are too large to allocate again for every step.
+def armBlock(C1, Dg, Phi, Candidates, Sky):
+    cosine = Dg @ Candidates.T
+    if not Sky:
+        cosine -= (C1*Dg).sum(axis=1)[:, None]
+        distance = C1 @ Candidates.T
+        distance *= -2
+        distance += (Candidates*Candidates).sum(axis=1)[None, :]
+        distance += (C1*C1).sum(axis=1)[:, None]
+        np.maximum(distance, 1e-12, out=distance)
+        np.sqrt(distance, out=distance)
+        cosine /= distance
+    np.negative(cosine, out=cosine)
+    np.clip(cosine, -1, 1, out=cosine)
+    np.arccos(cosine, out=cosine)
+    cosine *= 180/np.pi
+    cosine -= Phi[:, None]
+    return cosine
+
+#Backprojection and ARM histograms of the candidates Job = (Candidates, Settings), going through the events in
+#blocks of about Settings["block"] pairs
+def scanCandidates(Job):
+    Candidates, Settings = Job
+    C1, Dg, Phi = Shared["C1"], Shared["Dg"], Shared["phi"]
+    width, extent, bins = Settings["width"], Settings["range"], Settings["bins"]
+    m = len(Candidates)
+    counts = np.zeros(m)
+    histograms = np.zeros(m*bins)
+    step = max(Settings["block"]//max(m, 1), 1)
+    offsets = np.arange(m)*bins
+    for start in range(0, len(Phi), step):
+        arm = armBlock(C1[start:start+step], Dg[start:start+step], Phi[start:start+step], Candidates, Settings["sky"])
+        counts += (np.abs(arm) <= width).sum(axis=0)
+        arm += extent
+        arm *= bins/(2*extent)
+        column = arm.astype(np.int64)
+        column[arm < 0] = bins
+        inside = column < bins
+        column += offsets[None, :]
+        histograms += np.bincount(column[inside], minlength=m*bins)
+    return counts, histograms.reshape(m, bins)
+
+#Log-likelihood of the ARM values of every candidate, for the Gaussian of Width on a flat background with the
+#signal fraction Signal. It is summed over the bins of the histograms; all events outside of them are taken
+#to be background, which holds as long as Range is several Widths.
+def logLikelihood(Histograms, Events, Range, Width, Signal):
+    bins = Histograms.shape[1]
+    centers = -Range + (np.arange(bins) + 0.5)*(2*Range/bins)
+    background = (1 - Signal)/360.0
+    density = np.log(Signal/(np.sqrt(2*np.pi)*Width)*np.exp(-0.5*(centers/Width)**2) + background)
+    return Histograms @ density + (Events - Histograms.sum(axis=1))*np.log(background)
+
+#Evaluates all Candidates on Processes processes; the candidates are cut into about 4 jobs per process
+def scan(C1, Dg, Phi, Candidates, Sky=False, Width=3.0, Range=20.0, BinWidth=0.25, Signal=0.5, Block=1 << 18, Processes=None):
+    Settings = {"sky": Sky, "width": Width, "range": Range, "bins": int(round(2*Range/BinWidth)), "block": Block}
+    Processes = Processes or mp.cpu_count()
+    #Single precision is plenty for ARM bins of a fraction of a degree and twice as fast; positions are taken
+    #relative to the middle of the grid first so they stay small
+    origin = np.zeros(3) if Sky else Candidates.mean(axis=0)
+    C1, Dg, Phi = (C1 - origin).astype(np.float32), Dg.astype(np.float32), Phi.astype(np.float32)
+    Candidates = (Candidates - origin).astype(np.float32)
+    chunks = np.array_split(Candidates, min(len(Candidates), 4*Processes)) if Processes > 1 else [Candidates]
+    jobs = [(chunk, Settings) for chunk in chunks]
+    share(C1, Dg, Phi)
+    if Processes == 1:
+        results = list(map(scanCandidates, jobs))
+    else:
+        #Forked workers see the events without copying them
+        with mp.get_context("fork").Pool(Processes, initializer=share, initargs=(C1, Dg, Phi)) as pool:
+            results = pool.map(scanCandidates, jobs, chunksize=1)
+    counts, histograms = (np.concatenate(column) for column in zip(*results))
+    loglikelihood = logLikelihood(histograms, len(Phi), Range, Width, Signal)
+    peak, _, fwhm = h.getPeakFWHMBatch(histograms, -Range, 2*Range/Settings["bins"])
+    return {"counts": counts, "loglikelihood": loglikelihood, "fwhm": fwhm, "peak": peak}
+
+#Position of the largest 2 log L between grid points, and its 1 sigma error, from the parabola through the best
+#candidate and its two neighbours along every axis. Axes at the edge of the grid, or with one point, are not refined.
+def refine(Values, Best, Axes):
+    position, sigma = [], []
+    for axis, (index, points) in enumerate(zip(Best, Axes)):
+        if index == 0 or index == len(points) - 1:
+            position.append(float(points[index]))
+            sigma.append(float("nan"))
+            continue
+        step = points[index + 1] - points[index]
+        below, above = list(Best), list(Best)
+        below[axis] -= 1
+        above[axis] += 1
+        center, low, high = 2*Values[tuple(Best)], 2*Values[tuple(below)], 2*Values[tuple(above)]
+        curvature = low + high - 2*center
+        if curvature >= 0:
+            position.append(float(points[index]))
+            sigma.append(float("nan"))
+            continue
+        position.append(float(points[index] + step*(low - high)/(2*curvature)))
+        sigma.append(float(abs(step)*np.sqrt(-2/curvature)))
+    return position, sigma
+
+#Best candidate by likelihood, its 1 sigma region, the likelihood-weighted mean and spread of the candidates, and
+#the refined position between grid points
+def bestFit(Candidates, Maps, Coordinates, Axes, Shape):
+    loglikelihood = Maps["loglikelihood"]
+    best = int(np.argmax(loglikelihood))
+    delta = 2*(loglikelihood[best] - loglikelihood)
+    region = delta <= OneSigma
+    weights = np.exp(-delta/2)
+    weights /= weights.sum()
+    mean = weights @ Coordinates
+    spread = np.sqrt(np.maximum(weights @ (Coordinates - mean)**2, 0))
+    refined, error = refine(loglikelihood.reshape(Shape), np.unravel_index(best, Shape), Axes)
+    return {"index": best, "candidate": Candidates[best].tolist(), "coordinates": Coordinates[best].tolist(),
+            "region_low": Coordinates[region].min(axis=0).tolist(), "region_high": Coordinates[region].max(axis=0).tolist(),
+            "region_points": int(region.sum()), "mean": mean.tolist(), "sigma": spread.tolist(), "refined": refined, "error": error,
+            "counts": float(Maps["counts"][best]), "fwhm": float(Maps["fwhm"][best]), "best_fwhm": Coordinates[int(np.argmin(np.where(Maps["fwhm"] > 0, Maps["fwhm"], np.inf)))].tolist()}
+
+################################################################################
+
+def render(FileName, Axes, Names, Maps, Shape, Fit):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    varying = [i for i, n in enumerate(Shape) if n > 1]
+    if len(varying) != 2:
+        print("INFO: Maps are only drawn for grids with two axes")
+        return
+    a, b = varying
+    figure, axes = plt.subplots(1, 3, figsize=(15, 4.5))
+    for axis, (name, label) in zip(axes, (("loglikelihood", "2 (log L - log L max)"), ("counts", "Cones within width"), ("fwhm", "ARM FWHM [deg]"))):
+        values = Maps[name].reshape(Shape).squeeze()
+        if name == "loglikelihood":
+            values = 2*(values - values.max())
+        image = axis.pcolormesh(Axes[b], Axes[a], values, shading="nearest")
+        figure.colorbar(image, ax=axis, label=label)
+        axis.plot(Fit["coordinates"][b], Fit["coordinates"][a], "r+", markersize=12)
+        if name == "loglikelihood":
+            axis.contour(Axes[b], Axes[a], values, levels=[-OneSigma], colors="white", linewidths=1)
+        axis.set_xlabel(Names[b])
+        axis.set_ylabel(Names[a])
+    figure.tight_layout()
+    figure.savefig(FileName)
+    plt.close(figure)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Localize a source by scanning the ARM of its Compton events over a grid of positions or sky directions.')
+    parser.add_argument('-f', '--filename', required=True, help='txt file with the paths of the tra files, one per line')
+    parser.add_argument('-e', '--energy', type=float, nargs='+', default=None, help='Line energies [keV]; events within +-1.5% are used. Defaults to the lines of the isotope, or 662.')
+    parser.add_argument('-i', '--isotope', type=str, default='none', help='Isotope whose lines from the line catalog in Helper.py are used')
+    parser.add_argument('-m', '--maxevents', type=int, default=1000001, help='Events read per tra file')
+    parser.add_argument('-x', '--xcoordinate', type=float, default=26.1, help='X coordinate of the center of the position grid [cm]')
+    parser.add_argument('-y', '--ycoordinate', type=float, default=0.3, help='Y coordinate of the center of the position grid [cm]')
+    parser.add_argument('-z', '--zcoordinate', type=float, default=64.0, help='Z coordinate of the center of the position grid [cm]')
+    parser.add_argument('--extent', type=float, nargs=3, default=[40.0, 40.0, 0.0], help='Size of the position grid in x, y and z [cm]')
+    parser.add_argument('--sky', action='store_true', help='Scan sky directions (theta, phi) instead of positions')
+    parser.add_argument('--theta', type=float, nargs=2, default=[0.0, 90.0], help='Range of theta of the sky grid, from +z [deg]')
+    parser.add_argument('--phi', type=float, nargs=2, default=[-180.0, 180.0], help='Range of phi of the sky grid, from +x [deg]')
+    parser.add_argument('--points', type=int, nargs='+', default=None, help='Points per axis: nx ny nz (default 100 100 1), or ntheta nphi with --sky (default 100 100)')
+    parser.add_argument('-w', '--width', type=float, default=3.0, help='ARM width of the backprojection and of the Gaussian in the likelihood [deg]')
+    parser.add_argument('--range', type=float, default=20.0, help='ARM range of the histograms the FWHM map is taken from [deg]')
+    parser.add_argument('--signal', type=float, default=0.5, help='Fraction of the events from the source in the likelihood')
+    parser.add_argument('--block', type=int, default=1 << 18, help='Events x candidates evaluated at once')
+    parser.add_argument('-j', '--processes', type=int, default=0, help='Number of processes (default: all cores)')
+    parser.add_argument('-o', '--output', type=str, default='Localization', help='Prefix of the maps (.npz) and their plot (.png)')
+    args = parser.parse_args()
+
+    if args.energy:
+        energies = args.energy
+    elif args.isotope in h.LineCatalog:
+        energies = h.LineCatalog[args.isotope]
+    elif args.isotope != 'none':
+        print("ERROR: Unknown isotope " + args.isotope + " - pass its lines with -e")
+        quit()
+    else:
+        energies = [662.0]
+
+    if args.sky:
+        Shape = tuple(args.points or [100, 100])
+        Candidates, Axes = skyGrid(args.theta, args.phi, Shape)
+        Names = ["theta [deg]", "phi [deg]"]
+    else:
+        Shape = tuple(args.points or [100, 100, 1])
+        Candidates, Axes = positionGrid((args.xcoordinate, args.ycoordinate, args.zcoordinate), args.extent, Shape)
+        Names = ["x [cm]", "y [cm]", "z [cm]"]
+    if len(Shape) != len(Names):
+        print("ERROR: --points needs {} numbers".format(len(Names)))
+        quit()
+    Coordinates = np.column_stack([m.ravel() for m in np.meshgrid(*Axes, indexing="ij")])
+
+    Start = time.time()
+    C1, Dg, Phi = loadEvents(tr.readFileList(args.filename), [(0.985*energy, 1.015*energy) for energy in energies], args.maxevents, args.processes or None)
+    print("INFO: {} Compton events in the lines {} keV, read in {:.1f} s".format(len(Phi), ", ".join(str(energy) for energy in energies), time.time() - Start))
+    if len(Phi) == 0:
+        quit()
+
+    Start = time.time()
+    Maps = scan(C1, Dg, Phi, Candidates, args.sky, args.width, args.range, Signal=args.signal, Block=args.block, Processes=args.processes or None)
+    print("INFO: Scanned {} candidates in {:.1f} s".format(len(Candidates), time.time() - Start))
+
+    Fit = bestFit(Candidates, Maps, Coordinates, Axes, Shape)
+    print("Best fit: " + ", ".join("{} = {:.2f}".format(name, value) for name, value in zip(Names, Fit["coordinates"])))
+    print("1 sigma region ({} points): ".format(Fit["region_points"]) + ", ".join("{} in [{:.2f}, {:.2f}]".format(name, low, high)
+                                                                                  for name, low, high in zip(Names, Fit["region_low"], Fit["region_high"])))
+    print("Weighted by likelihood: " + ", ".join("{} = {:.2f} +- {:.2f}".format(name, mean, sigma) for name, mean, sigma in zip(Names, Fit["mean"], Fit["sigma"])))
+    print("Refined between grid points: " + ", ".join("{} = {:.2f} +- {:.2f}".format(name, value, error) for name, value, error, n in zip(Names, Fit["refined"], Fit["error"], Shape) if n > 1))
+    print("Cones within {} deg: {:.0f}, ARM FWHM there: {:.2f} deg; narrowest ARM at {}".format(args.width, Fit["counts"], Fit["fwhm"],
+                                                                                               ", ".join("{:.2f}".format(v) for v in Fit["best_fwhm"])))
+    np.savez_compressed(args.output + ".npz", candidates=Candidates, coordinates=Coordinates, shape=np.array(Shape), best=np.array(Fit["coordinates"]),
+                        refined=np.array(Fit["refined"]), error=np.array(Fit["error"]),
+                        **{name: values.reshape(Shape) for name, values in Maps.items()})
+    print("INFO: Wrote " + args.output + ".npz")
+    try:
+        render(args.output + ".png", Axes, Names, Maps, Shape, Fit)
+        print("INFO: Wrote " + args.output + ".png")
+    except ImportError:
+        print("INFO: matplotlib is not installed, not drawing the maps")
@@ -0,0 +1,204 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#SQLite store of the results of the analysis jobs, replacing the tab-separated <training>.log.txt files.
+#Every job adds one row to jobs (timings and event counts from Instrumentation.Stats) and one row per
+#value to results, labelled with run, isotope, line, description (training), algorithm, bin and metric.
+#A job run again with the same labels replaces its old values, so there are no duplicate rows.
+#
+#Many jobs can write to the same database at once: each job writes in one transaction which takes the
+#write lock up front, and waits up to Timeout seconds for other writers. The rollback journal is kept
+#instead of WAL since the data directories live on network file systems.
+#
+#Usage: python3 MetricsStore.py query -d Metrics.db -i Co60 -p "RFTests_%" -M FWHM
+#       python3 MetricsStore.py aggregate -d Metrics.db --by description algorithm -M FWHM
+#       python3 MetricsStore.py jobs -d Metrics.db
+
+import argparse
+import json
+import math
+import os
+import random
+import sqlite3
+import time
+
+DefaultDatabase = "Metrics.db"
+SchemaVersion = 1
+
+Schema = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    job TEXT NOT NULL,
+    host TEXT,
+    pid INTEGER,
+    argv TEXT,
+    started REAL,
+    wall REAL,
+    cpu REAL,
+    events_read INTEGER,
+    events_selected INTEGER,
+    stats TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    id INTEGER PRIMARY KEY,
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    run TEXT NOT NULL,
+    isotope TEXT NOT NULL,
+    line REAL NOT NULL,
+    description TEXT NOT NULL,
+    algorithm TEXT NOT NULL,
+    bin TEXT NOT NULL DEFAULT '',
+    metric TEXT NOT NULL,
+    value REAL,
+    error REAL,
+    entries INTEGER,
+    tra TEXT,
+    UNIQUE (run, isotope, line, description, algorithm, bin, metric)
+);
+CREATE INDEX IF NOT EXISTS results_by_description ON results (description, metric, algorithm);
+CREATE INDEX IF NOT EXISTS results_by_isotope ON results (isotope, line, metric);
+CREATE INDEX IF NOT EXISTS results_by_job ON results (job_id);
+CREATE INDEX IF NOT EXISTS jobs_by_started ON jobs (started);
+"""
+
+#Labels used in the plots for the tra files of a job, in the order of the file list
+Methods = ["Classic", "Bayes", "MLP", "RF"]
+Algorithms = ["Classic", "Bayes", "MLP", "RF", "BDTD"]
+
+#Algorithm of a tra file from its name (<run>.<algorithm>[.<description>].tra.gz), else by its place in the list
+def algorithmName(TraFile, Index):
+    for part in os.path.basename(TraFile).split("."):
+        if part in Algorithms:
+            return part
+    return Methods[Index] if Index < len(Methods) else "method" + str(Index)
+
+################################################################################
+
+class MetricsStore:
+    def __init__(self, FileName=DefaultDatabase, Timeout=600):
+        self.FileName = FileName
+        self.Timeout = Timeout
+
+    def connect(self):
+        connection = sqlite3.connect(self.FileName, timeout=self.Timeout, isolation_level=None)
+        connection.row_factory = sqlite3.Row
+        #Not every SQLite build has the math functions
+        connection.create_function("SQRT", 1, lambda x: None if x is None else math.sqrt(x), deterministic=True)
+        return connection
+
+    #Runs Function(connection) in one write transaction, trying again while the database is locked
+    def write(self, Function):
+        deadline = time.time() + self.Timeout
+        while True:
+            connection = self.connect()
+            try:
+                if connection.execute("PRAGMA user_version").fetchone()[0] != SchemaVersion:
+                    connection.executescript(Schema + "PRAGMA user_version = {};".format(SchemaVersion))
+                connection.execute("BEGIN IMMEDIATE")
+                result = Function(connection)
+                connection.execute("COMMIT")
+                return result
+            except sqlite3.OperationalError as e:
+                if connection.in_transaction:
+                    connection.execute("ROLLBACK")
+                if "locked" not in str(e) and "busy" not in str(e) or time.time() > deadline:
+                    raise
+                time.sleep(random.uniform(0.05, 0.5))
+            finally:
+                connection.close()
+
+    #Adds a job from its Instrumentation.Stats record and its result rows. Every row is a dict with
+    #run, isotope, line, description, algorithm, metric, value and optionally bin, error, entries and tra.
+    def record(self, Record, Rows):
+        def insert(connection):
+            counters = Record.get("counters", {})
+            job_id = connection.execute("INSERT INTO jobs (job, host, pid, argv, started, wall, cpu, events_read, events_selected, stats) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                        (Record["job"], Record.get("host"), Record.get("pid"), json.dumps(Record.get("argv")), Record.get("started"),
+                                         Record.get("wall"), Record.get("cpu"), counters.get("events_read"), counters.get("in_energy_window"),
+                                         json.dumps({"stages": Record.get("stages"), "counters": counters, "labels": Record.get("labels")}))).lastrowid
+            connection.executemany("""INSERT INTO results (job_id, run, isotope, line, description, algorithm, bin, metric, value, error, entries, tra)
+                                      VALUES (:job_id, :run, :isotope, :line, :description, :algorithm, :bin, :metric, :value, :error, :entries, :tra)
+                                      ON CONFLICT (run, isotope, line, description, algorithm, bin, metric) DO UPDATE SET
+                                      job_id = excluded.job_id, value = excluded.value, error = excluded.error, entries = excluded.entries, tra = excluded.tra""",
+                                   [dict({"bin": "", "error": None, "entries": None, "tra": None}, job_id=job_id, **row) for row in Rows])
+            return job_id
+        return self.write(insert)
+
+    def read(self, Query, Parameters=()):
+        if not os.path.exists(self.FileName):
+            return []
+        connection = self.connect()
+        try:
+            return [dict(row) for row in connection.execute(Query, Parameters)]
+        finally:
+            connection.close()
+
+    #Results matching the given labels; description and algorithm may contain % wildcards
+    def query(self, Metric=None, **Labels):
+        where, parameters = filters(Metric, Labels)
+        return self.read("SELECT run, isotope, line, description, algorithm, bin, metric, value, error, entries FROM results" + where +
+                         " ORDER BY isotope, line, description, run, algorithm, bin, metric", parameters)
+
+    #Count, mean, spread, minimum and maximum of the values of Metric grouped by the columns By
+    def aggregate(self, By, Metric, **Labels):
+        columns = [column for column in By if column in ("run", "isotope", "line", "description", "algorithm", "bin", "metric")]
+        if len(columns) != len(By):
+            raise ValueError("Cannot group by " + ", ".join(set(By) - set(columns)))
+        where, parameters = filters(Metric, Labels)
+        group = ", ".join(columns)
+        return self.read("SELECT " + group + ", COUNT(*) AS n, AVG(value) AS mean, SQRT(MAX(AVG(value*value) - AVG(value)*AVG(value), 0)) AS spread, " +
+                         "MIN(value) AS min, MAX(value) AS max, SQRT(SUM(error*error))/COUNT(error) AS error_of_mean FROM results" + where +
+                         " GROUP BY " + group + " ORDER BY mean", parameters)
+
+    def jobs(self, Last=20):
+        return self.read("SELECT id, job, host, started, wall, cpu, events_read, events_selected, (SELECT COUNT(*) FROM results WHERE job_id = jobs.id) AS results " +
+                         "FROM jobs ORDER BY started DESC LIMIT ?", (Last,))
+
+def filters(Metric, Labels):
+    conditions, parameters = [], []
+    if Metric:
+        conditions.append("metric = ?")
+        parameters.append(Metric)
+    for column, value in Labels.items():
+        if value is None:
+            continue
+        if column == "line":
+            conditions.append("ABS(line - ?) < 0.01")
+        elif column in ("description", "algorithm", "run"):
+            conditions.append(column + " LIKE ?")
+        else:
+            conditions.append(column + " = ?")
+        parameters.append(value)
+    return (" WHERE " + " AND ".join(conditions) if conditions else ""), parameters
+
+def printTable(Rows):
+    if not Rows:
+        print("No results")
+        return
+    print("\t".join(Rows[0]))
+    for row in Rows:
+        print("\t".join("" if value is None else "{:.4g}".format(value) if isinstance(value, float) else str(value) for value in row.values()))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Query the results of the analysis jobs.')
+    parser.add_argument('command', choices=['query', 'aggregate', 'jobs'], help='list results, aggregate them, or list the last jobs')
+    parser.add_argument('-d', '--database', type=str, default=DefaultDatabase, help='SQLite file of the results')
+    parser.add_argument('-r', '--run', type=str, default=None, help='Run (% wildcards allowed)')
+    parser.add_argument('-i', '--isotope', type=str, default=None, help='Isotope')
+    parser.add_argument('-e', '--line', type=float, default=None, help='Line energy in keV')
+    parser.add_argument('-p', '--description', type=str, default=None, help='Description or training (% wildcards allowed)')
+    parser.add_argument('-a', '--algorithm', type=str, default=None, help='Algorithm (% wildcards allowed)')
+    parser.add_argument('-M', '--metric', type=str, default=None, help='Metric, e.g. FWHM, RMS or Peak')
+    parser.add_argument('--by', type=str, nargs='+', default=['description', 'algorithm'], help='Columns to aggregate by')
+    parser.add_argument('-n', '--last', type=int, default=20, help='Number of jobs to list')
+    args = parser.parse_args()
+
+    Store = MetricsStore(args.database)
+    Labels = {"run": args.run, "isotope": args.isotope, "line": args.line, "description": args.description, "algorithm": args.algorithm}
+    if args.command == 'query':
+        printTable(Store.query(args.metric, **Labels))
+    elif args.command == 'aggregate':
+        printTable(Store.aggregate(args.by, args.metric or "FWHM", **Labels))
+    else:
+        printTable(Store.jobs(args.last))
@@ -0,0 +1,344 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Dependency-graph runner for the ER pipeline: nuclearizer (per run) -> revan (per run, algorithm and
+#description) -> ARMoutput.py (per run and description, all lines of the isotope). Every task starts as
+#soon as the tasks it depends on are done and its input files exist, within a budget of cores and memory,
+#instead of waiting for the slowest job of the previous stage. A task is skipped if its command and the
+#content hashes of its inputs and outputs are unchanged since it last succeeded. Tasks whose inputs are
+#missing (e.g. a TMVA file) are reported with everything that depends on them. At the end the timing of
+#every task and the critical path are printed and written to Pipeline.report.json.
+#
+#Usage: python3 Pipeline.py -o /volumes/selene/COSI_2016/ER/Data -d Data --cores 32 --memory 64
+
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import EventCache as ec
+import Helper as h
+
+ScriptPath = os.path.dirname(os.path.abspath(__file__))
+
+#Memory estimate of one task of each stage in GB
+TaskMemory = {"nuclearizer": 2.0, "revan": 2.0, "arm": 2.0}
+
+################################################################################
+
+class Task:
+    def __init__(self, Name, Stage, Command, Inputs=(), Outputs=(), After=(), Directory=".", Log=None, Memory=1.0, Moves=(), Prepare=None):
+        self.Name = Name
+        self.Stage = Stage
+        self.Command = [str(c) for c in Command]
+        self.Inputs = list(Inputs)
+        self.Outputs = list(Outputs)
+        self.After = list(After)
+        self.Directory = Directory
+        self.Log = Log
+        self.Memory = Memory
+        #Files renamed after the command succeeded, (from, to)
+        self.Moves = list(Moves)
+        #Called right before the command runs, e.g. to set up a working directory
+        self.Prepare = Prepare
+        self.Status = "pending"
+        self.Reason = ""
+        self.Start = None
+        self.End = None
+        self.Process = None
+
+    def duration(self):
+        return self.End - self.Start if self.Start is not None and self.End is not None else 0.0
+
+class Runner:
+    def __init__(self, Tasks, Cores, Memory, StateFile, DryRun=False):
+        self.Tasks = {task.Name: task for task in Tasks}
+        self.Cores = Cores
+        self.Memory = Memory
+        self.StateFile = os.path.abspath(StateFile)
+        self.State = ec.readJSON(self.StateFile, {})
+        self.DryRun = DryRun
+        os.makedirs(os.path.dirname(self.StateFile), exist_ok=True)
+        #Such a task still runs, but only once nothing else is running
+        for task in Tasks:
+            if task.Memory > Memory:
+                print("WARNING: {} needs {:g} GB, more than the memory budget of {:g} GB; it will run alone".format(task.Name, task.Memory, Memory))
+
+    def hash(self, FileName):
+        return ec.contentHash(FileName)
+
+    #Hash of the command and the content of all inputs
+    def signature(self, Task):
+        digest = hashlib.sha256(json.dumps(Task.Command).encode())
+        for FileName in Task.Inputs:
+            digest.update((FileName + ":" + self.hash(FileName) + ";").encode())
+        return digest.hexdigest()
+
+    def upToDate(self, Task):
+        saved = self.State.get(Task.Name)
+        if saved is None or saved["signature"] != self.signature(Task):
+            return False
+        for FileName in Task.Outputs:
+            if not os.path.exists(FileName) or saved["outputs"].get(FileName) != self.hash(FileName):
+                return False
+        return True
+
+    def launch(self, Task):
+        print("INFO: Starting " + Task.Name + ": " + " ".join(Task.Command))
+        Task.Start = time.time()
+        if self.DryRun:
+            Task.Status = "running"
+            return
+        if Task.Prepare:
+            Task.Prepare()
+        log = open(Task.Log, "w") if Task.Log else subprocess.DEVNULL
+        Task.Process = subprocess.Popen(Task.Command, cwd=Task.Directory, stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+        if Task.Log:
+            log.close()
+        Task.Status = "running"
+
+    def finish(self, Task, Code):
+        Task.End = time.time()
+        if Code != 0:
+            Task.Status, Task.Reason = "failed", "exit code " + str(Code)
+            print("ERROR: " + Task.Name + " failed with exit code " + str(Code) + (", see " + Task.Log if Task.Log else ""))
+            return
+        if not self.DryRun:
+            for source, target in Task.Moves:
+                if os.path.exists(source):
+                    os.replace(source, target)
+            missing = [FileName for FileName in Task.Outputs if not os.path.exists(FileName)]
+            if missing:
+                Task.Status, Task.Reason = "failed", "did not create " + ", ".join(missing)
+                print("ERROR: " + Task.Name + " did not create " + ", ".join(missing))
+                return
+            self.State[Task.Name] = {"signature": self.signature(Task), "outputs": {FileName: self.hash(FileName) for FileName in Task.Outputs}}
+            ec.writeJSON(self.StateFile, self.State)
+        Task.Status = "done"
+        print("INFO: Finished " + Task.Name + " in {:.1f} s".format(Task.duration()))
+
+    def run(self):
+        self.Started = time.time()
+        pending = list(self.Tasks.values())
+        running = []
+        while pending or running:
+            for task in list(pending):
+                before = [self.Tasks[name] for name in task.After]
+                blocked = [t for t in before if t.Status in ("failed", "skipped")]
+                if blocked:
+                    task.Status, task.Reason = "skipped", "needs " + blocked[0].Name
+                elif all(t.Status in ("done", "cached") for t in before):
+                    missing = [FileName for FileName in task.Inputs if not os.path.exists(FileName)]
+                    if missing and not self.DryRun:
+                        task.Status, task.Reason = "skipped", "missing input " + missing[0]
+                        print("ERROR: Skipping " + task.Name + ": input does not exist: " + missing[0])
+                    elif not self.DryRun and self.upToDate(task):
+                        task.Status, task.Reason = "cached", "up to date"
+                        print("INFO: " + task.Name + " is up to date")
+                    elif not running or (len(running) < self.Cores and task.Memory + sum(t.Memory for t in running) <= self.Memory):
+                        self.launch(task)
+                        running.append(task)
+                    else:
+                        continue
+                else:
+                    continue
+                pending.remove(task)
+
+            for task in list(running):
+                code = 0 if self.DryRun else task.Process.poll()
+                if code is not None:
+                    self.finish(task, code)
+                    running.remove(task)
+            if running:
+                time.sleep(0.2)
+        return self.report()
+
+    #Longest chain of dependent tasks by wall time, which bounds the run time of the pipeline.
+    #Tasks are created after the tasks they depend on, so one pass in that order is enough.
+    def criticalPath(self):
+        length, previous = {}, {}
+        for task in self.Tasks.values():
+            best = max(task.After, key=lambda name: length[name], default=None)
+            previous[task.Name] = best
+            length[task.Name] = task.duration() + (length[best] if best else 0.0)
+        if not length:
+            return [], 0.0
+        name = max(length, key=length.get)
+        total = length[name]
+        path = []
+        while name:
+            path.append(name)
+            name = previous[name]
+        return path[::-1], total
+
+    def report(self):
+        path, total = self.criticalPath()
+        tasks = [{"task": t.Name, "stage": t.Stage, "status": t.Status, "reason": t.Reason,
+                  "start": None if t.Start is None else round(t.Start - self.Started, 2), "wall": round(t.duration(), 2)}
+                 for t in self.Tasks.values()]
+        print("\nTask\tStatus\tStart [s]\tWall [s]")
+        for t in tasks:
+            print("{}\t{}{}\t{}\t{}".format(t["task"], t["status"], " (" + t["reason"] + ")" if t["reason"] else "",
+                                          "-" if t["start"] is None else t["start"], t["wall"]))
+        print("\nCritical path ({:.1f} s): ".format(total) + " -> ".join(path))
+        print("Total wall time: {:.1f} s".format(time.time() - self.Started))
+        return {"tasks": tasks, "critical_path": path, "critical_path_wall": round(total, 2), "wall": round(time.time() - self.Started, 2)}
+
+################################################################################
+
+#Lines of DataSets.txt containing Run (like grep): isotope in the 2nd column, position in the 4th to 6th
+def dataSet(DataSets, Run):
+    with open(DataSets, "r") as f:
+        for line in f:
+            columns = line.split()
+            if Run in line and len(columns) >= 6:
+                return {"isotope": columns[1], "x": columns[3], "y": columns[4], "z": columns[5]}
+    return None
+
+def findRuns(Origin):
+    runs = {}
+    for FileName in sorted(glob.glob(os.path.join(Origin, "*"))):
+        for extension in (".roa.gz", ".roa", ".sim.gz", ".sim"):
+            if FileName.endswith(extension):
+                runs[os.path.basename(FileName)[:-len(extension)]] = FileName
+                break
+    return runs
+
+def writeList(FileName, Lines):
+    content = "".join(line + "\n" for line in Lines)
+    if not os.path.exists(FileName) or open(FileName).read() != content:
+        with open(FileName, "w") as f:
+            f.write(content)
+
+#Plots ARMoutput.py writes in batch mode, one per line of the isotope (like ARMoutput.py, 662 keV without an isotope),
+#with the training description in the name if there is one
+def armOutputs(Data, Run, Isotope, Description=None):
+    energies = h.LineCatalog.get(Isotope, [662.0] if Isotope == "none" else [])
+    name = Isotope + ("_" + Description if Description else "")
+    return [os.path.join(Data, "Results_{}_{}_{}keV.pdf".format(Run, name, energy)) for energy in energies]
+
+#Revan writes <run>.tra.gz next to its input, so every revan task gets its own directory
+def revanDirectory(Directory, Files):
+    def prepare():
+        os.makedirs(Directory, exist_ok=True)
+        for FileName in Files:
+            link = os.path.join(Directory, os.path.basename(FileName))
+            if os.path.lexists(link):
+                os.remove(link)
+            os.symlink(os.path.abspath(FileName), link)
+    return prepare
+
+def buildTasks(args, Data):
+    runs = findRuns(args.origin)
+    print("Runs: " + " ".join(runs))
+    descriptions = args.descriptions or [None]
+    tasks = []
+    for run, source in runs.items():
+        evta = os.path.join(Data, run + ".evta.gz")
+        command = ["nuclearizer", "-a", "-g", args.geometry, "-c", "Nuclearizer_ER_Data.cfg",
+                   "-C", "ModuleOptions.XmlTagMeasurementLoaderROA.FileName=" + source,
+                   "-C", "ModuleOptions.XmlTagEventSaver.FileName=" + evta,
+                   "-C", "ModuleOptions.XmlTagSimulationLoader.UseStopAfter=True",
+                   "-C", "ModuleOptions.XmlTagSimulationLoader.MaximumAcceptedEvents=" + str(args.maxevents)]
+        if args.nuclearizer_timeout > 0:
+            command = ["timeout", str(args.nuclearizer_timeout)] + command
+        tasks.append(Task("nuclearizer." + run, "nuclearizer", command, [source, os.path.join(Data, "Nuclearizer_ER_Data.cfg")], [evta],
+                          Directory=Data, Log=os.path.join(Data, run + ".nuclearizer.log"), Memory=TaskMemory["nuclearizer"]))
+
+        isotope = run.split(".")[1] if "." in run else ""
+        position = dataSet(os.path.join(args.origin, "DataSets.txt"), run) if os.path.exists(os.path.join(args.origin, "DataSets.txt")) else None
+        if position is None:
+            print("ERROR: " + run + " is not in " + os.path.join(args.origin, "DataSets.txt") + ", no ARM output for it")
+
+        for description in descriptions:
+            tag = run + ("." + description if description else "")
+            tra_files, revan_tasks = [], []
+            for algorithm in args.algorithms:
+                name = tag.replace(run, run + "." + algorithm, 1)
+                config = os.path.join(Data, "Revan_ER_" + algorithm + ".cfg")
+                directory = os.path.join(Data, "revan", name)
+                command = ["revan", "-a", "-n", "-c", config, "-g", args.geometry, "-f", run + ".evta.gz"]
+                inputs = [evta, config]
+                if algorithm in ("MLP", "BDTD", "RF"):
+                    tmva = os.path.join(args.tmva, isotope, "AllSky", (description or "ComptonTMVA.v2") + ".tmva")
+                    weights = os.path.join(args.tmva, isotope, "AllSky", description or "ComptonTMVA.v2", "N2", "weights", "TMVAClassification_" + algorithm + ".weights.xml")
+                    command += ["-C", "CSRTMVAFile=" + tmva, "-C", "CSRTMVAMethods=" + algorithm]
+                    inputs += [tmva, weights]
+                elif algorithm not in ("Classic", "Bayes"):
+                    print("ERROR: Unknown algorithm: " + algorithm)
+                    continue
+                tra = os.path.join(Data, name + ".tra.gz")
+                tasks.append(Task("revan." + name, "revan", command, inputs, [tra], After=["nuclearizer." + run], Directory=directory,
+                                  Log=os.path.join(Data, run + ".revan." + algorithm + ("." + description if description else "") + ".log"), Memory=TaskMemory["revan"],
+                                  Moves=[(os.path.join(directory, run + ".tra.gz"), tra)], Prepare=revanDirectory(directory, [evta])))
+                tra_files.append(tra)
+                revan_tasks.append("revan." + name)
+
+            if position is None:
+                continue
+            list_file = os.path.join(Data, tag + ".txt")
+            writeList(list_file, [os.path.basename(f) for f in tra_files])
+            command = [sys.executable, os.path.join(ScriptPath, "ARMWorker.py" if args.worker else "ARMoutput.py")] + (["submit", "--"] if args.worker else [])
+            command += ["-f", tag + ".txt", "-m", str(args.minevents), "-x", position["x"], "-y", position["y"], "-z", position["z"],
+                        "-l", args.logarithmic, "-b", "yes", "-r", run, "-i", position["isotope"]]
+            if description:
+                command += ["-p", description]
+            tasks.append(Task("arm." + tag, "arm", command, [list_file] + tra_files, armOutputs(Data, run, position["isotope"], description),
+                              After=revan_tasks, Directory=Data,
+                              Log=os.path.join(Data, "ARM." + tag + ".log"), Memory=TaskMemory["arm"]))
+    return tasks
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run nuclearizer, revan and the ARM analysis for all runs as a dependency graph.')
+    parser.add_argument('-m', '--minevents', type=int, default=100000, help='Minimum number of events to use')
+    parser.add_argument('-l', '--logarithmic', type=str, default='no', help='Displays ARM plot on logarithmic scale')
+    parser.add_argument('-d', '--data', type=str, default='Data', help='Destination of the output')
+    parser.add_argument('-o', '--origin', type=str, default='/volumes/selene/COSI_2016/ER/Data', help='Origin of COSI data (roa or sim files and DataSets.txt)')
+    parser.add_argument('-t', '--tmva', type=str, default=None, help='Origin of TMVA data (default: <origin>/../Sims)')
+    parser.add_argument('-n', '--maxevents', type=int, default=100000, help='Maximum number of events to use')
+    parser.add_argument('-c', '--cfg', type=str, default=None, help='Origin of configuration files (default: <origin>/../Pipeline)')
+    parser.add_argument('-g', '--geometry', type=str, default='/home/andreas/Science/Software/Nuclearizer/MassModel/COSI.DetectorHead.geo.setup', help='Geometry setup file')
+    parser.add_argument('-a', '--algorithms', type=str, nargs='+', default=['BDTD'], help='Event reconstruction algorithms for revan')
+    parser.add_argument('--descriptions', type=str, nargs='*', default=[], help='TMVA training descriptions; without any, one revan run per algorithm with ComptonTMVA.v2')
+    parser.add_argument('--cores', type=int, default=os.cpu_count() or 1, help='Number of tasks running at the same time')
+    parser.add_argument('--memory', type=float, default=None, help='Memory budget in GB (default: physical memory)')
+    parser.add_argument('--nuclearizer-timeout', type=int, default=10, help='Seconds after which nuclearizer is stopped, 0 for no limit')
+    parser.add_argument('--worker', action='store_true', help='Run the ARM jobs through ARMWorker.py')
+    parser.add_argument('--dry-run', action='store_true', help='Only print the tasks in the order they would start')
+    args = parser.parse_args()
+
+    args.origin = os.path.abspath(args.origin)
+    args.tmva = os.path.abspath(args.tmva or os.path.join(args.origin, "..", "Sims"))
+    args.cfg = os.path.abspath(args.cfg or os.path.join(args.origin, "..", "Pipeline"))
+    if args.memory is None:
+        args.memory = os.sysconf("SC_PAGE_SIZE")*os.sysconf("SC_PHYS_PAGES")/(1 << 30)
+
+    for directory, what in ((args.origin, "origin folder for data"), (args.cfg, "CFG folder"), (args.tmva, "TMVA folder")):
+        if not os.path.isdir(directory):
+            print("Error: The " + what + " does not exist: " + directory)
+            sys.exit(1)
+    if not args.dry_run:
+        for program in ("nuclearizer", "revan"):
+            if shutil.which(program) is None:
+                print("ERROR: " + program + " must be installed")
+                sys.exit(1)
+
+    Data = os.path.abspath(args.data)
+    os.makedirs(Data, exist_ok=True)
+    for config in glob.glob(os.path.join(args.cfg, "*.cfg")):
+        if not args.dry_run:
+            shutil.copy(config, Data)
+
+    if args.worker and not args.dry_run:
+        subprocess.call([sys.executable, os.path.join(ScriptPath, "ARMWorker.py"), "start", "--log", os.path.join(Data, "ARMWorker.log")])
+    Pipeline = Runner(buildTasks(args, Data), args.cores, args.memory, os.path.join(Data, ".pipeline", "state.json"), args.dry_run)
+    Report = Pipeline.run()
+    if args.worker and not args.dry_run:
+        subprocess.call([sys.executable, os.path.join(ScriptPath, "ARMWorker.py"), "stop"])
+    ec.writeJSON(os.path.join(Data, "Pipeline.report.json"), Report)
+    sys.exit(0 if all(t["status"] in ("done", "cached") for t in Report["tasks"]) else 1)
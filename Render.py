@@ -0,0 +1,180 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Render stage of the ARM comparison plots. A plot is saved as histogram arrays plus its legend table
+#(.plot.npz, written next to the PDF by the analysis scripts) and drawn with ROOT or with matplotlib,
+#so plots can be drawn again without the events, and many plots are drawn at once in a process pool:
+#
+#Usage: python3 Render.py -j 32 --backend matplotlib --format pdf png Data/*.plot.npz
+#
+#The legend has one row per histogram and as many as there are histograms; colors come from a palette
+#of ROOT colors, either the colors of the method comparison or evenly spaced around the color wheel.
+
+import argparse
+import io
+import json
+import multiprocessing as mp
+import os
+import tempfile
+import numpy as np
+import Helper as h
+import Histograms as hs
+
+#ROOT base colors with their RGB values
+RootColors = {"kBlack": "#000000", "kRed": "#ff0000", "kGreen": "#00ff00", "kBlue": "#0000ff", "kYellow": "#ffff00",
+              "kMagenta": "#ff00ff", "kCyan": "#00ffff", "kOrange": "#ff8000", "kSpring": "#80ff00", "kTeal": "#00ff80",
+              "kAzure": "#0080ff", "kViolet": "#8000ff", "kPink": "#ff0080"}
+ColorWheel = ["kRed", "kPink", "kMagenta", "kViolet", "kBlue", "kAzure", "kCyan", "kTeal", "kGreen", "kSpring", "kYellow", "kOrange"]
+Palettes = {"methods": ["kRed", "kGreen", "kBlue", "kBlack"], "wheel": ColorWheel}
+
+def colors(Palette, N):
+    if Palette == "wheel":
+        return [ColorWheel[int(i*len(ColorWheel)/max(N, len(ColorWheel)))] for i in range(N)] if N > len(ColorWheel) else ColorWheel[:N]
+    chosen = list(Palettes[Palette])
+    chosen += [c for c in ColorWheel if c not in chosen]
+    return [chosen[i % len(chosen)] for i in range(N)]
+
+################################################################################
+
+class Plot:
+    #Counts and Sums: one row per histogram as in Histograms.BinnedARM; Rows: legend cells of every histogram
+    def __init__(self, Title, Labels, Counts, Sums, Low, High, Header, Rows, Log=False, Palette="methods", XTitle="ARM [deg]"):
+        self.Title = Title
+        self.Labels = list(Labels)
+        self.Counts = np.asarray(Counts, dtype=np.float64)
+        self.Sums = np.asarray(Sums, dtype=np.float64)
+        self.Low = Low
+        self.High = High
+        self.Header = list(Header)
+        self.Rows = [[str(cell) for cell in row] for row in Rows]
+        self.Log = Log
+        self.Palette = Palette
+        self.XTitle = XTitle
+
+    def meta(self):
+        return {"title": self.Title, "labels": self.Labels, "low": self.Low, "high": self.High, "header": self.Header,
+                "rows": self.Rows, "log": self.Log, "palette": self.Palette, "xtitle": self.XTitle}
+
+def savePlot(FileName, Plot):
+    buffer = io.BytesIO()
+    np.savez_compressed(buffer, counts=Plot.Counts.astype(np.float32), sums=Plot.Sums, meta=np.array(json.dumps(Plot.meta())))
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(FileName)), suffix=".tmp")
+    with os.fdopen(handle, "wb") as f:
+        f.write(buffer.getvalue())
+    h.replaceShared(temporary, FileName)
+
+def loadPlot(FileName):
+    with np.load(FileName) as content:
+        meta = json.loads(str(content["meta"]))
+        return Plot(meta["title"], meta["labels"], content["counts"], content["sums"], meta["low"], meta["high"], meta["header"],
+                    meta["rows"], meta["log"], meta["palette"], meta["xtitle"])
+
+################################################################################
+
+#Draws Plot on a ROOT canvas; the returned objects have to be kept alive as long as the canvas is shown
+def drawROOT(Plot, Name="CanvasARM"):
+    import ROOT as M
+    binned = hs.BinnedARM(np.arange(len(Plot.Labels) + 1), Plot.Counts.shape[1], Plot.Low, Plot.High)
+    binned.Counts, binned.Sums = Plot.Counts, Plot.Sums
+    hists = [binned.toTH1(i, Name + " " + label, Plot.Title) for i, label in enumerate(Plot.Labels)]
+    for hist, color in zip(hists, colors(Plot.Palette, len(hists))):
+        hist.SetLineColor(getattr(M, color))
+        hist.SetMaximum(1.1*Plot.Counts.max())
+
+    canvas = M.TCanvas(Name, Plot.Title, 650, 800)
+    for hist in hists:
+        if Plot.Log:
+            M.gPad.SetLogy()
+        hist.Draw("same")
+    hists[0].SetTitle(Plot.Title)
+    hists[0].GetXaxis().SetTitle(Plot.XTitle)
+    hists[0].GetYaxis().SetTitle("Counts [logarithmic]" if Plot.Log else "Counts")
+    hists[0].GetXaxis().CenterTitle()
+    hists[0].GetYaxis().CenterTitle()
+    hists[0].GetYaxis().SetTitleOffset(1.7)
+    canvas.cd()
+    canvas.SetGridx()
+    canvas.SetBottomMargin(0.5)
+
+    header = M.TH1D(Name + " legend header", " ", 1, Plot.Low, Plot.High)
+    header.SetLineColor(M.kWhite)
+    legend = M.TLegend(0.15, 0.35, 0.85, 0.1)
+    legend.SetTextSize(0.017)
+    legend.SetNColumns(len(Plot.Header))
+    for column in Plot.Header:
+        legend.AddEntry(header, column, "l")
+    for hist, row in zip(hists, Plot.Rows):
+        for cell in row:
+            legend.AddEntry(hist, cell, "l")
+    legend.Draw()
+    canvas.Update()
+    return canvas, hists, header, legend
+
+def drawMatplotlib(Plot, FileNames):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    figure = plt.figure(figsize=(6.5, 8))
+    axis = figure.add_axes([0.14, 0.5, 0.8, 0.44])
+    edges = np.linspace(Plot.Low, Plot.High, Plot.Counts.shape[1] + 1)
+    palette = [RootColors[c] for c in colors(Plot.Palette, len(Plot.Labels))]
+    for counts, label, color in zip(Plot.Counts, Plot.Labels, palette):
+        axis.stairs(counts, edges, color=color, label=label)
+    if Plot.Log:
+        axis.set_yscale("log")
+    else:
+        axis.set_ylim(0, 1.1*max(Plot.Counts.max(), 1))
+    axis.set_xlim(Plot.Low, Plot.High)
+    axis.set_title(Plot.Title, fontsize=10)
+    axis.set_xlabel(Plot.XTitle)
+    axis.set_ylabel("Counts [logarithmic]" if Plot.Log else "Counts")
+    axis.grid(axis="x", alpha=0.4)
+
+    legend = figure.add_axes([0.06, 0.04, 0.88, 0.34])
+    legend.axis("off")
+    table = legend.table(cellText=Plot.Rows, colLabels=Plot.Header, loc="upper center", cellLoc="center")
+    table.auto_set_font_size(False)
+    table.set_fontsize(7)
+    for row, color in enumerate(palette):
+        table[row + 1, 0].get_text().set_color(color)
+    for FileName in FileNames:
+        figure.savefig(FileName)
+    plt.close(figure)
+
+def render(Plot, FileNames, Backend="root"):
+    if Backend == "matplotlib":
+        drawMatplotlib(Plot, FileNames)
+        return
+    import ROOT as M
+    M.gROOT.SetBatch(True)
+    canvas = drawROOT(Plot)[0]
+    for FileName in FileNames:
+        canvas.SaveAs(FileName)
+
+#Draws one saved plot into a file of every format next to it
+def renderFile(Job):
+    PlotFile, Formats, Backend = Job
+    stem = PlotFile[:-len(".plot.npz")] if PlotFile.endswith(".plot.npz") else os.path.splitext(PlotFile)[0]
+    outputs = [stem + "." + extension for extension in Formats]
+    render(loadPlot(PlotFile), outputs, Backend)
+    return outputs
+
+def renderFiles(PlotFiles, Formats=("pdf",), Backend="root", Processes=None):
+    jobs = [(PlotFile, list(Formats), Backend) for PlotFile in PlotFiles]
+    if Processes == 1 or len(jobs) <= 1:
+        return [renderFile(job) for job in jobs]
+    with mp.Pool(Processes or mp.cpu_count()) as pool:
+        return pool.map(renderFile, jobs, chunksize=1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Draw saved ARM plots (.plot.npz) with ROOT or matplotlib in parallel.')
+    parser.add_argument('plots', nargs='+', help='Plot files written by the analysis scripts')
+    parser.add_argument('--backend', choices=['root', 'matplotlib'], default='matplotlib', help='Library to draw with')
+    parser.add_argument('--format', type=str, nargs='+', default=['pdf'], help='Output formats, e.g. pdf png')
+    parser.add_argument('-j', '--processes', type=int, default=0, help='Number of processes (default: all cores)')
+    args = parser.parse_args()
+
+    for outputs in renderFiles(args.plots, args.format, args.backend, args.processes or None):
+        print("INFO: Wrote " + ", ".join(outputs))
@@ -0,0 +1,156 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Local cache of ARM results. One entry holds the ARM histogram of one tra file in one energy window
+#(bins and unbinned sums) with its FWHM, RMS, peak height and bootstrap errors. It is stored under a hash
+#of everything the result depends on: the content of the tra file, the source position, the energy
+#window, the binning, the number of events read, the bootstrap settings and the analysis code. A change
+#to any of them gives a new key, so only the entries it affects are computed again.
+#
+#The cache lives in $COSI_RESULT_CACHE (default ~/.cache/COSIPrograms/results); setting it to an empty
+#string turns caching off. Once it is larger than $COSI_RESULT_CACHE_SIZE (default 2G) the least
+#recently used entries are removed.
+#
+#Usage: python3 ResultCache.py list
+#       python3 ResultCache.py prune --size 500M
+#       python3 ResultCache.py clear
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+import numpy as np
+import EventCache as ec
+
+DefaultDirectory = os.path.join(os.path.expanduser("~"), ".cache", "COSIPrograms", "results")
+DefaultSize = "2G"
+
+#Bumped whenever the layout of an entry changes
+ResultVersion = 1
+
+def cacheDirectory():
+    return os.environ.get("COSI_RESULT_CACHE", DefaultDirectory)
+
+def cacheLimit():
+    return ec.parseSize(os.environ.get("COSI_RESULT_CACHE_SIZE", DefaultSize))
+
+#Hash of the source of the analysis code, so results are computed again after it changed
+def codeVersion(FileNames):
+    digest = hashlib.sha256(str(ResultVersion).encode())
+    for FileName in FileNames:
+        with open(FileName, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+################################################################################
+
+class ResultCache:
+    def __init__(self, CodeFiles, Directory=None):
+        self.Directory = cacheDirectory() if Directory is None else Directory
+        self.Code = codeVersion(CodeFiles)
+        self.Hits = 0
+        self.Misses = 0
+        self.Seeds = {}
+
+    def enabled(self):
+        return self.Directory != ""
+
+    #Key of the result of TraFile; Settings holds everything else the result depends on
+    def key(self, TraFile, **Settings):
+        content = ec.contentHash(TraFile)
+        inputs = json.dumps({"tra": content, "settings": Settings}, sort_keys=True)
+        key = hashlib.sha256((inputs + self.Code).encode()).hexdigest()
+        self.Seeds[key] = int(hashlib.sha256(inputs.encode()).hexdigest()[:15], 16)
+        return key
+
+    #Seed of the bootstrap of the entry Key, from its inputs but not the code, so its errors do not depend on
+    #which other histograms are bootstrapped with it or on unrelated changes of the code
+    def seed(self, Key):
+        return self.Seeds[Key]
+
+    def path(self, Key):
+        return os.path.join(self.Directory, Key[:2], Key + ".npz")
+
+    #The entry of Key as a dict of arrays (counts, sums) and metrics, or None
+    def load(self, Key):
+        if not self.enabled():
+            return None
+        try:
+            with np.load(self.path(Key)) as content:
+                entry = {"counts": content["counts"], "sums": content["sums"]}
+                entry.update(json.loads(str(content["metrics"])))
+        except (OSError, KeyError, ValueError):
+            self.Misses += 1
+            return None
+        os.utime(self.path(Key))
+        self.Hits += 1
+        return entry
+
+    def store(self, Key, Counts, Sums, **Metrics):
+        if not self.enabled():
+            return
+        FileName = self.path(Key)
+        os.makedirs(os.path.dirname(FileName), exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez_compressed(buffer, counts=np.asarray(Counts), sums=np.asarray(Sums),
+                            metrics=np.array(json.dumps(dict(Metrics, created=time.time()))))
+        handle, temporary = tempfile.mkstemp(dir=os.path.dirname(FileName), suffix=".tmp")
+        with os.fdopen(handle, "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(temporary, FileName)
+
+    def prune(self):
+        if self.enabled():
+            prune(cacheLimit(), self.Directory)
+
+################################################################################
+
+def entries(Directory=None):
+    Directory = cacheDirectory() if Directory is None else Directory
+    found = []
+    if not os.path.isdir(Directory):
+        return found
+    for shard in os.listdir(Directory):
+        if len(shard) != 2 or not os.path.isdir(os.path.join(Directory, shard)):
+            continue
+        for name in os.listdir(os.path.join(Directory, shard)):
+            if name.endswith(".npz"):
+                path = os.path.join(Directory, shard, name)
+                found.append({"entry": name[:-4], "path": path, "bytes": os.path.getsize(path), "used": os.path.getmtime(path)})
+    return sorted(found, key=lambda e: e["used"], reverse=True)
+
+#Removes least recently used entries until the cache is at most MaxBytes large
+def prune(MaxBytes, Directory=None):
+    removed = []
+    cached = entries(Directory)
+    total = sum(e["bytes"] for e in cached)
+    for e in reversed(cached):
+        if total <= MaxBytes:
+            break
+        os.remove(e["path"])
+        total -= e["bytes"]
+        removed.append(e)
+    return removed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Inspect and prune the local cache of ARM results.')
+    parser.add_argument('command', choices=['list', 'prune', 'clear'], help='list entries, prune to a size, or remove everything')
+    parser.add_argument('-s', '--size', type=str, default=None, help='Size to prune to, e.g. 500M (default: $COSI_RESULT_CACHE_SIZE)')
+    args = parser.parse_args()
+
+    if args.command == 'list':
+        cached = entries()
+        for e in cached:
+            with np.load(e["path"]) as content:
+                metrics = json.loads(str(content["metrics"]))
+            print("{}  {}  {:>8} entries  FWHM {} +- {}  RMS {} +- {}  {}".format(e["entry"][:16], time.strftime("%Y-%m-%d %H:%M", time.localtime(e["used"])),
+                  int(metrics["entries"]), metrics["FWHM"], metrics["FWHMError"], metrics["RMS"], metrics["RMSError"], metrics.get("source", "")))
+        print("{} entries, {:.1f} MB in {}".format(len(cached), sum(e["bytes"] for e in cached)/(1 << 20), cacheDirectory()))
+    else:
+        limit = 0 if args.command == 'clear' else ec.parseSize(args.size) if args.size else cacheLimit()
+        for e in prune(limit):
+            print("Removed " + e["entry"])
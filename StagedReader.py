@@ -0,0 +1,339 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Reader of tra files in stages which run at the same time as each other and as the analysis of the events:
+#  prefetch    a thread reading the file in blocks, so the disk (or network storage) keeps reading while
+#              the CPU works on the blocks before. Plain files stay memory-mapped: the thread only cuts them
+#              at events and has the kernel read each range ahead, and they are parsed in place.
+#  decompress  a thread decompressing the blocks of .gz files (zlib lets the other threads run meanwhile)
+#              and cutting the text at the ends of events
+#  parse       processes turning the text into batches of events. For a file with an index (GzipIndex.py)
+#              they decompress their own part of the file and there is no prefetch or decompress stage.
+#              Small files are parsed by a thread of this process.
+#  analyze     whatever the caller does with the batches, e.g. selection, ARM and filling in ARMoutput.py
+#The stages are connected by queues of at most 2 items per process. A stage which is ahead waits once the
+#queue after it is full, so memory stays bounded and the slowest stage sets the pace. For every stage the
+#time it was busy, waiting for input and blocked on a full queue is kept: the stage which is busy nearly all
+#of the time limits the throughput, and the others mostly wait for it.
+#
+#Usage: python3 StagedReader.py Run043.RF.tra.gz -j 16
+#   or in a script: for Events in sr.readTra(FileName, Stats=Stats): ...
+
+import argparse
+import collections
+import mmap
+import multiprocessing as mp
+import os
+import queue
+import threading
+import time
+import zlib
+import numpy as np
+import TraReader as tr
+import GzipIndex as gi
+
+#Marks the last item of a queue
+End = object()
+
+#Passes an error of a stage on to the stages after it
+class Failed:
+    def __init__(self, Error):
+        self.Error = Error
+
+#Time a stage spent working, waiting for items from the stage before and waiting for room in the queue after it,
+#and the number of items it passed on
+class Stage:
+    def __init__(self, Name, Workers=1):
+        self.Name = Name
+        self.Workers = Workers
+        self.Started = time.perf_counter()
+        self.Stopped = None
+        self.Busy = None
+        self.Waiting = 0.0
+        self.Blocked = 0.0
+        self.Items = 0
+
+    def wall(self):
+        return (self.Stopped or time.perf_counter()) - self.Started
+
+    #Busy time of the processes of a stage is added up by the caller; that of a thread is what is left of its time
+    def busy(self):
+        return self.Busy if self.Busy is not None else max(self.wall() - self.Waiting - self.Blocked, 0.0)
+
+    #Utilization is the busy fraction of Wall, the time of the whole read, since a stage which is done early did
+    #not hold up the others any more
+    def report(self, Wall):
+        return {"wall": round(Wall, 6), "busy": round(self.busy(), 6), "waiting": round(self.Waiting, 6), "blocked": round(self.Blocked, 6),
+                "items": self.Items, "workers": self.Workers, "utilization": round(self.busy()/(Wall*self.Workers), 3) if Wall > 0 else None}
+
+#Puts Item into Queue once there is room, unless the reader was stopped meanwhile
+def put(Queue, Item, Stage, Stop):
+    start = time.perf_counter()
+    while not Stop.is_set():
+        try:
+            Queue.put(Item, timeout=0.1)
+            break
+        except queue.Full:
+            pass
+    Stage.Blocked += time.perf_counter() - start
+    return not Stop.is_set()
+
+#Next item of Queue, or End if the reader was stopped meanwhile
+def get(Queue, Stage, Stop):
+    start = time.perf_counter()
+    item = End
+    while not Stop.is_set():
+        try:
+            item = Queue.get(timeout=0.1)
+            break
+        except queue.Empty:
+            pass
+    Stage.Waiting += time.perf_counter() - start
+    return item
+
+#Runs the generator function Function in a thread, on the items of the queue Input (None for the first stage),
+#putting what it yields into the queue Output
+def startStage(Stage, Function, Input, Output, Stop):
+    def items():
+        while True:
+            item = get(Input, Stage, Stop)
+            if item is End:
+                return
+            if isinstance(item, Failed):
+                raise item.Error
+            yield item
+
+    def work():
+        try:
+            for result in Function(None if Input is None else items()):
+                if not put(Output, result, Stage, Stop):
+                    return
+                Stage.Items += 1
+            put(Output, End, Stage, Stop)
+        except Exception as error:
+            put(Output, Failed(error), Stage, Stop)
+        finally:
+            Stage.Stopped = time.perf_counter()
+
+    thread = threading.Thread(target=work, name=Stage.Name, daemon=True)
+    thread.start()
+    return thread
+
+################################################################################
+
+#Memory map of an open plain file, or None if it is empty
+def mapFile(File):
+    try:
+        return mmap.mmap(File.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        return None
+
+#Plain files stay memory-mapped as in TraReader.readTra: this stage cuts the file at events into parse jobs
+#(FileName, Start, End) and asks the kernel to read each range ahead, and the parse stage reads it in place
+def prefetchPlain(FileName, ChunkBytes):
+    def ranges(_):
+        with open(FileName, "rb") as f:
+            buffer = mapFile(f)
+            if buffer is None:
+                return
+            with buffer:
+                for start, end in tr.plainRanges(buffer, ChunkBytes):
+                    if hasattr(mmap, "MADV_WILLNEED"):
+                        aligned = start - start % mmap.PAGESIZE
+                        buffer.madvise(mmap.MADV_WILLNEED, aligned, end - aligned)
+                    yield FileName, start, end
+    return ranges
+
+def prefetchGzip(FileName, BlockBytes):
+    def blocks(_):
+        with open(FileName, "rb") as f:
+            for block in iter(lambda: f.read(BlockBytes), b""):
+                yield block
+    return blocks
+
+#Text of the blocks cut after the last complete event of about every ChunkBytes; gzip files of several members
+#(as written by ToyTra.py) are decompressed member after member
+def decompress(ChunkBytes):
+    def chunks(Blocks):
+        inflater = zlib.decompressobj(gi.GzipBits)
+        pieces, size, pending = [], 0, b""
+        for block in Blocks:
+            pending = pending + block if pending else block
+            while pending:
+                if inflater.eof:
+                    if len(pending) < 2:
+                        break
+                    if pending[:2] != b"\x1f\x8b":
+                        pending = b""
+                        break
+                    inflater = zlib.decompressobj(gi.GzipBits)
+                pieces.append(inflater.decompress(pending, ChunkBytes))
+                size += len(pieces[-1])
+                pending = inflater.unused_data if inflater.eof else inflater.unconsumed_tail
+                if size >= ChunkBytes:
+                    text = b"".join(pieces)
+                    split = text.rfind(b"\nSE")
+                    if split > 0:
+                        yield text[:split + 1]
+                        text = text[split + 1:]
+                    pieces, size = [text], len(text)
+        #Input can be used up while output is still held back by the ChunkBytes limit
+        if not inflater.eof:
+            pieces.append(inflater.flush())
+        yield b"".join(pieces)
+    return chunks
+
+#Parse jobs return the time they took, so the busy time of the processes is known
+def parseText(Text):
+    start = time.perf_counter()
+    return tr.parseEvents(Text), time.perf_counter() - start
+
+#Job = (FileName, Start, End) of a plain file, parsed through a memory map of its own
+def parsePlain(Job):
+    start = time.perf_counter()
+    FileName, Start, End = Job
+    with open(FileName, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            batch = tr.parseEvents(buffer, Start, End)
+    return batch, time.perf_counter() - start
+
+def parseCheckpoint(Job):
+    start = time.perf_counter()
+    return gi.readCheckpoint(Job), time.perf_counter() - start
+
+#Hands every job to Pool, passing on the pending results in order; the queue after this stage holds the
+#results the processes are working on or have finished and the caller did not take yet
+def submit(Pool, Function):
+    def results(Jobs):
+        for job in Jobs:
+            yield Pool.apply_async(Function, (job,))
+    return results
+
+def parseInline(Texts):
+    for text in Texts:
+        yield parseText(text)
+
+#Parse jobs of a plain file in this process, on one memory map
+def parsePlainInline(FileName):
+    def batches(Jobs):
+        with open(FileName, "rb") as f:
+            buffer = mapFile(f)
+            if buffer is None:
+                return
+            with buffer:
+                for _, start, end in Jobs:
+                    began = time.perf_counter()
+                    yield tr.parseEvents(buffer, start, end), time.perf_counter() - began
+    return batches
+
+################################################################################
+
+#Stage times of the last read of every file
+Reports = {}
+
+#Files smaller than this many ChunkBytes are parsed in this process, since starting a pool would take about
+#as long as parsing them
+SmallFile = 4
+
+#Drop-in replacement for TraReader.readTra which runs the stages above with Processes processes parsing
+#(default: all cores). The time of every stage goes to Stats (Instrumentation.py) once the file is read or the
+#caller stops. Within the processes of a pool, which cannot start processes of their own, the file is read by
+#TraReader.readTra.
+def readTra(FileName, BatchSize=100000, MaxEvents=None, Skip=0, Processes=None, Stats=None, BlockBytes=1 << 22, ChunkBytes=1 << 22):
+    if mp.current_process().daemon:
+        yield from tr.readTra(FileName, BatchSize, MaxEvents=MaxEvents, Skip=Skip)
+        return
+    Processes = Processes or mp.cpu_count()
+    if os.path.getsize(FileName) < SmallFile*ChunkBytes:
+        Processes = 1
+    Depth = 2*Processes
+    started = time.perf_counter()
+    compressed = FileName.endswith(".gz")
+    index = gi.load(FileName) if compressed and Processes > 1 else None
+    pool = mp.Pool(Processes) if Processes > 1 else None
+    stop = threading.Event()
+    stages = collections.OrderedDict()
+    parsed = queue.Queue(Depth)
+    skipped = 0
+    if index is not None:
+        #Checkpoints before the one Skip falls into and after the one MaxEvents falls into are not read
+        numbers = index["number"]
+        begin = max(int(np.searchsorted(numbers, Skip, side="right")) - 1, 0)
+        end = len(numbers) if MaxEvents is None else max(int(np.searchsorted(numbers, MaxEvents, side="left")), begin + 1)
+        skipped = int(numbers[begin])
+        jobs = queue.Queue()
+        for point in range(begin, end):
+            jobs.put((FileName, gi.checkpoint(index, point), ChunkBytes))
+        jobs.put(End)
+        stages["parse"] = Stage("parse", Processes)
+        startStage(Stage("submit"), submit(pool, parseCheckpoint), jobs, parsed, stop)
+    else:
+        stages["prefetch"] = Stage("prefetch")
+        texts = queue.Queue(Depth)
+        if compressed:
+            blocks = queue.Queue(Depth)
+            stages["decompress"] = Stage("decompress")
+            startStage(stages["prefetch"], prefetchGzip(FileName, BlockBytes), None, blocks, stop)
+            startStage(stages["decompress"], decompress(ChunkBytes), blocks, texts, stop)
+        else:
+            startStage(stages["prefetch"], prefetchPlain(FileName, ChunkBytes), None, texts, stop)
+        stages["parse"] = Stage("parse", Processes)
+        if pool is not None:
+            startStage(Stage("submit"), submit(pool, parseText if compressed else parsePlain), texts, parsed, stop)
+        else:
+            startStage(stages["parse"], parseInline if compressed else parsePlainInline(FileName), texts, parsed, stop)
+    parse = stages["parse"]
+    if pool is not None:
+        parse.Busy = 0.0
+    analyze = stages["analyze"] = Stage("analyze")
+
+    def batches():
+        while True:
+            item = get(parsed, analyze, stop)
+            if item is End:
+                return
+            if isinstance(item, Failed):
+                raise item.Error
+            if pool is not None:
+                start = time.perf_counter()
+                item = item.get()
+                analyze.Waiting += time.perf_counter() - start
+                parse.Busy += item[1]
+                parse.Items += 1
+            analyze.Items += 1
+            yield item[0]
+
+    try:
+        yield from tr.limitEvents(batches(), BatchSize, None if MaxEvents is None else MaxEvents - skipped, Skip - skipped)
+    finally:
+        stop.set()
+        if pool is not None:
+            pool.terminate()
+        for stage in stages.values():
+            stage.Stopped = stage.Stopped or time.perf_counter()
+        wall = time.perf_counter() - started
+        Reports[FileName] = collections.OrderedDict((name, stage.report(wall)) for name, stage in stages.items())
+        if Stats is not None:
+            Stats.pipeline(Reports[FileName])
+
+#One line per stage with how much of its time it was busy, and the stage limiting the throughput
+def summary(Report):
+    lines = ["{:<12}{:>7.1%} busy of {:.2f} s{}, {:.2f} s waiting, {:.2f} s blocked".format(name, stage["utilization"] or 0, stage["wall"],
+             " on {} processes".format(stage["workers"]) if stage["workers"] > 1 else "", stage["waiting"], stage["blocked"]) for name, stage in Report.items()]
+    limiting = max(Report, key=lambda name: Report[name]["utilization"] or 0)
+    return lines + ["Limited by " + limiting]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Read tra files in overlapping stages and show which stage limits the throughput.')
+    parser.add_argument('files', nargs='+', help='tra or tra.gz files')
+    parser.add_argument('-j', '--processes', type=int, default=0, help='Number of processes parsing (default: all cores)')
+    parser.add_argument('-m', '--maxevents', type=int, default=None, help='Events read per file')
+    args = parser.parse_args()
+
+    for FileName in args.files:
+        Start = time.time()
+        events = sum(tr.batchSize(batch) for batch in readTra(FileName, MaxEvents=args.maxevents, Processes=args.processes or None))
+        print("{}: {} events in {:.2f} s, {:.0f} events/s".format(FileName, events, time.time() - Start, events/(time.time() - Start)))
+        for line in summary(Reports[FileName]):
+            print("  " + line)
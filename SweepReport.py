@@ -0,0 +1,212 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Report of a hyperparameter sweep such as the RFTests trainings (RFTests_<n>Cuts, <n>Trees, <n>Depth,
+#<n>%NodeSize). All results are loaded into flat arrays at once, from a metrics store (MetricsStore.py)
+#and/or old <training>.log.txt files, grouped by family and value of the hyperparameter, line, algorithm
+#and metric, and the configurations are ranked by FWHM (and RMS) with their bootstrap errors. The curves
+#of every family are drawn with matplotlib into one multi-page PDF.
+#
+#Old .log.txt rows only hold FWHM and RMS of every method. The ARM jobs of the lines of an isotope ran at the
+#same time and appended to the same file, so the order of the rows says nothing about their line, and the
+#ARM.<tag>.log files do not hold the values written. These rows are therefore reported as one group of
+#unknown line, which mixes the lines of the isotope: exact duplicate rows are dropped, the rest are averaged
+#without an error (they hold no bootstrap error, and the spread between lines is not noise), and the group
+#is listed but not ranked.
+#
+#Usage: python3 SweepReport.py Data/Metrics.db Data/RFTests_*.log.txt -i Co60 -o Data/RFTests
+
+import argparse
+import glob
+import json
+import os
+import re
+import numpy as np
+import MetricsStore as ms
+
+#<prefix>_<value>[%]<family>, e.g. RFTests_1000Cuts or RFTests_10%NodeSize
+DescriptionPattern = re.compile(r"^(?:.*_)?(\d+(?:\.\d+)?)(%?)([A-Za-z]+)$")
+LegacyRow = re.compile(r"^(\S+?): (.*)$", re.M)
+
+Columns = ["run", "isotope", "line", "description", "algorithm", "metric", "value", "error"]
+
+def hyperparameter(Description):
+    match = DescriptionPattern.match(Description)
+    if match is None:
+        return ("baseline" if Description in ("", "none") else Description), np.nan, ""
+    return match.group(3), float(match.group(1)), match.group(2)
+
+################################################################################
+
+def loadStore(FileName):
+    rows = ms.MetricsStore(FileName).read("SELECT run, isotope, line, description, algorithm, metric, value, error FROM results WHERE bin = ''")
+    return {column: np.array([row[column] for row in rows], dtype=np.float64 if column in ("line", "value", "error") else object) for column in Columns}
+
+def loadLegacy(FileName):
+    description = os.path.basename(FileName)[:-len(".log.txt")]
+    with open(FileName, "r") as f:
+        rows = list(dict.fromkeys(LegacyRow.findall(f.read())))
+    found = {column: [] for column in Columns}
+    for list_file, values in rows:
+        values = [float(v) for v in values.split()]
+        methods = len(values)//2
+        run = list_file[:-len("." + description + ".txt")] if list_file.endswith("." + description + ".txt") else list_file[:-len(".txt")]
+        isotope = run.split(".")[1] if "." in run else ""
+        line = np.nan
+        path = os.path.join(os.path.dirname(FileName), list_file)
+        tra_files = open(path).read().split() if os.path.exists(path) else []
+        for i in range(methods):
+            algorithm = ms.algorithmName(tra_files[i] if i < len(tra_files) else "", i)
+            for metric, value in (("FWHM", values[i]), ("RMS", values[methods + i])):
+                for column, entry in zip(Columns, (run, isotope, line, description, algorithm, metric, value, np.nan)):
+                    found[column].append(entry)
+    return {column: np.array(found[column], dtype=np.float64 if column in ("line", "value", "error") else object) for column in Columns}
+
+def loadAll(Sources):
+    parts = [loadStore(FileName) if FileName.endswith((".db", ".sqlite")) else loadLegacy(FileName) for FileName in Sources]
+    return {column: np.concatenate([part[column] for part in parts]) if parts else np.zeros(0) for column in Columns}
+
+################################################################################
+
+#Mean, error and number of rows of every (family, value, line, algorithm, metric). The error is the
+#bootstrap error of the mean if all rows have one, else nan.
+def aggregate(Results):
+    descriptions, which = np.unique(Results["description"].astype(str), return_inverse=True)
+    parsed = [hyperparameter(d) for d in descriptions]
+    family = np.array([p[0] for p in parsed], dtype=object)[which]
+    setting = np.array([p[1] for p in parsed])[which]
+    unit = np.array([p[2] for p in parsed], dtype=object)[which]
+    line = np.round(Results["line"], 3)
+
+    keys = np.rec.fromarrays([family.astype(str), np.nan_to_num(setting, nan=-1), unit.astype(str), np.nan_to_num(line, nan=-1),
+                              Results["algorithm"].astype(str), Results["metric"].astype(str)])
+    groups, group = np.unique(keys, return_inverse=True)
+    n = np.bincount(group, minlength=len(groups)).astype(np.float64)
+    mean = np.bincount(group, weights=Results["value"], minlength=len(groups))/n
+    has_error = np.isfinite(Results["error"])
+    errors = np.bincount(group, weights=np.where(has_error, Results["error"], 0)**2, minlength=len(groups))
+    with_error = np.bincount(group, weights=has_error, minlength=len(groups))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        error = np.where(with_error == n, np.sqrt(errors)/n, np.nan)
+    return {"family": groups.f0, "value": np.where(groups.f1 == -1, np.nan, groups.f1), "unit": groups.f2,
+            "line": np.where(groups.f3 == -1, np.nan, groups.f3), "algorithm": groups.f4, "metric": groups.f5,
+            "mean": mean, "error": error, "n": n.astype(np.int64)}
+
+#Configurations of every line and algorithm ranked by Metric, with the other metrics of the same configuration.
+#Results of unknown line mix the lines of the isotope and are listed by configuration without a rank.
+def rank(Groups, Metric="FWHM", Others=("RMS", "Peak")):
+    config = np.rec.fromarrays([Groups["family"], np.nan_to_num(Groups["value"], nan=-1), np.nan_to_num(Groups["line"], nan=-1), Groups["algorithm"]])
+    ranking = []
+    chosen = np.flatnonzero(Groups["metric"] == Metric)
+    for line, algorithm in sorted(set(zip(np.nan_to_num(Groups["line"][chosen], nan=-1).tolist(), Groups["algorithm"][chosen].tolist()))):
+        members = chosen[(np.nan_to_num(Groups["line"][chosen], nan=-1) == line) & (Groups["algorithm"][chosen] == algorithm)]
+        if line == -1:
+            members = members[np.lexsort((np.nan_to_num(Groups["value"][members], nan=-1), Groups["family"][members].astype(str)))]
+        else:
+            members = members[np.argsort(Groups["mean"][members], kind="stable")]
+        best = members[0]
+        for place, i in enumerate(members):
+            entry = {"rank": None if line == -1 else place + 1, "line": None if line == -1 else line, "algorithm": algorithm, "family": Groups["family"][i],
+                     "value": None if np.isnan(Groups["value"][i]) else Groups["value"][i], "unit": Groups["unit"][i], "n": int(Groups["n"][i]),
+                     Metric: Groups["mean"][i], Metric + "Error": Groups["error"][i]}
+            #distance to the best configuration in units of the combined error
+            combined = np.hypot(Groups["error"][i], Groups["error"][best])
+            entry["sigma"] = (Groups["mean"][i] - Groups["mean"][best])/combined if line != -1 and combined > 0 else np.nan
+            for other in Others:
+                match = np.flatnonzero((config == config[i]) & (Groups["metric"] == other))
+                entry[other] = Groups["mean"][match[0]] if len(match) else np.nan
+                entry[other + "Error"] = Groups["error"][match[0]] if len(match) else np.nan
+            ranking.append(entry)
+    return ranking
+
+def label(Entry):
+    if Entry["value"] is None:
+        return Entry["family"]
+    return "{:g}{}{}".format(Entry["value"], Entry["unit"], Entry["family"])
+
+def printRanking(Ranking, Metric, Top, Output=None):
+    text = []
+    for line, algorithm in dict.fromkeys((e["line"], e["algorithm"]) for e in Ranking):
+        text.append("\n{}, {}:".format("unknown line (not ranked)" if line is None else "{} keV".format(line), algorithm))
+        text.append("  rank\tconfiguration\tFWHM\t\tRMS\t\tPeak\t\tn\t{} sigma to best".format(Metric))
+        for e in [e for e in Ranking if e["line"] == line and e["algorithm"] == algorithm][:Top]:
+            text.append("  {}\t{:<16}\t".format("-" if e["rank"] is None else e["rank"], label(e)) +
+                        "\t".join("{:.2f} +- {:.2f}".format(e[m], e[m + "Error"]) for m in ("FWHM", "RMS", "Peak")) + "\t{}\t{:.1f}".format(e["n"], e["sigma"]))
+    print("\n".join(text))
+    if Output:
+        with open(Output, "w") as f:
+            f.write("\n".join(text).lstrip("\n") + "\n")
+
+################################################################################
+
+#One page per family: the metrics against the value of the hyperparameter, one panel per line and metric
+def render(Groups, FileName, Metrics=("FWHM", "RMS")):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_pdf import PdfPages
+
+    swept = np.isfinite(Groups["value"])
+    #Results of unknown line (old .log.txt rows) are a panel of their own
+    lineKey = np.nan_to_num(Groups["line"], nan=-1)
+    with PdfPages(FileName) as pdf:
+        for family in np.unique(Groups["family"][swept]):
+            inside = swept & (Groups["family"] == family)
+            lines = np.unique(lineKey[inside])
+            figure, axes = plt.subplots(len(Metrics), len(lines), figsize=(4.5*len(lines), 3.2*len(Metrics)), squeeze=False, sharex=True)
+            for column, line in enumerate(lines):
+                for row, metric in enumerate(Metrics):
+                    axis = axes[row][column]
+                    for algorithm in np.unique(Groups["algorithm"][inside]):
+                        chosen = np.flatnonzero(inside & (lineKey == line) & (Groups["algorithm"] == algorithm) & (Groups["metric"] == metric))
+                        chosen = chosen[np.argsort(Groups["value"][chosen])]
+                        if len(chosen):
+                            axis.errorbar(Groups["value"][chosen], Groups["mean"][chosen], yerr=np.nan_to_num(Groups["error"][chosen]),
+                                          marker="o", capsize=3, label=algorithm)
+                    values = Groups["value"][inside]
+                    if values.min() > 0 and values.max()/values.min() >= 20:
+                        axis.set_xscale("log")
+                    axis.set_title("{:g} keV".format(line) if line != -1 else "unknown line")
+                    axis.set_ylabel(metric + " [deg]")
+                    axis.grid(alpha=0.3)
+                    if row == len(Metrics) - 1:
+                        axis.set_xlabel(family + (" [%]" if Groups["unit"][inside][0] == "%" else ""))
+            axes[0][0].legend(fontsize="small")
+            figure.suptitle(family)
+            figure.tight_layout()
+            pdf.savefig(figure)
+            plt.close(figure)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rank the configurations of a hyperparameter sweep by the ARM FWHM and RMS.')
+    parser.add_argument('sources', nargs='*', help='Metrics store (.db) and/or old <training>.log.txt files (default: Metrics.db and *.log.txt here)')
+    parser.add_argument('-i', '--isotope', type=str, default=None, help='Only results of this isotope')
+    parser.add_argument('-a', '--algorithm', type=str, default=None, help='Only results of this algorithm')
+    parser.add_argument('-M', '--metric', type=str, default='FWHM', help='Metric to rank by')
+    parser.add_argument('-n', '--top', type=int, default=10, help='Number of configurations shown per line and algorithm')
+    parser.add_argument('-o', '--output', type=str, default='Sweep', help='Prefix of the report (.txt, .json) and the curves (.pdf)')
+    args = parser.parse_args()
+
+    Sources = args.sources or [f for f in [ms.DefaultDatabase] if os.path.exists(f)] + sorted(glob.glob("*.log.txt"))
+    if not Sources:
+        print("ERROR: No results found - pass a metrics store or .log.txt files")
+        quit()
+    Results = loadAll(Sources)
+    keep = np.ones(len(Results["value"]), dtype=bool)
+    if args.isotope:
+        keep &= Results["isotope"] == args.isotope
+    if args.algorithm:
+        keep &= Results["algorithm"] == args.algorithm
+    Results = {column: values[keep] for column, values in Results.items()}
+    print("INFO: Loaded {} results from {} files".format(len(Results["value"]), len(Sources)))
+    if len(Results["value"]) == 0:
+        quit()
+
+    Groups = aggregate(Results)
+    Ranking = rank(Groups, args.metric, [m for m in ("FWHM", "RMS", "Peak") if m != args.metric])
+    printRanking(Ranking, args.metric, args.top, args.output + ".txt")
+    with open(args.output + ".json", "w") as f:
+        json.dump([{k: (None if isinstance(v, float) and np.isnan(v) else v) for k, v in e.items()} for e in Ranking], f, indent=1, default=float)
+    render(Groups, args.output + ".pdf")
+    print("INFO: Wrote " + args.output + ".txt, " + args.output + ".json and " + args.output + ".pdf")
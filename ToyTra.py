@@ -0,0 +1,384 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Generator of toy tra files: gamma rays of the given lines from a point source (the -x/-y/-z position of
+#the analysis scripts) into a box of one material. Everything is sampled for whole arrays of photons:
+#  - directions isotropic within the cone around the box, entry and exit points of the box
+#  - the first interaction point and process from the cross sections in crossections/ (Total is taken as
+#    Compton + Photo + Pair); pair events are dropped, photo events are written as PH events
+#  - the Compton scatter angle from the Klein-Nishina cross section (sampled as in Geant4's
+#    G4KleinNishinaCompton), and the point where the scattered gamma is absorbed, again from the cross
+#    sections. Compton events whose scattered gamma leaves the box are dropped.
+#  - Gaussian smearing of the energies and positions; events with a deposit below the threshold are dropped
+#Events are turned into text with NumPy as well (fixed width numbers), in chunks of ChunkSize events on
+#all cores. Compressed files are written as one gzip member per chunk, which gzip reads as one file.
+#
+#Without smearing the ARM of every Compton event is 0, up to the rounding of the written values. With
+#--truth the ARM of every event computed from the written values is kept in <name>.truth.npz, which "check"
+#compares to what TraReader and Helper.getARM make of the file.
+#
+#Usage: python3 ToyTra.py generate toy.tra.gz -n 10000000 -i Cs137 -x 26.1 -y 0.3 -z 64 --truth
+#       python3 ToyTra.py check toy.tra.gz
+
+import argparse
+import gzip
+import multiprocessing as mp
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import Helper as h
+import TraReader as tr
+import Histograms as hs
+import CrossSections as cs
+
+DefaultSource = (26.1, 0.3, 64.0)
+#Corners of the detector box [cm]: the 2x2x3 stack of 8x8x1.5 cm germanium detectors
+DefaultVolume = ((-8.0, -8.0, -4.5), (8.0, 8.0, 4.5))
+Processes = ["Compton", "Photo", "Pair"]
+
+#Widths of the numbers in the written events; positions need to be within +-99999 cm, energies below 10 MeV
+IDWidth = 10
+PositionWidth, PositionDecimals = 11, 4
+EnergyWidth, EnergyDecimals = 11, 4
+
+################################################################################
+
+#Cross section tables per directory, opened once per process
+Tables = {}
+
+def crossSections(Directory):
+    if Directory not in Tables:
+        Tables[Directory] = cs.CrossSections(Directory)
+    return Tables[Directory]
+
+def unit(Vectors):
+    return Vectors/np.linalg.norm(Vectors, axis=1)[:, None]
+
+#Two unit vectors perpendicular to every direction of Directions and to each other
+def perpendicular(Directions):
+    helper = np.where(np.abs(Directions[:, 2:3]) < 0.9, [[0.0, 0.0, 1.0]], [[1.0, 0.0, 0.0]])
+    u = unit(np.cross(Directions, helper))
+    return u, np.cross(Directions, u)
+
+#Directions turned by the angles with cosines CosAngles about Directions, at random azimuths
+def turn(Directions, CosAngles, rng):
+    u, v = perpendicular(Directions)
+    azimuth = rng.uniform(0, 2*np.pi, len(Directions))
+    sine = np.sqrt(np.maximum(1 - CosAngles**2, 0))
+    return CosAngles[:, None]*Directions + sine[:, None]*(np.cos(azimuth)[:, None]*u + np.sin(azimuth)[:, None]*v)
+
+#Distances along Directions from Points at which the rays enter and leave the box (enter > leave if they miss it)
+def boxCrossing(Points, Directions, Volume):
+    low, high = np.asarray(Volume[0]), np.asarray(Volume[1])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t1 = (low - Points)/Directions
+        t2 = (high - Points)/Directions
+    enter = np.nan_to_num(np.minimum(t1, t2), nan=-np.inf).max(axis=1)
+    leave = np.nan_to_num(np.maximum(t1, t2), nan=np.inf).min(axis=1)
+    return np.maximum(enter, 0), leave
+
+#Scattered gamma energy as a fraction of the energy (epsilon) and cosine of the scatter angle, sampled from the
+#Klein-Nishina cross section for every energy of Energies, rejecting and sampling again only the rejected ones
+def kleinNishina(Energies, rng):
+    k = np.asarray(Energies, dtype=np.float64)/tr.E0
+    eps0 = 1/(1 + 2*k)
+    alpha1 = -np.log(eps0)
+    alpha2 = (1 - eps0**2)/2
+    epsilon = np.empty(len(k))
+    onecost = np.empty(len(k))
+    todo = np.arange(len(k))
+    while len(todo) > 0:
+        r1, r2, r3 = rng.random((3, len(todo)))
+        a1, a2, e0 = alpha1[todo], alpha2[todo], eps0[todo]
+        e = np.where(a1/(a1 + a2) > r1, np.exp(-a1*r2), np.sqrt(e0**2 + (1 - e0**2)*r2))
+        oc = (1 - e)/(e*k[todo])
+        accept = 1 - e*oc*(2 - oc)/(1 + e**2) >= r3
+        epsilon[todo[accept]] = e[accept]
+        onecost[todo[accept]] = oc[accept]
+        todo = todo[~accept]
+    return epsilon, 1 - onecost
+
+#Photons from Source into the box of Material, N at a time, until Events events are left after all cuts.
+#Returns the columns of the events: type, true energy, true scatter angle and measured energies and positions.
+def simulate(Settings, Events, rng):
+    tables = crossSections(Settings["crosssections"])
+    mu = lambda process, energies: np.nan_to_num(tables.mu(process, Settings["material"], energies))
+    lines = np.asarray(Settings["lines"], dtype=np.float64)
+    line_mu = np.array([mu(process, lines) for process in Processes])
+    source = np.asarray(Settings["source"], dtype=np.float64)
+    low, high = np.asarray(Settings["volume"][0]), np.asarray(Settings["volume"][1])
+    center = (low + high)/2
+    radius = np.linalg.norm(high - low)/2
+    axis = unit((center - source)[None, :])
+    distance = np.linalg.norm(center - source)
+    cos_cone = np.sqrt(1 - (radius/distance)**2) if distance > radius else -1.0
+
+    found = []
+    kept = 0
+    batch = Events
+    while kept < Events:
+        line = rng.integers(len(lines), size=batch)
+        direction = turn(np.repeat(axis, batch, axis=0), rng.uniform(cos_cone, 1, batch), rng)
+        enter, leave = boxCrossing(np.repeat(source[None, :], batch, axis=0), direction, Settings["volume"])
+        length = np.maximum(leave - enter, 0)
+
+        #First interaction inside the box, from the attenuation along the path through it; only Compton and
+        #photo interactions are followed further
+        total = line_mu.sum(axis=0)[line]
+        probability = -np.expm1(-total*length)
+        choice = rng.random(batch)*total
+        interacting = np.flatnonzero((rng.random(batch) < probability) & (choice < (line_mu[0] + line_mu[1])[line]))
+        n = len(interacting)
+        energy = lines[line[interacting]]
+        direction = direction[interacting]
+        depth = -np.log1p(-rng.random(n)*probability[interacting])/total[interacting]
+        c1 = source + (enter[interacting] + depth)[:, None]*direction
+        compton = choice[interacting] < line_mu[0][line[interacting]]
+
+        #Compton scattering and absorption of the scattered gamma
+        epsilon, cos_scatter = kleinNishina(energy, rng)
+        eg = epsilon*energy
+        scattered = turn(direction, cos_scatter, rng)
+        leave_scattered = boxCrossing(c1, scattered, Settings["volume"])[1]
+        travel = -np.log(rng.random(n))/np.maximum(mu("Total", eg), 1e-30)
+        absorbed = travel < leave_scattered
+        c2 = c1 + travel[:, None]*scattered
+
+        #Measured values
+        sigma_e, sigma_x = Settings["energysigma"], Settings["positionsigma"]
+        measured_eg = eg + rng.normal(0, sigma_e, n)
+        measured_ee = energy - eg + rng.normal(0, sigma_e, n)
+        measured_e = energy + rng.normal(0, sigma_e, n)
+        measured_c1 = c1 + rng.normal(0, sigma_x, (n, 3))
+        measured_c2 = c2 + rng.normal(0, sigma_x, (n, 3))
+        compton_kept = compton & absorbed & (measured_eg >= Settings["threshold"]) & (measured_ee >= Settings["threshold"])
+        photo_kept = ~compton & (measured_e >= Settings["threshold"])
+
+        keep = np.flatnonzero(compton_kept | photo_kept)[:Events - kept]
+        found.append({"type": np.where(compton_kept[keep], tr.c_Compton, tr.c_Photo).astype(np.int8), "energy": energy[keep],
+                      "phi": np.arccos(cos_scatter[keep]), "eg": measured_eg[keep], "ee": measured_ee[keep], "e": measured_e[keep],
+                      "C1": measured_c1[keep], "C2": measured_c2[keep]})
+        kept += len(keep)
+        batch = int(min(max((Events - kept)*1.2*batch/max(len(keep), 1), 1000), 10*Events))
+    return {name: np.concatenate([f[name] for f in found]) for name in found[0]}
+
+################################################################################
+
+#Text of the numbers 0000-9999 as one 4 byte word each, for turning numbers into text four digits at a time
+Digits = np.array([list(b"%04d" % i) for i in range(10000)], dtype=np.uint8).view(np.uint32).ravel()
+
+#Right-aligned text of Values (n, k) with Decimals decimals, as uint8 array (n, k*(Width+1)) with one blank
+#before every number
+def fixedText(Values, Width, Decimals):
+    Values = np.asarray(Values, dtype=np.float64)
+    scaled = np.rint(np.abs(Values)*10.0**Decimals).astype(np.int64)
+    integer = scaled//10**Decimals
+    places = Width - Decimals - (1 if Decimals > 0 else 0)
+    if np.any(integer >= 10**(places - 1)):
+        raise ValueError("Values do not fit into {} characters with {} decimals".format(Width, Decimals))
+
+    count = places + Decimals
+    groups = -(-count//4)
+    words = np.empty(Values.shape + (groups,), dtype=np.uint32)
+    rest = scaled
+    for g in range(groups - 1, -1, -1):
+        words[..., g] = Digits[rest % 10000]
+        rest = rest//10000
+    digits = words.view(np.uint8)[..., 4*groups - count:]
+    text = np.empty(Values.shape + (Width + 1,), dtype=np.uint8)
+    text[..., 0] = ord(" ")
+    text[..., 1:places + 1] = digits[..., :places]
+    if Decimals > 0:
+        text[..., places + 1] = ord(".")
+        text[..., places + 2:] = digits[..., places:]
+
+    #Leading zeros become blanks, the one in front of the first digit the sign
+    first = (places - np.searchsorted(10**np.arange(1, places, dtype=np.int64), integer, side="right")).astype(np.int8)[..., None]
+    sign = np.where((Values < 0) & (scaled > 0), ord("-"), ord(" ")).astype(np.uint8)[..., None]
+    position = np.arange(Width + 1, dtype=np.int8)
+    text[position < first - 1] = ord(" ")
+    np.copyto(text, sign, where=position == first - 1)
+    return text.reshape(len(Values), -1)
+
+#Text of N events from Parts, a list of constant byte strings and uint8 arrays (N, width)
+def records(Parts, N):
+    return np.concatenate([np.broadcast_to(np.frombuffer(part, dtype=np.uint8), (N, len(part))) if isinstance(part, bytes) else part
+                           for part in Parts], axis=1)
+
+def columns(*Values):
+    return np.column_stack(Values)
+
+#The events of one simulate() result as tra text, in the order of their IDs
+def eventText(Events, FirstID, EnergySigma):
+    compton = Events["type"] == tr.c_Compton
+    ids = np.arange(FirstID, FirstID + len(compton))
+    c, p = np.flatnonzero(compton), np.flatnonzero(~compton)
+    sigma = np.full(len(compton), EnergySigma)
+    zeros = np.zeros((len(compton), 3))
+    text_c = records([b"SE\nID", fixedText(ids[c, None], IDWidth, 0), b" 0\nET CO\nCE",
+                      fixedText(columns(Events["eg"][c], sigma[c], Events["ee"][c], sigma[c]), EnergyWidth, EnergyDecimals), b"\nCD",
+                      fixedText(np.hstack((Events["C1"][c], zeros[c], Events["C2"][c])), PositionWidth, PositionDecimals),
+                      b" 0 0 0 0 0 0 0 0 0\n"], len(c))
+    text_p = records([b"SE\nID", fixedText(ids[p, None], IDWidth, 0), b" 0\nET PH\nPE",
+                      fixedText(columns(Events["e"][p], sigma[p]), EnergyWidth, EnergyDecimals), b"\nPP",
+                      fixedText(Events["C1"][p], PositionWidth, PositionDecimals), b"\n"], len(p))
+
+    #Photo events are shorter; their PP line is padded with blanks so all events are rows of one array
+    text = np.empty((len(compton), text_c.shape[1]), dtype=np.uint8)
+    text[c] = text_c
+    text[p, :text_p.shape[1] - 1] = text_p[:, :-1]
+    text[p, text_p.shape[1] - 1:-1] = ord(" ")
+    text[p, -1] = ord("\n")
+    return text.tobytes()
+
+#ARM [deg] of the events as written (rounded like the text), NaN for photo events
+def writtenARM(Events, Source):
+    c1 = np.round(Events["C1"], PositionDecimals)
+    c2 = np.round(Events["C2"], PositionDecimals)
+    eg = np.round(Events["eg"], EnergyDecimals)
+    ee = np.round(Events["ee"], EnergyDecimals)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cos_phi = 1 - tr.E0*(1/eg - 1/(eg + ee))
+        phi = np.arccos(np.where(np.abs(cos_phi) <= 1, cos_phi, np.nan))
+        towards = unit(np.asarray(Source) - c1)
+        dg = unit(c2 - c1)
+        arm = np.degrees(np.arccos(np.clip(-(towards*dg).sum(axis=1), -1, 1)) - phi)
+    return np.where(Events["type"] == tr.c_Compton, arm, np.nan)
+
+#One chunk: events FirstID.. of the file as (possibly compressed) text and their truth
+def chunk(Job):
+    Settings, FirstID, Events, Seed = Job
+    rng = np.random.default_rng(Seed)
+    events = simulate(Settings, Events, rng)
+    text = eventText(events, FirstID, Settings["energysigma"])
+    if Settings["compression"] is not None:
+        text = gzip.compress(text, compresslevel=Settings["compression"])
+    truth = None
+    if Settings["truth"]:
+        truth = {"id": np.arange(FirstID, FirstID + Events), "type": events["type"], "energy": events["energy"],
+                 "phi": np.degrees(np.where(events["type"] == tr.c_Compton, events["phi"], np.nan)), "arm": writtenARM(events, Settings["source"])}
+    return text, truth
+
+def truthName(FileName):
+    for extension in (".tra.gz", ".tra"):
+        if FileName.endswith(extension):
+            return FileName[:-len(extension)] + ".truth.npz"
+    return FileName + ".truth.npz"
+
+#Writes Events events to FileName (.tra or .tra.gz); the chunks are generated on Processes processes and
+#are the same for any number of processes. Returns the number of events of every type.
+def generate(FileName, Events, Source=DefaultSource, Lines=(661.657,), Volume=DefaultVolume, Material="Germanium", EnergySigma=1.0,
+             PositionSigma=0.06, Threshold=15.0, Seed=0, Processes=None, ChunkSize=250000, Compression=1, Truth=False,
+             CrossSectionDirectory=cs.DefaultDirectory):
+    Settings = {"source": tuple(Source), "lines": list(Lines), "volume": Volume, "material": Material, "energysigma": EnergySigma,
+                "positionsigma": PositionSigma, "threshold": Threshold, "crosssections": CrossSectionDirectory, "truth": Truth,
+                "compression": Compression if FileName.endswith(".gz") else None}
+    #Packs the cross sections before the workers start
+    crossSections(CrossSectionDirectory).materialIndex("Total", [Material])
+    jobs = [(Settings, start + 1, min(ChunkSize, Events - start), np.random.SeedSequence(Seed, spawn_key=(i,)))
+            for i, start in enumerate(range(0, Events, ChunkSize))]
+
+    header, footer = b"Type TRA\n\n", b"EN\n"
+    if Settings["compression"] is not None:
+        header, footer = gzip.compress(header, Compression), gzip.compress(footer, Compression)
+    handle, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(FileName)), suffix=".tmp")
+    truths = []
+    with os.fdopen(handle, "wb") as f:
+        f.write(header)
+        if Processes == 1 or len(jobs) <= 1:
+            for text, truth in map(chunk, jobs):
+                f.write(text)
+                truths.append(truth)
+        else:
+            with mp.Pool(Processes or mp.cpu_count()) as pool:
+                for text, truth in pool.imap(chunk, jobs):
+                    f.write(text)
+                    truths.append(truth)
+        f.write(footer)
+    #Fixtures and load-test files are shared
+    h.replaceShared(temporary, FileName)
+
+    types = np.concatenate([t["type"] for t in truths]) if Truth else None
+    if Truth:
+        np.savez(truthName(FileName), source=np.asarray(Source), lines=np.asarray(Lines),
+                 **{name: np.concatenate([t[name] for t in truths]) for name in truths[0]})
+        return {"events": Events, "compton": int((types == tr.c_Compton).sum()), "photo": int((types == tr.c_Photo).sum())}
+    return {"events": Events}
+
+################################################################################
+
+#Reads FileName with TraReader, computes the ARM with Helper.getARM and compares it with the truth event by
+#event and by the FWHM and RMS of the ARM histograms. Returns the comparison and whether it passed.
+def check(FileName, Tolerance=1e-3):
+    with np.load(truthName(FileName)) as content:
+        truth = {name: content[name] for name in content.files}
+    Events = tr.concatBatches(list(tr.readTra(FileName)))
+    compton = Events["type"] == tr.c_Compton
+    index = np.searchsorted(truth["id"], Events["id"])
+    matched = (index < len(truth["id"])) & (truth["id"][np.minimum(index, len(truth["id"]) - 1)] == Events["id"])
+    ARM = h.getARM(Events["C1"][compton], Events["Dg"][compton], Events["phi"][compton], truth["source"])
+    expected = truth["arm"][index[compton]]
+    both = np.isfinite(ARM) & np.isfinite(expected)
+    difference = float(np.abs(ARM[both] - expected[both]).max()) if both.any() else 0.0
+
+    histograms = hs.BinnedARM(np.arange(0, 3))
+    histograms.fill(np.zeros(int(np.isfinite(ARM).sum())), ARM[np.isfinite(ARM)])
+    histograms.fill(np.ones(int(np.isfinite(truth["arm"]).sum())), truth["arm"][np.isfinite(truth["arm"])])
+    fwhm, rms = histograms.getFWHM(), histograms.getRMS()
+    result = {"events": len(compton), "expected_events": len(truth["id"]), "compton": int(compton.sum()),
+              "expected_compton": int((truth["type"] == tr.c_Compton).sum()), "matched": int(matched.sum()),
+              "max_arm_difference": difference, "FWHM": float(fwhm[0]), "expected_FWHM": float(fwhm[1]), "RMS": float(rms[0]), "expected_RMS": float(rms[1])}
+    passed = (result["events"] == result["expected_events"] == result["matched"] and result["compton"] == result["expected_compton"]
+              and difference <= Tolerance)
+    return result, passed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Generate toy tra files of Compton events from a point source, or check the analysis against their truth.')
+    parser.add_argument('command', choices=['generate', 'check'], help='write a toy tra file, or compare the ARM of a toy file with its truth')
+    parser.add_argument('filename', help='tra or tra.gz file')
+    parser.add_argument('-n', '--events', type=int, default=1000000, help='Number of events')
+    parser.add_argument('-x', '--xcoordinate', type=float, default=DefaultSource[0], help='X coordinate of the source [cm]')
+    parser.add_argument('-y', '--ycoordinate', type=float, default=DefaultSource[1], help='Y coordinate of the source [cm]')
+    parser.add_argument('-z', '--zcoordinate', type=float, default=DefaultSource[2], help='Z coordinate of the source [cm]')
+    parser.add_argument('-e', '--energy', type=float, nargs='+', default=None, help='Line energies [keV], equally strong. Defaults to the lines of the isotope, or 662.')
+    parser.add_argument('-i', '--isotope', type=str, default='none', help='Isotope whose lines from the line catalog in Helper.py are used')
+    parser.add_argument('--volume', type=float, nargs=6, default=None, help='Corners of the detector box: x0 y0 z0 x1 y1 z1 [cm]')
+    parser.add_argument('--material', type=str, default='Germanium', help='Material of the detector, as named in crossections/')
+    parser.add_argument('--energy-sigma', type=float, default=1.0, help='Gaussian energy resolution of every deposit [keV]')
+    parser.add_argument('--position-sigma', type=float, default=0.06, help='Gaussian position resolution of every coordinate [cm]')
+    parser.add_argument('--threshold', type=float, default=15.0, help='Events with a deposit below this energy [keV] are dropped')
+    parser.add_argument('-s', '--seed', type=int, default=0, help='Seed of the generator')
+    parser.add_argument('-j', '--processes', type=int, default=0, help='Number of processes (default: all cores)')
+    parser.add_argument('--compression', type=int, default=1, help='gzip level of .tra.gz files')
+    parser.add_argument('--truth', action='store_true', help='Also write the ARM of every event to <name>.truth.npz')
+    parser.add_argument('--tolerance', type=float, default=1e-3, help='check: largest allowed ARM difference to the truth [deg]')
+    args = parser.parse_args()
+
+    if args.command == 'check':
+        Result, Passed = check(args.filename, args.tolerance)
+        for name, value in Result.items():
+            print("{}: {}".format(name, value))
+        print("INFO: The analysis agrees with the truth" if Passed else "ERROR: The analysis does not agree with the truth")
+        sys.exit(0 if Passed else 1)
+
+    if args.energy:
+        Lines = args.energy
+    elif args.isotope in h.LineCatalog:
+        Lines = h.LineCatalog[args.isotope]
+    elif args.isotope != 'none':
+        print("ERROR: Unknown isotope " + args.isotope + " - pass its lines with -e")
+        sys.exit(1)
+    else:
+        Lines = [662.0]
+    Volume = (tuple(args.volume[:3]), tuple(args.volume[3:])) if args.volume else DefaultVolume
+
+    Start = time.time()
+    Written = generate(args.filename, args.events, (args.xcoordinate, args.ycoordinate, args.zcoordinate), Lines, Volume, args.material,
+                       args.energy_sigma, args.position_sigma, args.threshold, args.seed, args.processes or None, Compression=args.compression,
+                       Truth=args.truth)
+    print("INFO: Wrote {} events to {} in {:.1f} s".format(args.events, args.filename, time.time() - Start))
+    if args.truth:
+        print("INFO: {} Compton and {} photo events, truth in {}".format(Written["compton"], Written["photo"], truthName(args.filename)))
@@ -0,0 +1,249 @@
+################################################################################
+#Written by Rhea Senthil Kumar
+################################################################################
+
+#Reader for revan .tra and .tra.gz files which does not need ROOT or MEGAlib.
+#Events come out as batches of NumPy columns:
+#  id    event ID                         (n,)   int64
+#  type  event type, see c_Compton etc.   (n,)   int8
+#  Ei    total energy [keV]               (n,)   float64
+#  phi   Compton scatter angle [rad]      (n,)   float64
+#  C1    first interaction position       (n, 3) float64
+#  C2    second interaction position      (n, 3) float64
+#  Dg    scattered gamma direction        (n, 3) float64
+#Columns an event type does not have are NaN (e.g. phi, C2 and Dg of photo events).
+
+import gzip
+import mmap
+import re
+import numpy as np
+
+#Event types, numbered like MPhysicalEvent
+c_Unknown = 0
+c_Compton = 1
+c_Pair = 2
+c_Muon = 3
+c_Shower = 4
+c_Photo = 5
+c_Decay = 6
+c_PET = 7
+c_Multi = 8
+c_Unidentifiable = 9
+
+EventTypes = {b"CO": c_Compton, b"PA": c_Pair, b"MU": c_Muon, b"SH": c_Shower, b"PH": c_Photo,
+              b"DY": c_Decay, b"PT": c_PET, b"MT": c_Multi, b"UN": c_Unidentifiable}
+
+#Electron rest mass in keV, as c_E0 in MEGAlib
+E0 = 510.998910
+
+#Bumped whenever the columns produced by the reader change
+ReaderVersion = 1
+
+Columns = ("id", "type", "Ei", "phi", "C1", "C2", "Dg")
+
+################################################################################
+
+def emptyBatch(n=0):
+    batch = {"id": np.zeros(n, dtype=np.int64), "type": np.zeros(n, dtype=np.int8)}
+    for name in ("Ei", "phi"):
+        batch[name] = np.full(n, np.nan)
+    for name in ("C1", "C2", "Dg"):
+        batch[name] = np.full((n, 3), np.nan)
+    return batch
+
+#Parse the first Width numbers of each of Rows, in one call if all rows have the same length
+def parseRows(Rows, Width):
+    if len(Rows) == 0:
+        return np.zeros((0, Width))
+    values = np.fromstring(b" ".join(Rows), sep=" ")
+    per_row = len(np.fromstring(Rows[0], sep=" "))
+    if per_row >= Width and len(values) == len(Rows)*per_row:
+        return values.reshape(len(Rows), per_row)[:, :Width]
+    table = np.full((len(Rows), Width), np.nan)
+    for r, row in enumerate(Rows):
+        numbers = np.fromstring(row, sep=" ")[:Width]
+        table[r, :len(numbers)] = numbers
+    return table
+
+Tag = {name: re.compile(rb"\n" + name + rb"[ \t]+([^\r\n]*)") for name in (b"ID", b"ET", b"CE", b"CD", b"PE", b"PP")}
+EventStart = re.compile(rb"\nSE\b")
+AnyTag = re.compile(rb"^(SE|ID|ET|CE|CD|PE|PP)[ \t]*([^\r\n]*)", re.M)
+
+def eventTypes(Rows):
+    tags = np.array(Rows, dtype="S2")
+    types = np.full(len(tags), c_Unknown, dtype=np.int8)
+    for tag, code in EventTypes.items():
+        types[tags == tag] = code
+    return types
+
+def comptonColumns(Batch, Events, Energies, Positions):
+    eg, ee = Energies[:, 0], Energies[:, 2]
+    Batch["Ei"][Events] = eg + ee
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cosphi = 1 - E0*(1/eg - 1/(eg + ee))
+        Batch["phi"][Events] = np.arccos(np.where(np.abs(cosphi) <= 1, cosphi, np.nan))
+        c1, c2 = Positions[:, 0:3], Positions[:, 6:9]
+        Batch["C1"][Events] = c1
+        Batch["C2"][Events] = c2
+        Batch["Dg"][Events] = (c2 - c1)/np.linalg.norm(c2 - c1, axis=1)[:, None]
+
+def photoColumns(Batch, Events, Energies, Positions):
+    Batch["Ei"][Events] = Energies[:, 0]
+    Batch["C1"][Events] = Positions
+
+#Turn complete events in Buffer[Start:End] into columns.
+#Every event has one ID and ET line, Compton events one CE and CD line and photo events one PE and PP line,
+#so each tag is collected with its own pattern and matched to the events of its type in order.
+#Buffers which do not follow that layout go through parseEventsByLine.
+def parseEvents(Buffer, Start=0, End=None):
+    End = len(Buffer) if End is None else End
+    found = {name: pattern.findall(Buffer, Start, End) for name, pattern in Tag.items()}
+    n = len(EventStart.findall(Buffer, Start, End)) + (Buffer[Start:Start+3].rstrip() == b"SE")
+    if len(found[b"ID"]) != n or len(found[b"ET"]) != n:
+        return parseEventsByLine(Buffer, Start, End)
+
+    batch = emptyBatch(n)
+    batch["id"][:] = parseRows(found[b"ID"], 1)[:, 0]
+    batch["type"][:] = eventTypes(found[b"ET"])
+    compton = np.flatnonzero(batch["type"] == c_Compton)
+    photo = np.flatnonzero(batch["type"] == c_Photo)
+    #Pair events write PE and PP lines as well
+    if len(found[b"CE"]) != len(compton) or len(found[b"CD"]) != len(compton) or len(found[b"PE"]) != len(photo) or len(found[b"PP"]) != len(photo):
+        return parseEventsByLine(Buffer, Start, End)
+
+    comptonColumns(batch, compton, parseRows(found[b"CE"], 4), parseRows(found[b"CD"], 9))
+    photoColumns(batch, photo, parseRows(found[b"PE"], 1), parseRows(found[b"PP"], 3))
+    return batch
+
+def parseEventsByLine(Buffer, Start, End):
+    found = AnyTag.findall(Buffer, Start, End)
+    if not found:
+        return emptyBatch()
+    tags, values = zip(*found)
+    tags = np.array(tags)
+    values = np.array(values, dtype=object)
+    event = np.cumsum(tags == b"SE") - 1
+    keep = event >= 0
+    tags, values, event = tags[keep], values[keep], event[keep]
+    batch = emptyBatch(int(event[-1]) + 1 if len(event) > 0 else 0)
+
+    rows = tags == b"ID"
+    batch["id"][event[rows]] = parseRows(values[rows], 1)[:, 0]
+    rows = tags == b"ET"
+    batch["type"][event[rows]] = eventTypes(values[rows])
+    ce = (tags == b"CE") & (batch["type"][event] == c_Compton)
+    cd = (tags == b"CD") & (batch["type"][event] == c_Compton)
+    if np.array_equal(event[ce], event[cd]):
+        comptonColumns(batch, event[ce], parseRows(values[ce], 4), parseRows(values[cd], 9))
+    pe = (tags == b"PE") & (batch["type"][event] == c_Photo)
+    pp = (tags == b"PP") & (batch["type"][event] == c_Photo)
+    if np.array_equal(event[pe], event[pp]):
+        photoColumns(batch, event[pe], parseRows(values[pe], 1), parseRows(values[pp], 3))
+    return batch
+
+def concatBatches(Batches):
+    if len(Batches) == 1:
+        return Batches[0]
+    return {name: np.concatenate([b[name] for b in Batches]) for name in Columns}
+
+def sliceBatch(Batch, Start, End):
+    return {name: column[Start:End] for name, column in Batch.items()}
+
+def batchSize(Batch):
+    return len(Batch["id"])
+
+#Cut a stream of variable sized batches into batches of exactly BatchSize events (the last one may be shorter)
+def rebatch(Batches, BatchSize):
+    pending, waiting = [], 0
+    for batch in Batches:
+        pending.append(batch)
+        waiting += batchSize(batch)
+        if waiting < BatchSize:
+            continue
+        joined = concatBatches(pending)
+        start = 0
+        while waiting - start >= BatchSize:
+            yield sliceBatch(joined, start, start + BatchSize)
+            start += BatchSize
+        pending = [sliceBatch(joined, start, waiting)]
+        waiting -= start
+    if waiting > 0:
+        yield concatBatches(pending)
+
+################################################################################
+
+#Start and end of about ChunkBytes of Buffer at a time, each ending where an event starts
+def plainRanges(Buffer, ChunkBytes):
+    start = 0
+    while start < len(Buffer):
+        end = min(start + ChunkBytes, len(Buffer))
+        if end < len(Buffer):
+            split = Buffer.rfind(b"\nSE", start, end)
+            if split <= start:
+                split = Buffer.find(b"\nSE", end)
+            end = split + 1 if split >= 0 else len(Buffer)
+        yield start, end
+        start = end
+
+#Plain files are memory-mapped and parsed in place, ChunkBytes at a time
+def chunksPlain(FileName, ChunkBytes):
+    with open(FileName, "rb") as f:
+        try:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            return
+        with buffer:
+            for start, end in plainRanges(buffer, ChunkBytes):
+                yield parseEvents(buffer, start, end)
+
+#Compressed files are decompressed ChunkBytes at a time, keeping the unfinished event for the next chunk
+def chunksGzip(FileName, ChunkBytes):
+    carry = b""
+    with gzip.open(FileName, "rb") as f:
+        while True:
+            data = f.read(ChunkBytes)
+            buffer = carry + data
+            if not data:
+                yield parseEvents(buffer)
+                return
+            split = buffer.rfind(b"\nSE")
+            if split <= 0:
+                carry = buffer
+                continue
+            yield parseEvents(buffer, 0, split + 1)
+            carry = buffer[split + 1:]
+
+#Drops the first Skip events of a stream of batches
+def skipEvents(Batches, Skip):
+    for batch in Batches:
+        if Skip >= batchSize(batch):
+            Skip -= batchSize(batch)
+            continue
+        yield sliceBatch(batch, Skip, batchSize(batch)) if Skip > 0 else batch
+        Skip = 0
+
+#Cuts a stream of batches from the start of a file into batches of BatchSize events, stopping after MaxEvents events.
+#The first Skip events are dropped, and count towards MaxEvents.
+def limitEvents(Batches, BatchSize, MaxEvents=None, Skip=0):
+    if MaxEvents is not None:
+        MaxEvents -= Skip
+        if MaxEvents <= 0:
+            return
+    read = 0
+    for batch in rebatch(skipEvents(Batches, Skip), BatchSize):
+        if MaxEvents is not None and read + batchSize(batch) >= MaxEvents:
+            yield sliceBatch(batch, 0, MaxEvents - read)
+            return
+        read += batchSize(batch)
+        yield batch
+
+#Yields batches of BatchSize events from a .tra or .tra.gz file, stopping after MaxEvents events.
+#The first Skip events of the file are parsed but not returned, and count towards MaxEvents.
+def readTra(FileName, BatchSize=100000, ChunkBytes=1 << 24, MaxEvents=None, Skip=0):
+    chunks = chunksGzip if FileName.endswith(".gz") else chunksPlain
+    yield from limitEvents(chunks(FileName, ChunkBytes), BatchSize, MaxEvents, Skip)
+
+#List of tra files in a text file such as alltra.txt, one path per line
+def readFileList(FileName):
+    with open(FileName, "r") as f:
+        return [line.strip() for line in f if line.strip()]
@@ -8,22 +8,14 @@ from math import pi
 import math
 import argparse
 import Helper as h
-import multiprocessing as mp
+import TraReader as tr
+import Histograms as hs
+import Instrumentation as ins
+import numpy as np
 from os import path
-pool = mp.Pool(mp.cpu_count())
 import os
 
 ################################################################################
-# Load MEGAlib into ROOT
-M.gSystem.Load("$(MEGALIB)/lib/libMEGAlib.so")
-
-# Initialize MEGAlib
-G = M.MGlobal()
-G.Initialize()
-
-# We are good to go ...
-GeometryName = "/volumes/selene/users/rhea/geomega/COSI.DetectorHead.geo.setup"
-
 parser = argparse.ArgumentParser(description='Compare output parameters from event reconstruction files and source location.')
 parser.add_argument('-f', '--filename', default='test.txt', help='txt file name used for calculating ARM. Contains path to tra file.')
 parser.add_argument('-m', '--minevents', default='1000000', help='Minimum number of events to use')
@@ -37,8 +29,14 @@ parser.add_argument('-b', '--batch', type=str, default='no', help='If set to yes
 parser.add_argument('-i', '--isotope', type=str, default='none', help='The name of the isotope')
 parser.add_argument('-r', '--run', type=str, default='none', help='The name of the run')
 parser.add_argument('-p', '--training', type=str, default='none', help='The name of the training output file')
+parser.add_argument('-c', '--checkpoint', type=str, default='', help='Checkpoint file of the histograms. Resumes from it if it exists.')
+parser.add_argument('--checkpoint-every', type=int, default=1000000, help='Number of events between checkpoints')
+parser.add_argument('-o', '--output', type=str, default='FirstInteraction', help='Prefix of the output files: <output>.txt with lever arm quantiles per scatter angle, <output>.npz with the histograms')
+parser.add_argument('--stats', type=str, default='', help='File to append the timing and event counts of this job to as one JSON line. Printed if not given.')
+parser.add_argument('--debug-sample', type=float, default=0.0, help='Fraction of the selected events whose ARM value is printed')
 
 args = parser.parse_args()
+Stats = ins.Stats("countFirstInteraction", args.debug_sample, run=args.run, isotope=args.isotope, training=args.training)
 
 if args.filename != "":
   FileName = args.filename
@@ -83,67 +81,59 @@ while line:
   print(trafiles[-1])
   line = str(f.readline()).strip()
 
-# Load geometry:
-Geometry = M.MDGeometryQuest()
-if Geometry.ScanSetupFile(M.MString(GeometryName)) == True:
-  print("Geometry " + GeometryName + " loaded!")
-else:
-  print("Unable to load geometry " + GeometryName + " - Aborting!")
-  quit()
-
-interactionList = []
-#ARM histograms sorted by phi of the event, separated by 20 degrees
-HistARMlist = []
-for i in range(0, 180):
-    HistARMlist.append(M.TH1D("Angle Range " + str(i), title, 3601, -180, 180))
+#ARM histograms sorted by phi of the event, separated by 1 degree
+ARMbyPhi = hs.BinnedARM(np.arange(0, 181, 1))
+#ARM histograms sorted by first lever arm, 0.5 cm bins; their entries are the lever arm histogram
+ARMbyLeverArm = hs.BinnedARM(np.arange(0, 50.5, 0.5))
+#Lever arm distribution per phi bin of 1 degree, 0 to 100 cm in 0.05 cm bins
+LeverArmbyPhi = hs.BinnedARM(np.arange(0, 181, 1), 2000, 0.0, 100.0)
+Hists = {"phi": ARMbyPhi, "leverarm": ARMbyLeverArm, "leverarm_by_phi": LeverArmbyPhi}
+Filling = hs.Checkpoint(args.checkpoint, Hists, args.checkpoint_every)
 
 print("Starting data collection...")
 
 # Load file
 for y in range(0, len(trafiles)):
-    Reader = M.MFileEventsTra()
-    if Reader.Open(M.MString(trafiles[y])) == False:
-        print("Unable to open file " + FileName + ". Aborting!")
+    if not path.exists(trafiles[y]):
+        print("Unable to open file " + trafiles[y] + ". Aborting!")
         quit()
     else:
-        print("File " + FileName + " loaded!")
+        print("File " + trafiles[y] + " loaded!")
 
 #Fill Histogram values
-    counter = 0
-    while counter <= 1000000:
-        Event = Reader.GetNextEvent()
-        counter = counter + 1
-        if not Event:
-            break
-
-        if (Event.GetType() == M.MPhysicalEvent.c_Compton) and (low_e <= Event.Ei() <= high_e):
-            ARM_value = Event.GetARMGamma(M.MVector(X, Y, Z))*(180.0/pi);
-            print("ARM_value: " + str(ARM_value))
-            print("Phi: " + str(Event.Phi()))
-            degree = Event.Phi()*(180/pi)
-            index = math.floor(degree)
-            HistARMlist[index].Fill(ARM_value);
-            interactionList.append(Event.FirstLeverArm())
-        else:
-            pass
+    for Events in Stats.timed("reading", Filling.events(trafiles[y], MaxEvents=1000001)):
+        with Stats.stage("selection"):
+            Compton = Events["type"] == tr.c_Compton
+            Selected = Compton & (low_e <= Events["Ei"]) & (Events["Ei"] <= high_e)
+            Stats.countSelection(Compton, Selected)
+        with Stats.stage("filling"):
+            ARM_values = h.getARM(Events["C1"][Selected], Events["Dg"][Selected], Events["phi"][Selected], (X, Y, Z))
+            Phi = hs.getAttribute(Events, "phi")[Selected]
+            LeverArm = hs.getAttribute(Events, "leverarm")[Selected]
+            ARMbyPhi.fill(Phi, ARM_values)
+            ARMbyLeverArm.fill(LeverArm, ARM_values)
+            LeverArmbyPhi.fill(Phi, LeverArm)
+        Stats.debug("ARM", Events["id"][Selected], ARM_values)
 print("\n")
 print("Data collection complete. Getting data analysis parameters..." + "\n")
 
-#get back the fwhm and rms values
-#v1: see these values printed
-#TODO v2: store these values into a file
-
-FWHMlist = []
-RMSlist = []
-
-for i in range(len(HistARMlist)):
-    FWHMlist.append(h.getFWHM(HistARMlist[i]))
-    RMSlist.append(round(HistARMlist[i].GetRMS(), 2))
-
-#print(FWHMlist)
-#print(RMSlist)
-file = open("interactionList.txt", "w")
-file.write(interactionList + "\n")
+#FWHM and RMS of every phi bin, written to <output>.txt with the lever arm quantiles
+FWHMlist = ARMbyPhi.getFWHM().tolist()
+RMSlist = ARMbyPhi.getRMS().tolist()
+
+#Lever arm quantiles per phi bin, one row per bin
+Probabilities = [0.05, 0.16, 0.5, 0.84, 0.95]
+Quantiles = LeverArmbyPhi.quantiles(Probabilities)
+Entries = LeverArmbyPhi.entries()
+Mean = LeverArmbyPhi.getMean()
+file = open(args.output + ".txt", "w")
+file.write("#Lever arm [cm] of selected Compton events per scatter angle bin: {} ({}, {} keV), {}\n".format(run, isotope, energy, args.filename))
+file.write("#phi_low\tphi_high\tentries\tmean\t" + "\t".join("q{:02d}".format(int(round(100*p))) for p in Probabilities) + "\tARM_FWHM\tARM_RMS\n")
+for i in range(LeverArmbyPhi.slices()):
+    file.write("{:g}\t{:g}\t{:d}\t{:.4f}\t".format(LeverArmbyPhi.Edges[i], LeverArmbyPhi.Edges[i+1], int(Entries[i]), Mean[i]))
+    file.write("\t".join("{:.4f}".format(q) for q in Quantiles[i]) + "\t{}\t{}\n".format(FWHMlist[i], RMSlist[i]))
 file.close()
+hs.saveCheckpoint(args.output + ".npz", Hists, Filling.Progress)
+print("Lever arm summary written to " + args.output + ".txt, histograms to " + args.output + ".npz")
 
-
+Stats.write(args.stats)
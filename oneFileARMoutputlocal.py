@@ -7,21 +7,13 @@ import ROOT as M
 from math import pi
 import argparse
 import Helper as h
-import multiprocessing as mp
+import TraReader as tr
+import Histograms as hs
+import Instrumentation as ins
+import numpy as np
 from os import path
-pool = mp.Pool(mp.cpu_count())
 
 ################################################################################
-# Load MEGAlib into ROOT
-M.gSystem.Load("$(MEGALIB)/lib/libMEGAlib.so")
-
-# Initialize MEGAlib
-G = M.MGlobal()
-G.Initialize()
-
-# We are good to go ...
-GeometryName = "/volumes/selene/users/rhea/geomega/COSI.DetectorHead.geo.setup"
-
 parser = argparse.ArgumentParser(description='Compare output parameters from event reconstruction files and source location.')
 parser.add_argument('-f', '--filename', default='test.txt', help='txt file name used for calculating ARM. Contains path to tra file.')
 parser.add_argument('-m', '--minevents', default='1000000', help='Minimum number of events to use')
@@ -35,8 +27,13 @@ parser.add_argument('-b', '--batch', type=str, default='no', help='If set to yes
 parser.add_argument('-i', '--isotope', type=str, default='none', help='The name of the isotope')
 parser.add_argument('-r', '--run', type=str, default='none', help='The name of the run')
 parser.add_argument('-p', '--training', type=str, default='none', help='The name of the training output file')
+parser.add_argument('-c', '--checkpoint', type=str, default='', help='Checkpoint file of the ARM histograms. Resumes from it if it exists.')
+parser.add_argument('--checkpoint-every', type=int, default=1000000, help='Number of events between checkpoints')
+parser.add_argument('--stats', type=str, default='', help='File to append the timing and event counts of this job to as one JSON line. Printed if not given.')
+parser.add_argument('--debug-sample', type=float, default=0.0, help='Fraction of the selected events whose ARM value is printed')
 
 args = parser.parse_args()
+Stats = ins.Stats("oneFileARMoutputlocal", args.debug_sample, run=args.run, isotope=args.isotope, training=args.training)
 
 if args.filename != "":
   FileName = args.filename
@@ -81,99 +78,31 @@ while line:
   print(trafiles[-1])
   line = str(f.readline()).strip()
 
-# Load geometry:
-Geometry = M.MDGeometryQuest()
-if Geometry.ScanSetupFile(M.MString(GeometryName)) == True:
-  print("Geometry " + GeometryName + " loaded!")
-else:
-  print("Unable to load geometry " + GeometryName + " - Aborting!")
-  quit()
-
 
-#ARM histograms sorted by phi of the event, separated by 20 degrees
-HistARMlist = []
-for i in range(0, 18):
-    HistARMlist.append(M.TH1D("Angle Range " + str(i), title, 3601, -180, 180))
+#ARM histograms sorted by phi of the event, separated by 10 degrees
+ARMbyPhi = hs.BinnedARM(np.arange(0, 181, 10))
+Filling = hs.Checkpoint(args.checkpoint, {"phi": ARMbyPhi}, args.checkpoint_every)
 
 print("Starting data collection...")
 
 # Load file
 for y in range(0, len(trafiles)):
-    Reader = M.MFileEventsTra()
-    if Reader.Open(M.MString(trafiles[y])) == False:
-        print("Unable to open file " + FileName + ". Aborting!")
+    if not path.exists(trafiles[y]):
+        print("Unable to open file " + trafiles[y] + ". Aborting!")
         quit()
     else:
-        print("File " + FileName + " loaded!")
-
-    countdict = {"else" : 0, "count1" : 0, "count2" : 0, "count3" : 0, "count4" : 0, "count5" : 0, "count6" : 0, "count7" : 0, "count8" : 0, "count9" : 0, "count10" : 0, "count11" : 0, "count12" : 0, "count13" : 0, "count14" : 0, "count15" : 0, "count16" : 0, "count17" : 0}
+        print("File " + trafiles[y] + " loaded!")
 
 #Fill Histogram values
-    counter = 0
-    while counter <= 1000000:
-        Event = Reader.GetNextEvent()
-        counter = counter + 1
-        if not Event:
-            break
-
-        if (Event.GetType() == M.MPhysicalEvent.c_Compton) and (low_e <= Event.Ei() <= high_e):
-            ARM_value = Event.GetARMGamma(M.MVector(X, Y, Z))*(180.0/pi);
-            print("ARM_value: " + str(ARM_value))
-            print("Phi: " + str(Event.Phi()))
-            if 0 < Event.Phi() and Event.Phi() <= 0.175:
-                HistARMlist[0].Fill(ARM_value);
-                countdict["count1"] += 1
-            elif 0.175 < Event.Phi() and Event.Phi() <= 0.349:
-                HistARMlist[1].Fill(ARM_value);
-                countdict["count2"] += 1
-            elif 0.349 < Event.Phi() and Event.Phi() <= 0.523:
-                HistARMlist[2].Fill(ARM_value);
-                countdict["count3"] += 1
-            elif 0.523 < Event.Phi() and Event.Phi() <= 0.698:
-                HistARMlist[3].Fill(ARM_value);
-                countdict["count4"] += 1
-            elif 0.698 < Event.Phi() and Event.Phi() <= 0.873:
-                HistARMlist[4].Fill(ARM_value);
-                countdict["count5"] += 1
-            elif 0.873 < Event.Phi() and Event.Phi() <= 1.222:
-                HistARMlist[5].Fill(ARM_value);
-                countdict["count6"] += 1
-            elif 1.222 < Event.Phi() and Event.Phi() <= 1.396:
-                HistARMlist[6].Fill(ARM_value);
-                countdict["count7"] += 1
-            elif 1.396 < Event.Phi() and Event.Phi() <= 1.571:
-                HistARMlist[7].Fill(ARM_value);
-                countdict["count8"] += 1
-            elif 1.571 < Event.Phi() and Event.Phi() <= 1.745:
-                HistARMlist[8].Fill(ARM_value);
-                countdict["count9"] += 1
-            elif 1.745 < Event.Phi() and Event.Phi() <= 1.919:
-                HistARMlist[9].Fill(ARM_value);
-                countdict["count10"] += 1
-            elif 1.919 < Event.Phi() and Event.Phi() <= 2.094:
-                HistARMlist[10].Fill(ARM_value);
-                countdict["count11"] += 1
-            elif 2.094 < Event.Phi() and Event.Phi() <= 2.269:
-                HistARMlist[11].Fill(ARM_value);
-                countdict["count12"] += 1
-            elif 2.269 < Event.Phi() and Event.Phi() <= 2.443:
-                HistARMlist[12].Fill(ARM_value);
-                countdict["count13"] += 1
-            elif 2.443 < Event.Phi() and Event.Phi() <= 2.618:
-                HistARMlist[13].Fill(ARM_value);
-                countdict["count14"] += 1
-            elif 2.618 < Event.Phi() and Event.Phi() <= 2.793:
-                HistARMlist[14].Fill(ARM_value);
-                countdict["count15"] += 1
-            elif 2.793 < Event.Phi() and Event.Phi() <= 2.967:
-                HistARMlist[15].Fill(ARM_value);
-                countdict["count16"] += 1
-            elif 2.967 < Event.Phi() and Event.Phi() <= 3.142:
-                HistARMlist[16].Fill(ARM_value);
-                countdict["count17"] += 1
-            else:
-                countdict["else"] += 1
-                pass
+    for Events in Stats.timed("reading", Filling.events(trafiles[y], MaxEvents=1000001)):
+        with Stats.stage("selection"):
+            Compton = Events["type"] == tr.c_Compton
+            Selected = Compton & (low_e <= Events["Ei"]) & (Events["Ei"] <= high_e)
+            Stats.countSelection(Compton, Selected)
+        with Stats.stage("filling"):
+            ARM_values = h.getARM(Events["C1"][Selected], Events["Dg"][Selected], Events["phi"][Selected], (X, Y, Z))
+            ARMbyPhi.fill(hs.getAttribute(Events, "phi")[Selected], ARM_values)
+        Stats.debug("ARM", Events["id"][Selected], ARM_values)
 print("\n")
 print("Data collection complete. Getting data analysis parameters..." + "\n")
 
@@ -181,21 +110,16 @@ print("Data collection complete. Getting data analysis parameters..." + "\n")
 #v1: see these values printed
 #TODO v2: store these values into a file
 
-FWHMlist = []
-RMSlist = []
-
-for i in range(len(HistARMlist)):
-    lower_range = i*10
-    upper_range = (i+1)*10
-    range_str = str(lower_range) + " to " + str(upper_range)
-    FWHMlist.append(h.getFWHM(HistARMlist[i]))
-    RMSlist.append(round(HistARMlist[i].GetRMS(), 2))
+FWHMlist = ARMbyPhi.getFWHM().tolist()
+RMSlist = ARMbyPhi.getRMS().tolist()
 
-    #print(range_str)
-    #print(str(h.getFWHM(HistARMlist[i])))
-    print("FWHM for range: " + range_str + ": " + str(h.getFWHM(HistARMlist[i])))
-    print("RMS for range: " + range_str + ": " + str(round(HistARMlist[i].GetRMS(), 2)))
+for i in range(ARMbyPhi.slices()):
+    range_str = str(int(ARMbyPhi.Edges[i])) + " to " + str(int(ARMbyPhi.Edges[i+1]))
+    print("FWHM for range: " + range_str + ": " + str(FWHMlist[i]))
+    print("RMS for range: " + range_str + ": " + str(RMSlist[i]))
 
 print(FWHMlist)
 print(RMSlist)
-print(list(countdict.values()))
+print([ARMbyPhi.Outside] + ARMbyPhi.entries().astype(int).tolist())
+
+Stats.write(args.stats)